@@ -74,15 +74,31 @@ True
 
 from __future__ import with_statement
 
+from collections import OrderedDict
+
+import datetime
+import hashlib
+import re
+import struct
 import thread
+import threading
+import time
+import uuid
+import zlib
+import Queue
 import System
 import clr
 
-from System import Array
+from System import Array, BitConverter, Byte, Convert, DateTime, Guid, Int32, Int64
+from System.Text import DecoderFallback, EncoderFallback, EncoderFallbackException
 from System.Globalization import CompareOptions, CultureInfo
-from System.IO import File, Path, Directory
+from System.IO import File, FileAccess, FileInfo, FileMode, FileShare, FileStream, HandleInheritability, Path, Directory
+from System.Security.Cryptography import SHA256
 from System.Text import Encoding
 
+clr.AddReference('System.Core')
+from System.IO.MemoryMappedFiles import MemoryMappedFile, MemoryMappedFileAccess
+
 clr.AddReferenceByPartialName('Esent.Interop')
 from Microsoft.Isam.Esent.Interop import Api
 
@@ -97,7 +113,9 @@ from Microsoft.Isam.Esent.Interop import JET_INDEXCREATE
 from Microsoft.Isam.Esent.Interop import JET_CP
 from Microsoft.Isam.Esent.Interop import JET_coltyp
 from Microsoft.Isam.Esent.Interop import JET_param
+from Microsoft.Isam.Esent.Interop import JET_TblInfo
 from Microsoft.Isam.Esent.Interop import JET_prep
+from Microsoft.Isam.Esent.Interop import JET_wrn
 
 from Microsoft.Isam.Esent.Interop import AttachDatabaseGrbit
 from Microsoft.Isam.Esent.Interop import CloseDatabaseGrbit
@@ -105,29 +123,70 @@ from Microsoft.Isam.Esent.Interop import ColumndefGrbit
 from Microsoft.Isam.Esent.Interop import CommitTransactionGrbit
 from Microsoft.Isam.Esent.Interop import CreateDatabaseGrbit
 from Microsoft.Isam.Esent.Interop import CreateIndexGrbit
+from Microsoft.Isam.Esent.Interop import DupCursorGrbit
 from Microsoft.Isam.Esent.Interop import EndSessionGrbit
 from Microsoft.Isam.Esent.Interop import InitGrbit
 from Microsoft.Isam.Esent.Interop import MakeKeyGrbit
 from Microsoft.Isam.Esent.Interop import OpenDatabaseGrbit
 from Microsoft.Isam.Esent.Interop import OpenTableGrbit
+from Microsoft.Isam.Esent.Interop import RetrieveColumnGrbit
+from Microsoft.Isam.Esent.Interop import RetrieveKeyGrbit
 from Microsoft.Isam.Esent.Interop import RollbackTransactionGrbit
 from Microsoft.Isam.Esent.Interop import SeekGrbit
 from Microsoft.Isam.Esent.Interop import SetColumnGrbit
+from Microsoft.Isam.Esent.Interop import SetIndexRangeGrbit
 
 from Microsoft.Isam.Esent.Interop import InstanceParameters
 from Microsoft.Isam.Esent.Interop import SystemParameters
 from Microsoft.Isam.Esent.Interop import EsentVersion
 from Microsoft.Isam.Esent.Interop import Conversions
 
+from Microsoft.Isam.Esent.Interop import EsentErrorException
+from Microsoft.Isam.Esent.Interop import EsentNoCurrentRecordException
+from Microsoft.Isam.Esent.Interop import EsentWriteConflictException
+
 from Microsoft.Isam.Esent.Interop.Server2003 import Server2003Grbits
 
+from Microsoft.Isam.Esent.Interop.Vista import VistaColtyp
 from Microsoft.Isam.Esent.Interop.Vista import VistaParam
 
+from Microsoft.Isam.Esent.Interop.Windows7 import Windows7Api
 from Microsoft.Isam.Esent.Interop.Windows7 import Windows7Param
+from Microsoft.Isam.Esent.Interop.Windows7 import PrereadKeysGrbit
 from Microsoft.Isam.Esent.Interop.Windows7 import Windows7Grbits
 
 _unspecified = object()
 
+# Binary values are exchanged as byte strings, with each character holding
+# one byte. Characters that don't fit in a byte are an error.
+_byteEncoding = Encoding.GetEncoding(28591, EncoderFallback.ExceptionFallback, DecoderFallback.ExceptionFallback)
+
+def _valueToBytes(value):
+    """Converts a value to the bytes stored in a binary column."""
+    if isinstance(value, Array[Byte]):
+        return value
+    if isinstance(value, bytearray):
+        return Array[Byte](value)
+    try:
+        return _byteEncoding.GetBytes(str(value))
+    except EncoderFallbackException:
+        raise EseDBError('binary values must be byte strings')
+
+def _toDateTime(d):
+    """Converts a datetime.datetime to a System.DateTime. Esent stores
+    times with millisecond precision.
+    
+    """
+    return DateTime(d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond // 1000)
+
+def _fromDateTime(t):
+    """Converts a System.DateTime to a datetime.datetime."""
+    return datetime.datetime(t.Year, t.Month, t.Day, t.Hour, t.Minute, t.Second, t.Millisecond * 1000)
+
+# Ordinal keys are stored as UTF-8, which sorts by code point when the
+# bytes are compared with memcmp.
+_ordinalKeyEncoding = Encoding.UTF8
+
 #-----------------------------------------------------------------------
 class _EseTransaction(object):
 #-----------------------------------------------------------------------
@@ -135,11 +194,31 @@ class _EseTransaction(object):
     a with statement. If the 'with' block ends normally the transaction
     will be committed, otherwise it will rollback.
     
+    A listener can be added for a session, to be told when a transaction
+    of the session begins, commits or rolls back. This is used to keep
+    changes made outside the database in step with its transactions.
+    
     """
     
+    # Maps sessions to their listeners
+    _listeners = {}
+    
     def __init__(self, sesid):
         self._sesid = sesid
         self._inTransaction = False
+
+    @staticmethod
+    def addListener(sesid, listener):
+        """Adds the listener for the transactions of a session. The listener
+        has begin(), commit() and rollback() methods, which are called after
+        the esent call has succeeded.
+        
+        """
+        _EseTransaction._listeners[sesid] = listener
+
+    @staticmethod
+    def removeListener(sesid):
+        del _EseTransaction._listeners[sesid]
         
     def __enter__(self):
         self.begin()
@@ -158,6 +237,8 @@ class _EseTransaction(object):
         Api.JetBeginTransaction(self._sesid)
         self._inTransaction = True
         self._updatesThisBatch = 0
+        if self._listeners.has_key(self._sesid):
+            self._listeners[self._sesid].begin()
     
     def commit(self, lazyflush=False):
         assert self._inTransaction, 'not in a transaction'
@@ -167,11 +248,15 @@ class _EseTransaction(object):
             commitgrbit = CommitTransactionGrbit.None        
         Api.JetCommitTransaction(self._sesid, commitgrbit)
         self._inTransaction = False
+        if self._listeners.has_key(self._sesid):
+            self._listeners[self._sesid].commit()
         
     def rollback(self):
         assert self._inTransaction, 'not in a transaction'
         Api.JetRollback(self._sesid, RollbackTransactionGrbit.None)
         self._inTransaction = False      
+        if self._listeners.has_key(self._sesid):
+            self._listeners[self._sesid].rollback()
 
     def pulse(self):
         assert self._inTransaction, 'not in a transaction'
@@ -225,6 +310,151 @@ class _EseUpdate(object):
         self._inUpdate = False    
 
     
+#-----------------------------------------------------------------------
+class _ExpirySweeper(object):
+#-----------------------------------------------------------------------
+    """A background thread which deletes the expired records of a table
+    every interval seconds, in transactions of up to batchsize records.
+    
+    The sweeper owns the cursor and closes it when the sweeper is stopped.
+    An error stops the thread, and is kept in error.
+    
+    """
+    
+    def __init__(self, cursor, interval, batchsize):
+        self._cursor = cursor
+        self._interval = interval
+        self._batchsize = batchsize
+        self.error = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target = self._sweep)
+        # A cursor which is never closed mustn't stop the process exiting
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the sweeper thread and close the cursor."""
+        if not self._stopped.isSet():
+            self._stopped.set()
+            self._thread.join()
+            self._cursor.close()
+
+    def _sweep(self):
+        """Delete expired records until the sweeper is stopped or an error
+        is raised. Records being written by a transaction are skipped by
+        the batches and deleted by a later sweep.
+        
+        """
+        while True:
+            self._stopped.wait(self._interval)
+            try:
+                while not self._stopped.isSet():
+                    if self._cursor._deleteExpiredBatch(self._batchsize) < self._batchsize:
+                        break
+            except Exception, e:
+                self.error = e
+                break
+            if self._stopped.isSet():
+                break
+
+
+#-----------------------------------------------------------------------
+class _EseScan(object):
+#-----------------------------------------------------------------------
+    """A scan of all the records in a table. A producer thread reads
+    chunks of records with a sequential cursor and puts them in a bounded
+    queue, so the next chunk is being read while the consumer processes
+    the current one. The size of the queue limits the memory used.
+    
+    The scan is an iterator. It owns the cursor and closes it when the
+    scan finishes or close() is called. The producer thread doesn't refer
+    to the scan, so a scan which is abandoned without being closed is
+    closed when it is garbage collected. The thread is a daemon thread,
+    so it never stops the process from exiting.
+    
+    """
+    
+    def __init__(self, cursor, chunksize, prefetch):
+        self._cursor = cursor
+        self._queue = Queue.Queue(prefetch)
+        self._stopped = threading.Event()
+        # The exception raised by the producer, if there is one
+        self._errors = []
+        self._chunk = iter([])
+        self._closed = False
+        self._thread = threading.Thread(
+            target = _EseScan._produce,
+            args = (cursor, chunksize, self._queue, self._stopped, self._errors))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            for record in self._chunk:
+                return record
+            if self._closed:
+                raise StopIteration
+            chunk = self._queue.get()
+            if None == chunk:
+                self.close()
+                if self._errors:
+                    raise self._errors[0]
+                raise StopIteration
+            self._chunk = iter(chunk)
+            
+    def close(self):
+        """Stop the producer thread and close the cursor."""
+        if not self._closed:
+            self._closed = True
+            self._chunk = iter([])
+            self._stopped.set()
+            self._thread.join()
+            self._cursor.close()
+
+    @staticmethod
+    def _produce(cursor, chunksize, queue, stopped, errors):
+        """Read the records and put them in the queue, followed by None
+        to mark the end of the scan.
+        
+        """
+        sesid = cursor._sesid
+        tableid = cursor._tableid
+        try:
+            with _EseTransaction(sesid) as trx:
+                Api.MoveBeforeFirst(sesid, tableid)
+                more = True
+                while more and not stopped.isSet():
+                    chunk = []
+                    while len(chunk) < chunksize:
+                        if not cursor._skipExpired(tableid, Api.TryMoveNext(sesid, tableid), Api.TryMoveNext):
+                            more = False
+                            break
+                        chunk.append(cursor._retrieveCurrentRecord())
+                    trx.commit()
+                    if chunk:
+                        _EseScan._put(queue, stopped, chunk)
+                    trx.begin()
+        except Exception, e:
+            errors.append(e)
+        _EseScan._put(queue, stopped, None)
+
+    @staticmethod
+    def _put(queue, stopped, item):
+        """Put an item in the queue, giving up if the scan is stopped."""
+        while not stopped.isSet():
+            try:
+                queue.put(item, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+    
+
 #-----------------------------------------------------------------------
 class _EseDBRegistry(object):
 #-----------------------------------------------------------------------
@@ -392,977 +622,3776 @@ class Counter(object):
 
 
 #-----------------------------------------------------------------------
-class _EseDB(object):
+class LazyValue(object):
 #-----------------------------------------------------------------------
-    """An esedb database. A database contains one table, which has two
-    columns, providing the key => value mappings. This class contains
-    a JET_INSTANCE and will open/create the database.
+    """The value of a record, which is only retrieved from the database
+    when get() is called. This is returned by iteritems(lazy=True) so that
+    callers which look at the key and skip most records don't pay for
+    retrieving the values they don't use.
     
-    Insert/Delete/Update/Lookup functionality is provided by the 
-    EseDBCursor class. One database can have many cursors and the
-    database is automatically closed when the last cursor is closed.
-    
-    The EseDB contains a lock used to synchronize updates by 
-    multiple cursors. This isn't really needed, as esent supports highly 
-    concurrent access to data, but if we allow multiple threads to update the 
-    database at the same time then we will face the problem of two threads 
-    updating the same record at the same time, which will generate a 
-    write-conflict error. Instead of dealing with those complexities we 
-    simply restrict updates to one thread at a time. For read operations the
-    snapshot isolation provided by esent transactions is sufficient.
+    The value is read from the current record if the cursor is still
+    positioned on it, otherwise a duplicate cursor goes to the record
+    using a bookmark saved when the LazyValue was created, leaving the
+    cursor where it was. If the record has been deleted get() raises a
+    KeyError, and if the cursor has been closed it raises
+    EseDBCursorClosedError.
     
     """
+
+    def __init__(self, cursor, bookmark):
+        self._cursor = cursor
+        self._bookmark = bookmark
+        self._retrieved = False
+        self._value = None
+
+    def get(self):
+        """Returns the value. The value is only retrieved once."""
+        if not self._retrieved:
+            self._cursor._checkNotClosed()
+            self._value = self._cursor._retrieveValueAtBookmark(self._bookmark)
+            self._retrieved = True
+        return self._value
+
+    def __repr__(self):
+        return 'LazyValue(%r)' % self.get()
+
+
+#-----------------------------------------------------------------------
+class _HotKeys(object):
+#-----------------------------------------------------------------------
+    """A bounded sample of recently used keys, which can be saved
+    when the database is closed and used to warm the cache when it is
+    reopened. Keys are stored in their normalized (esent index) form so
+    they can be preread without knowing how the key was made, and the
+    least recently recorded keys are discarded when the sample is full.
     
-    def __init__(self, instancename, filename):
-        self._filename = filename
-        self._directory = Path.GetDirectoryName(filename)
-        self._instancename = instancename
-        self._datatable = 'esedb_data'
-        self._keycolumn = 'key'
-        self._valuecolumn = 'value'
-        self._numCursors = 0
-        self._critsecs = [thread.allocate_lock() for i in range(31)]
-        self._instance = None    
-        self._basename = 'wdb'
-        self.cachedRecordCount = Counter()
-        
-    def openCursor(self, flag, lazyflush):
-        """Creates a new cursor on the database. This function will
-        initialize esent and create the database if necessary.
-        
-        This routine is synchronized by the global registry object.
-        Cursors are opened while the registry is locked.
+    """
+
+    def __init__(self, maxkeys):
+        self._critsec = thread.allocate_lock()
+        self._maxkeys = maxkeys
+        self._keys = OrderedDict()
+
+    def record(self, normalizedkey):
+        """Adds a normalized key to the sample."""
+        k = Convert.ToBase64String(normalizedkey)
+        with self._critsec:
+            if self._keys.has_key(k):
+                del self._keys[k]
+            elif len(self._keys) >= self._maxkeys:
+                self._keys.popitem(last=False)
+            self._keys[k] = None
+
+    def save(self, path):
+        """Writes the sampled keys to the given file."""
+        with self._critsec:
+            File.WriteAllLines(path, Array[str](self._keys.keys()))
+
+    def load(self, path):
+        """Reads keys saved by save() back into the sample. The keys are
+        returned in sorted order, which is the order of the records in the
+        primary index.
         
         """
-        _registry.assertLocked()
-        readonly = False
-        create = False
-        if flag == 'r':
-            readonly = True
-        if flag == 'c' and not File.Exists(self._filename):
-            create = True
-        if flag == 'n':
-            self._deleteDatabaseAndLogfiles()
-            create = True            
-                    
-        if None == self._instance:
-            self._instance = self._createInstance()    
-            grbit = InitGrbit.None
-            if EsentVersion.SupportsWindows7Features:
-                grbit = Windows7Grbits.ReplayIgnoreLostLogs
-            Api.JetInit2(self._instance, grbit)
-            
-        if create:
-            try:
-                self._createDatabase()
-            except:
-                # Don't leave a partially created database lying around
-                Api.JetTerm(self._instance)
-                self._deleteDatabaseAndLogfiles()
-                raise
-                
-        cursor = self._createCursor(readonly, lazyflush)
-        return cursor
+        saved = [k for k in File.ReadAllLines(path) if k]
+        with self._critsec:
+            for k in saved[-self._maxkeys:]:
+                self._keys[k] = None
+        keys = [Convert.FromBase64String(k) for k in saved]
+        keys.sort(key=tuple)
+        return keys
+
+
+#-----------------------------------------------------------------------
+class _KeyFormat(object):
+#-----------------------------------------------------------------------
+    """A key format converts keys to and from the key column and makes
+    search keys for the primary index. The format of a table is chosen
+    when the database is created and is identified by the type of the
+    key column.
+    
+    Keys are retrieved with retrieveKey(), which is given a grbit asking
+    for the key to be read from an index entry. Formats whose keys can be
+    recovered from the index use it, so the key column of the record isn't
+    read.
+    
+    """
+    
+    hashed = False
+    composite = False
+    
+    def indexDefinition(self, keycolumn):
+        """Returns the key definition of the primary index."""
+        return '+%s\0\0' % keycolumn
+
+    def trySeek(self, sesid, tableid, columnid, key):
+        """Seeks for the record with the given key, returning False if
+        there isn't one.
         
-    def closeCursor(self, esedbCursor):
-        _registry.lock()
-        try:
-            self._numCursors -= 1
-            if 0 == self._numCursors:
-                # The last cursor on the database has been closed
-                # unregister this object and terminate esent
-                _registry.unregisterDB(self)
-                Api.JetTerm(self._instance)
-                self._instance = None
-        finally:
-            _registry.unlock()
-            
-    def getWriteLock(self, hash=None):
         """
-        Gets a write-lock on the database. If no hash value is specified
-        then all locks are taken.
+        self.makeKey(sesid, tableid, key, MakeKeyGrbit.NewKey)
+        return Api.TrySeek(sesid, tableid, SeekGrbit.SeekEQ)
 
-        """
-        self._lock(lambda l: l.acquire(), hash)
-            
-    def unlock(self, hash=None):
-        """
-        Releases a write-lock on the database. If no hash value is specified
-        then all locks are released.
 
-        """
-        self._lock(lambda l: l.release(), hash)
+#-----------------------------------------------------------------------
+class _TextKeyFormat(_KeyFormat):
+#-----------------------------------------------------------------------
+    """Keys stored as Unicode text and sorted with the collation of the
+    current culture. This is the default key format. Every key is converted
+    to a string with str(). Text sorted by locale can't be recovered from
+    its sort key, so this format always reads the key column.
+    
+    """
+    
+    name = 'str'
+    coltyp = JET_coltyp.LongText
+    localeCollation = True
+    
+    def normalize(self, key):
+        """Converts a key to the type stored in the key column."""
+        return str(key)
 
-    def _lock(self, f, hash=None):
-        """
-        Applies a function to a database lock. If no hash value is specified
-        the function is applied to all locks.
+    def makeKey(self, sesid, tableid, key, grbit):
+        Api.MakeKey(sesid, tableid, str(key), Encoding.Unicode, grbit)
 
-        """
-        if None == hash:
-            for l in self._critsecs:            
-                f(l)
-        else:
-            i = hash % len(self._critsecs)
-            f(self._critsecs[i])
-            
-    def _createInstance(self):
-        """Create the JET_INSTANCE and set the system parameters. The
-        important changes here are to reduce the logfile size, turn
-        on circular logging and turn off the temporary database.
-        
-        """
-        instance = Api.JetCreateInstance(self._instancename)
-        parameters = InstanceParameters(instance)
-        parameters.WaypointLatency = 1
-        parameters.SystemDirectory = self._directory
-        parameters.TempDirectory = self._directory
-        parameters.LogFileDirectory = self._directory
-        parameters.BaseName = self._basename
-        parameters.CircularLog = True
-        parameters.NoInformationEvent = True
-        parameters.CreatePathIfNotExist = True
-        parameters.LogFileSize = 1024
-        parameters.MaxTemporaryTables = 0
-                    
-        return instance
+    def setColumn(self, sesid, tableid, columnid, key):
+        Api.SetColumn(sesid, tableid, columnid, str(key), Encoding.Unicode)
 
-    def _deleteDatabaseAndLogfiles(self):
-        """Delete the database and logfiles."""
-        if File.Exists(self._filename):
-            File.Delete(self._filename)
-        self._deleteFilesMatching(self._directory, '%s*.log' % self._basename)
-        self._deleteFilesMatching(self._directory, '%s.chk' % self._basename)
-            
-    def _deleteFilesMatching(self, directory, pattern):
-        """Delete files in the directory matching the pattern."""
-        if Directory.Exists(directory):
-            files = Directory.GetFiles(directory, pattern)
-            for f in files:
-                File.Delete(f)
-        
-    def _createIndex(self, sesid, tableid):
-        indexdef = '+%s\0\0' % self._keycolumn
+    def retrieveColumn(self, sesid, tableid, columnid):
+        return Api.RetrieveColumnAsString(sesid, tableid, columnid)
 
-        idxUnicode = JET_UNICODEINDEX(
-            lcid = CultureInfo.CurrentCulture.LCID,
-            dwMapFlags = Conversions.LCMapFlagsFromCompareOptions(CompareOptions.None))
+    def retrieveKey(self, sesid, tableid, columnid, grbit):
+        return self.retrieveColumn(sesid, tableid, columnid)
 
-        indexcreate = JET_INDEXCREATE(
-            szIndexName = 'primary',
-            szKey = indexdef,
-            cbKey = indexdef.Length,
-            grbit = CreateIndexGrbit.IndexUnique | CreateIndexGrbit.IndexPrimary,
-            cbKeyMost = SystemParameters.KeyMost,
-            pidxUnicode = idxUnicode)
-        indexcreates = Array[JET_INDEXCREATE]([indexcreate])
 
-        Api.JetCreateIndex2(sesid, tableid, indexcreates, 1);            
+#-----------------------------------------------------------------------
+class _OrdinalKeyFormat(_TextKeyFormat):
+#-----------------------------------------------------------------------
+    """String keys stored as UTF-8 in a binary column, which are compared
+    bytewise instead of with a locale.
     
-    def _createDatabase(self):
-        """Create the database, table and columns."""
-        sesid = Api.JetBeginSession(self._instance, '', '')        
+    """
+    
+    coltyp = JET_coltyp.LongBinary
+    localeCollation = False
+    
+    def makeKey(self, sesid, tableid, key, grbit):
+        Api.MakeKey(sesid, tableid, _ordinalKeyEncoding.GetBytes(str(key)), grbit)
+
+    def setColumn(self, sesid, tableid, columnid, key):
+        Api.SetColumn(sesid, tableid, columnid, _ordinalKeyEncoding.GetBytes(str(key)))
+
+    def retrieveColumn(self, sesid, tableid, columnid):
+        return _ordinalKeyEncoding.GetString(Api.RetrieveColumn(sesid, tableid, columnid))
+
+    def retrieveKey(self, sesid, tableid, columnid, grbit):
+        data = Api.RetrieveColumn(sesid, tableid, columnid, grbit, None)
+        # Esent normalizes binary data in 8 byte chunks, each taking 9
+        # bytes of the index entry. Index entries are truncated at KeyMost
+        # bytes, so a long key has to be read from the record.
+        if 1 + 9 * ((data.Length + 7) // 8) > self._keyMost() - 9:
+            return self.retrieveColumn(sesid, tableid, columnid)
+        return _ordinalKeyEncoding.GetString(data)
+
+    def _keyMost(self):
+        if None == self._keymost:
+            self._keymost = SystemParameters.KeyMost
+        return self._keymost
+    
+    _keymost = None
+
+
+#-----------------------------------------------------------------------
+class _Int64KeyFormat(_KeyFormat):
+#-----------------------------------------------------------------------
+    """Integer keys stored in a fixed 64-bit column, in numeric order."""
+    
+    name = 'int'
+    coltyp = JET_coltyp.Currency
+    localeCollation = False
+    
+    def normalize(self, key):
         try:
-            dbid = Api.JetCreateDatabase(
-                sesid,
-                self._filename,
-                '',
-                CreateDatabaseGrbit.OverwriteExisting)
-            with _EseTransaction(sesid) as trx:
-                tableid = Api.JetCreateTable(
-                    sesid,
-                    dbid,
-                    self._datatable,
-                    32,
-                    100)
-                self._addTextColumn(sesid, tableid, self._keycolumn)
-                self._addTextColumn(sesid, tableid, self._valuecolumn)
-                self._createIndex(sesid, tableid)
-                Api.JetCloseTable(sesid, tableid)
-                trx.commit(lazyflush=True)
-            Api.JetCloseDatabase(sesid, dbid, CloseDatabaseGrbit.None)
-            Api.JetDetachDatabase(sesid, self._filename)
-            
-            # As the database is newly created we know there are no records
-            self.cachedRecordCount.set(0)
-        finally:
-            Api.JetEndSession(sesid, EndSessionGrbit.None)
+            key = int(key)
+        except (TypeError, ValueError):
+            raise EseDBError('key %r is not an integer' % (key,))
+        if key < -2**63 or key >= 2**63:
+            raise EseDBError('key %r is not a 64-bit integer' % (key,))
+        return key
 
-    def _addTextColumn(self, sesid, tableid, column):
-        """Add a new text column to the given table."""
-        grbit = ColumndefGrbit.None
-        if EsentVersion.SupportsWindows7Features:
-            grbit = Windows7Grbits.ColumnCompressed        
-        columndef = JET_COLUMNDEF(
-            cp = JET_CP.Unicode,
-            coltyp = JET_coltyp.LongText,
-            grbit = grbit)
-        Api.JetAddColumn(
-            sesid,
-            tableid,
-            column,
-            columndef,
-            None,
-            0)
-            
-    def _createCursor(self, readonly, lazyflush):
-        """Creates a new EseDBCursor."""
-        sesid = Api.JetBeginSession(self._instance, '', '')
-        if readonly:
-            grbit = AttachDatabaseGrbit.ReadOnly
-        else:
-            grbit = AttachDatabaseGrbit.None
-        Api.JetAttachDatabase(sesid, self._filename, grbit)
-        if readonly:
-            grbit = OpenDatabaseGrbit.ReadOnly
+    def makeKey(self, sesid, tableid, key, grbit):
+        Api.MakeKey(sesid, tableid, Int64(self.normalize(key)), grbit)
+
+    def setColumn(self, sesid, tableid, columnid, key):
+        Api.SetColumn(sesid, tableid, columnid, Int64(self.normalize(key)))
+
+    def retrieveColumn(self, sesid, tableid, columnid):
+        return int(Api.RetrieveColumnAsInt64(sesid, tableid, columnid))
+
+    def retrieveKey(self, sesid, tableid, columnid, grbit):
+        return int(Api.RetrieveColumnAsInt64(sesid, tableid, columnid, grbit))
+
+
+#-----------------------------------------------------------------------
+class _GuidKeyFormat(_KeyFormat):
+#-----------------------------------------------------------------------
+    """uuid.UUID keys stored in a GUID column."""
+    
+    name = 'uuid'
+    coltyp = VistaColtyp.GUID
+    localeCollation = False
+    
+    def normalize(self, key):
+        if isinstance(key, uuid.UUID):
+            return key
+        try:
+            return uuid.UUID(str(key))
+        except ValueError:
+            raise EseDBError('key %r is not a uuid' % (key,))
+
+    def makeKey(self, sesid, tableid, key, grbit):
+        Api.MakeKey(sesid, tableid, Guid(str(self.normalize(key))), grbit)
+
+    def setColumn(self, sesid, tableid, columnid, key):
+        Api.SetColumn(sesid, tableid, columnid, Guid(str(self.normalize(key))))
+
+    def retrieveColumn(self, sesid, tableid, columnid):
+        return uuid.UUID(str(Api.RetrieveColumnAsGuid(sesid, tableid, columnid)))
+
+    def retrieveKey(self, sesid, tableid, columnid, grbit):
+        return uuid.UUID(str(Api.RetrieveColumnAsGuid(sesid, tableid, columnid, grbit)))
+
+
+#-----------------------------------------------------------------------
+class _DateTimeKeyFormat(_KeyFormat):
+#-----------------------------------------------------------------------
+    """datetime.datetime keys stored in a DateTime column, in time order.
+    Esent stores times with millisecond precision.
+    
+    """
+    
+    name = 'datetime'
+    coltyp = JET_coltyp.DateTime
+    localeCollation = False
+    
+    def normalize(self, key):
+        if not isinstance(key, datetime.datetime):
+            raise EseDBError('key %r is not a datetime' % (key,))
+        return key.replace(microsecond = key.microsecond - key.microsecond % 1000)
+
+    def makeKey(self, sesid, tableid, key, grbit):
+        Api.MakeKey(sesid, tableid, _toDateTime(self.normalize(key)), grbit)
+
+    def setColumn(self, sesid, tableid, columnid, key):
+        Api.SetColumn(sesid, tableid, columnid, _toDateTime(self.normalize(key)))
+
+    def retrieveColumn(self, sesid, tableid, columnid):
+        return _fromDateTime(Api.RetrieveColumnAsDateTime(sesid, tableid, columnid))
+
+    def retrieveKey(self, sesid, tableid, columnid, grbit):
+        return _fromDateTime(Api.RetrieveColumnAsDateTime(sesid, tableid, columnid, grbit))
+
+
+#-----------------------------------------------------------------------
+class _HashedKeyFormat(_KeyFormat):
+#-----------------------------------------------------------------------
+    """String keys of any length, indexed by a 64-bit hash of the key
+    instead of the key itself. The full key is stored in the key column,
+    which isn't indexed. A seek compares it with the keys of the records
+    that have the same hash, so collisions are resolved, and the cost of
+    a seek doesn't depend on the length of the key.
+    
+    The ordered format puts the first characters of the key, sorted by
+    locale, in front of the hash, so keys are ordered by their prefix and
+    keys with the same prefix are in hash order. The unordered format
+    only indexes the hash and doesn't use a locale at all.
+    
+    The last column of the index is an autoincrement column, which keeps
+    the index entries of colliding keys unique. The format needs the
+    column ids of the table, so one is created for each table when it is
+    opened.
+    
+    """
+    
+    name = 'str'
+    coltyp = JET_coltyp.LongText
+    hashed = True
+    hashColumn = 'keyhash'
+    prefixColumn = 'keyprefix'
+    sequenceColumn = 'keyseq'
+    prefixLength = 32
+    
+    def __init__(self, ordered, hashcolumnid=None, prefixcolumnid=None):
+        self.ordered = ordered
+        self.localeCollation = ordered
+        self.hashcolumnid = hashcolumnid
+        self.prefixcolumnid = prefixcolumnid
+
+    def normalize(self, key):
+        return str(key)
+
+    def indexDefinition(self, keycolumn):
+        if self.ordered:
+            return '+%s\0+%s\0+%s\0\0' % (self.prefixColumn, self.hashColumn, self.sequenceColumn)
+        return '+%s\0+%s\0\0' % (self.hashColumn, self.sequenceColumn)
+
+    def makeKey(self, sesid, tableid, key, grbit):
+        # Only the prefix is ordered, so this finds the first key with
+        # the same prefix
+        if not self.ordered:
+            raise EseDBError('unordered keys can\'t be searched by position')
+        Api.MakeKey(sesid, tableid, str(key)[:self.prefixLength], Encoding.Unicode, grbit)
+
+    def trySeek(self, sesid, tableid, columnid, key):
+        key = str(key)
+        h = self._hash(key)
+        if self.ordered:
+            Api.MakeKey(sesid, tableid, key[:self.prefixLength], Encoding.Unicode, MakeKeyGrbit.NewKey)
+            Api.MakeKey(sesid, tableid, Int64(h), MakeKeyGrbit.None)
         else:
-            grbit = OpenDatabaseGrbit.None
-        (wrn, dbid) = Api.JetOpenDatabase(sesid, self._filename, '', grbit)
-        tableid = Api.JetOpenTable(
-            sesid,
-            dbid,
-            self._datatable,
-            None,
-            0,
-            OpenTableGrbit.None)
-        keycolumnid = self._getColumnid(sesid, tableid, self._keycolumn)
-        valuecolumnid = self._getColumnid(sesid, tableid, self._valuecolumn)
-        cursor = EseDBCursor(self, sesid, tableid, lazyflush, keycolumnid, valuecolumnid)
-        self._numCursors += 1
-        return cursor
+            Api.MakeKey(sesid, tableid, Int64(h), MakeKeyGrbit.NewKey)
+        if not Api.TrySeek(sesid, tableid, SeekGrbit.SeekGE):
+            return False
+        while h == Api.RetrieveColumnAsInt64(sesid, tableid, self.hashcolumnid, RetrieveColumnGrbit.RetrieveFromIndex):
+            if key == self.retrieveColumn(sesid, tableid, columnid):
+                return True
+            if not Api.TryMoveNext(sesid, tableid):
+                break
+        return False
 
-    def _getColumnid(self, sesid, tableid, column):
-        """Returns the columnid of the column."""
-        columndef = clr.Reference[JET_COLUMNDEF]()
-        Api.JetGetTableColumnInfo(
-            sesid,
-            tableid,
-            column,
-            columndef)
-        return columndef.Value.columnid
+    def setColumn(self, sesid, tableid, columnid, key):
+        key = str(key)
+        Api.SetColumn(sesid, tableid, columnid, key, Encoding.Unicode)
+        Api.SetColumn(sesid, tableid, self.hashcolumnid, Int64(self._hash(key)))
+        if self.ordered:
+            Api.SetColumn(sesid, tableid, self.prefixcolumnid, key[:self.prefixLength], Encoding.Unicode)
+
+    def retrieveColumn(self, sesid, tableid, columnid):
+        return Api.RetrieveColumnAsString(sesid, tableid, columnid)
+
+    def retrieveKey(self, sesid, tableid, columnid, grbit):
+        return self.retrieveColumn(sesid, tableid, columnid)
+
+    def _hash(self, key):
+        """Returns a 64-bit hash of a key, which is the same on every machine."""
+        return struct.unpack('<q', hashlib.md5(key.encode('utf-8')).digest()[:8])[0]
+
+
+_textKeys = _TextKeyFormat()
+_ordinalKeys = _OrdinalKeyFormat()
+_keyFormats = {
+    str: _textKeys,
+    int: _Int64KeyFormat(),
+    long: _Int64KeyFormat(),
+    uuid.UUID: _GuidKeyFormat(),
+    datetime.datetime: _DateTimeKeyFormat(),
+    }
+
+
+#-----------------------------------------------------------------------
+class _CompositeKeyFormat(_KeyFormat):
+#-----------------------------------------------------------------------
+    """Tuple keys whose components are stored in a column each, using the
+    key format of the type of the component. The primary index is over
+    all the columns, so keys are ordered by their first component, then
+    by their second, and so on, and each component sorts in the order of
+    its type. Search keys can be made from the leading components of a
+    key, which is how prefix queries become index ranges.
+    
+    The first component is stored in the key column and the others in
+    numbered columns after it. The format needs the ids of those columns,
+    so one is created for each table when it is opened.
+    
+    """
+    
+    name = 'tuple'
+    composite = True
+    
+    def __init__(self, formats, columnids=None):
+        self.formats = formats
+        # The ids of the columns of the components after the first
+        self.columnids = columnids
+        self.coltyp = formats[0].coltyp
+        self.localeCollation = True in [f.localeCollation for f in formats]
+
+    @staticmethod
+    def columnName(keycolumn, i):
+        """Returns the name of the column of the i'th component."""
+        if 0 == i:
+            return keycolumn
+        return '%s_%d' % (keycolumn, i)
+
+    def normalize(self, key):
+        return self.normalizePrefix(key, len(self.formats))
+
+    def normalizePrefix(self, key, length=None):
+        """Normalizes the leading components of a key. If length is given
+        the key must have that many components.
         
-    def _filename(self):
-        """Returns the path of the database"""
-        return self._filename
+        """
+        if not isinstance(key, (tuple, list)) or 0 == len(key) or len(key) > len(self.formats):
+            raise EseDBError('key %r is not a tuple of up to %d components' % (key, len(self.formats)))
+        if None != length and len(key) != length:
+            raise EseDBError('key %r does not have %d components' % (key, length))
+        return tuple(f.normalize(k) for (f, k) in zip(self.formats, key))
+
+    def indexDefinition(self, keycolumn):
+        return ''.join('+%s\0' % self.columnName(keycolumn, i) for i in range(len(self.formats))) + '\0'
+
+    def makeKey(self, sesid, tableid, key, grbit):
+        # A key with fewer components makes a search key for the records
+        # starting with those components. The grbit applies to the first
+        # column made, except for a limit, which applies to the last.
+        key = self.normalizePrefix(key)
+        last = len(key) - 1
+        for (i, (f, k)) in enumerate(zip(self.formats, key)):
+            componentgrbit = MakeKeyGrbit.None
+            if 0 == i:
+                componentgrbit |= grbit & MakeKeyGrbit.NewKey
+            if last == i:
+                componentgrbit |= grbit ^ (grbit & MakeKeyGrbit.NewKey)
+            f.makeKey(sesid, tableid, k, componentgrbit)
+
+    def trySeek(self, sesid, tableid, columnid, key):
+        # Only a complete key identifies a record
+        return _KeyFormat.trySeek(self, sesid, tableid, columnid, self.normalize(key))
+
+    def setColumn(self, sesid, tableid, columnid, key):
+        key = self.normalize(key)
+        for (f, k, c) in zip(self.formats, key, [columnid] + self.columnids):
+            f.setColumn(sesid, tableid, c, k)
+
+    def retrieveColumn(self, sesid, tableid, columnid):
+        return tuple(f.retrieveColumn(sesid, tableid, c) for (f, c) in zip(self.formats, [columnid] + self.columnids))
+
+    def retrieveKey(self, sesid, tableid, columnid, grbit):
+        return tuple(f.retrieveKey(sesid, tableid, c, grbit) for (f, c) in zip(self.formats, [columnid] + self.columnids))
+
+
+#-----------------------------------------------------------------------
+class _RecordColumn(object):
+#-----------------------------------------------------------------------
+    """A named, typed column of a record table. Each column of a record is
+    stored in its own native esent column, so a single column can be
+    updated without rewriting the rest of the record. The position of the
+    column in the record is kept in the name of the esent column, which
+    lets the columns be read back in the order they were declared.
+    
+    """
+    
+    coltyps = {
+        str: JET_coltyp.LongText,
+        int: JET_coltyp.Currency,
+        long: JET_coltyp.Currency,
+        float: JET_coltyp.IEEEDouble,
+        bool: JET_coltyp.Bit,
+        datetime.datetime: JET_coltyp.DateTime,
+        bytearray: JET_coltyp.LongBinary,
+        }
+    
+    # The stored name adds a 5 character prefix and esent column names
+    # can be at most 64 characters long
+    _validName = re.compile(r'^[A-Za-z][A-Za-z0-9_]{0,58}$')
+    _storedName = re.compile(r'^c(\d{3})_(.+)$')
+    
+    def __init__(self, name, coltyp, position):
+        self.name = name
+        self.coltyp = coltyp
+        self.position = position
+        self.columnid = None
+
+    @staticmethod
+    def fromDeclaration(name, pytype, position):
+        """Creates a column from a (name, type) pair given by the caller."""
+        if not isinstance(name, str) or not _RecordColumn._validName.match(name):
+            raise EseDBError('invalid column name %r' % (name,))
+        if not _RecordColumn.coltyps.has_key(pytype):
+            raise EseDBError('invalid type for column %s' % name)
+        return _RecordColumn(name, _RecordColumn.coltyps[pytype], position)
+
+    @staticmethod
+    def fromColumnInfo(columninfo):
+        """Creates a column from an existing esent column, or returns None
+        if the esent column isn't a record column.
         
-    filename = property(_filename, doc='path of the database')
+        """
+        m = _RecordColumn._storedName.match(columninfo.Name)
+        if not m:
+            return None
+        column = _RecordColumn(m.group(2), columninfo.Coltyp, int(m.group(1)))
+        column.columnid = columninfo.Columnid
+        return column
+
+    def storedName(self):
+        """Returns the name of the esent column."""
+        return 'c%03d_%s' % (self.position, self.name)
+
+    def set(self, sesid, tableid, value):
+        """Sets the column. An update should be prepared."""
+        if None == value:
+            Api.SetColumn(sesid, tableid, self.columnid, None)
+        elif JET_coltyp.LongText == self.coltyp:
+            Api.SetColumn(sesid, tableid, self.columnid, self._convert(value), Encoding.Unicode, SetColumnGrbit.IntrinsicLV)
+        elif JET_coltyp.LongBinary == self.coltyp:
+            Api.SetColumn(sesid, tableid, self.columnid, self._convert(value), SetColumnGrbit.IntrinsicLV)
+        else:
+            Api.SetColumn(sesid, tableid, self.columnid, self._convert(value))
+
+    def makeKey(self, sesid, tableid, value, grbit):
+        """Makes a search key for a value of the column."""
+        if JET_coltyp.LongText == self.coltyp:
+            Api.MakeKey(sesid, tableid, self._convert(value), Encoding.Unicode, grbit)
+        else:
+            Api.MakeKey(sesid, tableid, self._convert(value), grbit)
+
+    def _convert(self, value):
+        """Converts a value to the type used to set the column."""
+        try:
+            if JET_coltyp.LongText == self.coltyp:
+                return str(value)
+            if JET_coltyp.LongBinary == self.coltyp:
+                return _valueToBytes(value)
+            if JET_coltyp.Currency == self.coltyp:
+                return Int64(int(value))
+            if JET_coltyp.IEEEDouble == self.coltyp:
+                return float(value)
+            if JET_coltyp.Bit == self.coltyp:
+                return bool(value)
+            if isinstance(value, datetime.datetime):
+                return _toDateTime(value)
+        except (TypeError, ValueError):
+            pass
+        raise EseDBError('invalid value %r for column %s' % (value, self.name))
+
+    def retrieve(self, sesid, tableid):
+        """Returns the value of the column in the current record."""
+        if JET_coltyp.LongText == self.coltyp:
+            return Api.RetrieveColumnAsString(sesid, tableid, self.columnid)
+        if JET_coltyp.LongBinary == self.coltyp:
+            data = Api.RetrieveColumn(sesid, tableid, self.columnid)
+            if None == data:
+                return None
+            return bytearray(data)
+        if JET_coltyp.Currency == self.coltyp:
+            value = Api.RetrieveColumnAsInt64(sesid, tableid, self.columnid)
+            if None == value:
+                return None
+            return int(value)
+        if JET_coltyp.IEEEDouble == self.coltyp:
+            return Api.RetrieveColumnAsDouble(sesid, tableid, self.columnid)
+        if JET_coltyp.Bit == self.coltyp:
+            return Api.RetrieveColumnAsBoolean(sesid, tableid, self.columnid)
+        value = Api.RetrieveColumnAsDateTime(sesid, tableid, self.columnid)
+        if None == value:
+            return None
+        return _fromDateTime(value)
 
 
 #-----------------------------------------------------------------------
-class EseDBError(Exception):
+class _IndexColumn(_RecordColumn):
 #-----------------------------------------------------------------------
-    """Esedb exception"""
+    """A column holding the output of the extractor of a secondary index.
+    The extractor is called with the value of a record every time the
+    record is written, and the result is stored in the column, which is
+    indexed. Extractors can't be stored in the database, so when a database
+    is opened its index columns are found without one and the extractor
+    has to be given again with the indexes option of open() or table().
     
-    def __init__(self, message):
-        self._message = message
+    """
+    
+    _storedName = re.compile(r'^idx_(.+)$')
+    
+    def __init__(self, name, coltyp, extractor=None):
+        _RecordColumn.__init__(self, name, coltyp, None)
+        self.extractor = extractor
+
+    @staticmethod
+    def fromDeclaration(name, pytype, extractor):
+        """Creates an index column for a new index."""
+        if not callable(extractor):
+            raise EseDBError('the extractor of index %s is not callable' % (name,))
+        column = _RecordColumn.fromDeclaration(name, pytype, None)
+        return _IndexColumn(column.name, column.coltyp, extractor)
+
+    @staticmethod
+    def fromColumnInfo(columninfo):
+        """Creates an index column from an existing esent column, or
+        returns None if the esent column isn't an index column.
         
-    def __repr__(self):
-        return 'EseDBError(%s)' % self._message
+        """
+        m = _IndexColumn._storedName.match(columninfo.Name)
+        if not m:
+            return None
+        column = _IndexColumn(m.group(1), columninfo.Coltyp)
+        column.columnid = columninfo.Columnid
+        return column
 
-    __str__ = __repr__
+    def storedName(self):
+        """Returns the name of the esent column and index."""
+        return 'idx_%s' % self.name
 
+
+#-----------------------------------------------------------------------
+class _ZlibCodec(object):
+#-----------------------------------------------------------------------
+    """Compresses values with zlib before they are stored. This works on
+    every version of Windows, unlike esent's own compression, and does
+    much better on large, repetitive values. Values shorter than the
+    threshold are not compressed, as compressing them costs more than it
+    saves.
+    
+    """
     
+    def __init__(self, level, threshold):
+        if not isinstance(level, int) or level < 1 or level > 9:
+            raise EseDBError('compression level must be between 1 and 9')
+        if threshold < 0:
+            raise EseDBError('compression threshold must not be negative')
+        self.level = level
+        self.threshold = threshold
+
+    def compress(self, data):
+        """Compresses a byte string."""
+        return zlib.compress(data, self.level)
+
+
 #-----------------------------------------------------------------------
-class EseDBCursorClosedError(EseDBError):
+class _BlobStore(object):
 #-----------------------------------------------------------------------
-    """Raised when a method is called on a closed cursor."""
+    """The table holding the values of deduplicated tables, opened in the
+    session of a cursor. Each distinct value is stored once, keyed by its
+    SHA-256 digest, with a count of the records which refer to it. The
+    counts are changed with escrow updates, so cursors adding and removing
+    references to a popular value don't conflict with each other.
     
-    def __init__(self):
-        EseDBError.__init__(self, 'cursor is closed')
+    Two cursors storing the same new value at the same time will each
+    insert a row for it. The rows are told apart by an autoincrement id,
+    so neither insert conflicts, and records refer to a value by its
+    digest and id.
     
+    """
     
+    def __init__(self, sesid, tableid):
+        self._sesid = sesid
+        self._tableid = tableid
+        columns = dict((c.Name, c.Columnid) for c in Api.GetTableColumns(sesid, tableid))
+        self._digestcolumnid = columns['digest']
+        self._idcolumnid = columns['id']
+        self._datacolumnid = columns['data']
+        self._refcountcolumnid = columns['refcount']
+
+    def close(self):
+        Api.JetCloseTable(self._sesid, self._tableid)
+
+    @staticmethod
+    def digest(data):
+        """Returns the digest of a byte array, as a byte array."""
+        sha = SHA256.Create()
+        try:
+            return sha.ComputeHash(data)
+        finally:
+            sha.Dispose()
+
+    def acquire(self, digest, data):
+        """Adds a reference to the value with the given digest and data,
+        storing it if it isn't already stored, and returns the id of its
+        row. The session should be in a transaction.
+        
+        """
+        Api.MakeKey(self._sesid, self._tableid, digest, MakeKeyGrbit.NewKey)
+        if Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekGE):
+            found = Api.RetrieveColumn(
+                self._sesid, self._tableid, self._digestcolumnid, RetrieveColumnGrbit.RetrieveFromIndex, None)
+            if tuple(found) == tuple(digest):
+                Api.EscrowUpdate(self._sesid, self._tableid, self._refcountcolumnid, 1)
+                return Api.RetrieveColumnAsInt32(
+                    self._sesid, self._tableid, self._idcolumnid, RetrieveColumnGrbit.RetrieveFromIndex)
+        # An escrow column can be set when its row is inserted, so the new
+        # row starts with its reference
+        with _EseUpdate(self._sesid, self._tableid, JET_prep.Insert) as u:
+            Api.SetColumn(self._sesid, self._tableid, self._digestcolumnid, digest)
+            Api.SetColumn(self._sesid, self._tableid, self._datacolumnid, data)
+            Api.SetColumn(self._sesid, self._tableid, self._refcountcolumnid, Int32(1))
+            blobid = Api.RetrieveColumnAsInt32(
+                self._sesid, self._tableid, self._idcolumnid, RetrieveColumnGrbit.RetrieveCopy)
+            u.update()
+        return blobid
+
+    def release(self, digest, blobid):
+        """Removes a reference to a stored value. Esent deletes the row
+        when the count reaches zero, if it supports that. Otherwise the row
+        stays and is reused when the value is stored again. The session
+        should be in a transaction.
+        
+        """
+        self._seek(digest, blobid)
+        Api.EscrowUpdate(self._sesid, self._tableid, self._refcountcolumnid, -1)
+
+    def retrieve(self, digest, blobid):
+        """Returns the data of a stored value as a byte array."""
+        self._seek(digest, blobid)
+        return Api.RetrieveColumn(self._sesid, self._tableid, self._datacolumnid)
+
+    def _seek(self, digest, blobid):
+        Api.MakeKey(self._sesid, self._tableid, digest, MakeKeyGrbit.NewKey)
+        Api.MakeKey(self._sesid, self._tableid, Int32(blobid), MakeKeyGrbit.None)
+        if not Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekEQ):
+            raise EseDBError('stored value %s is missing' % Convert.ToBase64String(digest))
+
+
 #-----------------------------------------------------------------------
-class EseDBCursor(object):
+class _DeferredDeletes(object):
 #-----------------------------------------------------------------------
-    """A cursor on an esedb database. A cursor contains a JET_SESID and
-    a JET_TABLEID along with a reference to the underlying EseDB.
+    """The side files of a table which have been released by a committed
+    transaction but may still be named in the snapshot of an older one.
+    It is shared by the _ExternalFiles of all the cursors on the table.
+    
+    The start of every outermost transaction, and every commit releasing
+    files, is given a tick from a clock. A file released at a tick is
+    deleted when every open transaction started after that tick, so no
+    transaction can still see the record which named it.
     
     """
+
+    def __init__(self):
+        self._critsec = thread.allocate_lock()
+        self._clock = 0
+        # Maps each _ExternalFiles whose session is in a transaction to
+        # the tick its transaction started at
+        self._snapshots = {}
+        # (tick, name) of the released files, oldest first
+        self._pending = []
+
+    def begin(self, files):
+        """Called when the outermost transaction of a session starts."""
+        self._critsec.acquire()
+        try:
+            self._clock += 1
+            self._snapshots[files] = self._clock
+        finally:
+            self._critsec.release()
+
+    def end(self, files, released):
+        """Called when the outermost transaction of a session ends, with
+        the names of the files it released if it committed. Returns the
+        names of the files which can now be deleted.
         
-    # Decorator that checks self (args[0]) isn't closed
-    def cursorMustBeOpen(func):
-        def checked_func(*args, **kwargs):
-            args[0]._checkNotClosed()
-            return func(*args, **kwargs)
-        # Promote the documentation so doctest will work
-        checked_func.__doc__ = func.__doc__
-        return checked_func
+        """
+        self._critsec.acquire()
+        try:
+            del self._snapshots[files]
+            if released:
+                self._clock += 1
+                self._pending.extend((self._clock, name) for name in released)
+            if self._snapshots:
+                oldest = min(self._snapshots.values())
+            else:
+                oldest = self._clock + 1
+            ready = [name for (tick, name) in self._pending if tick < oldest]
+            self._pending = [(tick, name) for (tick, name) in self._pending if tick >= oldest]
+            return ready
+        finally:
+            self._critsec.release()
+
+
+#-----------------------------------------------------------------------
+class _ExternalFiles(object):
+#-----------------------------------------------------------------------
+    """The side files of a cursor's table, which hold values larger than a
+    threshold outside the database. Records hold the name of the file of
+    their value. The files are written and read as raw bytes, so huge
+    values don't go through the version store or the database cache, and
+    they are read with memory-mapped I/O.
+    
+    The object is the transaction listener of the cursor's session. A file
+    written in a transaction which rolls back is deleted. The file of a
+    value which is replaced or deleted is released when the outermost
+    transaction commits, and deleted once no transaction of the other
+    cursors on the table can still see the old value. Files left behind
+    by a crash are deleted when the table is next opened.
+    
+    The threshold is None for a cursor which doesn't write new files.
+    
+    """
+    
+    def __init__(self, directory, threshold, deferred):
+        self._directory = directory
+        self.threshold = threshold
+        self._deferred = deferred
+        # The (created, released) file names of each open transaction level
+        self._levels = []
+
+    def begin(self):
+        if not self._levels:
+            self._deferred.begin(self)
+        self._levels.append(([], []))
+
+    def commit(self):
+        (created, released) = self._levels.pop()
+        if self._levels:
+            # A nested transaction; its changes are kept or undone with
+            # the transaction it is in
+            self._levels[-1][0].extend(created)
+            self._levels[-1][1].extend(released)
+        else:
+            for name in self._deferred.end(self, released):
+                self._delete(name)
+
+    def rollback(self):
+        (created, released) = self._levels.pop()
+        for name in created:
+            self._delete(name)
+        if not self._levels:
+            for name in self._deferred.end(self, []):
+                self._delete(name)
+
+    def close(self):
+        """Called when the cursor is closed. Ending the session rolls back
+        any transaction it is still in.
         
-    def __init__(self, database, sesid, tableid, lazyflush, keycolumnid, valuecolumnid):
-        """Initialize a new EseDBCursor on the specified database."""
-        self._database = database
-        self._sesid = sesid
-        self._tableid = tableid
-        self._lazyflush = lazyflush
-        self._keycolumnid = keycolumnid
-        self._valuecolumnid = valuecolumnid
-        self._isopen = True
-        self._encoding = Encoding.Unicode
+        """
+        while self._levels:
+            self.rollback()
+
+    def write(self, data, flush):
+        """Writes a byte array to a new file and returns its name. If flush
+        is true the data is on disk before this returns. The session must be
+        in a transaction.
         
-    def __del__(self):
-        """Called when garbage collection is removing the object. Close it."""
-        self.close()
+        """
+        Directory.CreateDirectory(self._directory)
+        name = Guid.NewGuid().ToString('N')
+        self._levels[-1][0].append(name)
+        stream = FileStream(self._path(name), FileMode.CreateNew, FileAccess.Write, FileShare.None)
+        try:
+            stream.Write(data, 0, data.Length)
+            if flush:
+                stream.Flush(True)
+        finally:
+            stream.Dispose()
+        return name
+
+    def release(self, name):
+        """Deletes a file once the current transaction commits."""
+        self._levels[-1][1].append(name)
+
+    def read(self, name):
+        """Reads a file into a new byte array."""
+        data = Array.CreateInstance(Byte, self.size(name))
+        self.readInto(name, data)
+        return data
+
+    def readInto(self, name, buffer):
+        """Reads as much of a file as fits into a byte array and returns
+        the size of the file.
         
-    @cursorMustBeOpen
-    def __getitem__(self, key): 
-        """Returns the value of the record with the specified key.
+        """
+        # Files are opened so that they can still be deleted, a commit
+        # by another cursor doesn't have to wait for readers
+        stream = self._open(name)
+        try:
+            size = stream.Length
+            n = min(size, buffer.Length)
+            if n > 0:
+                mapping = MemoryMappedFile.CreateFromFile(
+                    stream, None, 0, MemoryMappedFileAccess.Read, None, HandleInheritability.None, True)
+                try:
+                    view = mapping.CreateViewAccessor(0, n, MemoryMappedFileAccess.Read)
+                    try:
+                        view.ReadArray[Byte](0, buffer, 0, n)
+                    finally:
+                        view.Dispose()
+                finally:
+                    mapping.Dispose()
+            return size
+        finally:
+            stream.Dispose()
 
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['a'] = 'somedata'
-        >>> x['a']
-        'somedata'
-        >>> x.close()
+    def size(self, name):
+        try:
+            return FileInfo(self._path(name)).Length
+        except IOError:
+            raise EseDBError('the file holding a value is missing, it may have been replaced')
+
+    def deleteUnreferenced(self, referenced):
+        """Deletes the files whose names aren't in the set of referenced
+        names.
+        
+        """
+        if Directory.Exists(self._directory):
+            for path in Directory.GetFiles(self._directory):
+                if not Path.GetFileName(path) in referenced:
+                    File.Delete(path)
+
+    def _open(self, name):
+        try:
+            return FileStream(self._path(name), FileMode.Open, FileAccess.Read, FileShare.Read | FileShare.Delete)
+        except IOError:
+            raise EseDBError('the file holding a value is missing, it may have been replaced')
+
+    def _delete(self, name):
+        try:
+            File.Delete(self._path(name))
+        except IOError:
+            # The file is deleted when the table is next opened
+            pass
+
+    def _path(self, name):
+        return Path.Combine(self._directory, name)
+
+
+#-----------------------------------------------------------------------
+class _TableLayout(object):
+#-----------------------------------------------------------------------
+    """Describes how the records of a table are stored. When a database
+    is created the layout holds the options requested by the caller. When
+    a cursor is opened the layout is read back from the columns of the
+    table, so databases created with different options, or by older
+    versions of esedb, are opened correctly.
+    
+    """
+
+    def __init__(self, binaryvalues=False, keyformat=_textKeys, recordcolumns=None, smallvaluesize=None,
+                 initialpages=32, density=100, dedup=False, external=False, expiry=False):
+        self.binaryvalues = binaryvalues
+        self.keyformat = keyformat
+        # The number of pages allocated when the table is created and the
+        # percentage of each page filled before a new page is started
+        self.initialpages = initialpages
+        self.density = density
+        # True if the values are kept in the blob table, which is only set
+        # when the table is created. An opened table has the ids of the
+        # columns referring to the blob table instead.
+        self.dedup = dedup
+        self.blobdigestcolumnid = None
+        self.blobidcolumnid = None
+        # True if values can be kept in side files, which is only set when
+        # the table is created
+        self.external = external
+        self.externalcolumnid = None
+        self.countercolumnid = None
+        # True if records can expire, which is only set when the table is
+        # created. The expiry column has an index of the same name.
+        self.expiry = expiry
+        self.expirycolumnid = None
+        self.expiryindex = None
+        # The largest value, in bytes, kept in the small value column
+        # instead of the long value column, or None if the table doesn't
+        # have one
+        self.smallvaluesize = smallvaluesize
+        self.smallvaluecolumnid = None
+        # A list of _RecordColumn objects for a record table, which
+        # has no value column
+        self.recordcolumns = recordcolumns
+        # A list of _IndexColumn objects for the secondary indexes of
+        # the table. This is only filled in when a table is opened.
+        self.indexcolumns = []
+        self.keycolumnid = None
+        self.valuecolumnid = None
+        self.versioncolumnid = None
+        self.generationcolumnid = None
+        self.compressedcolumnid = None
+
+
+#-----------------------------------------------------------------------
+class _EseDB(object):
+#-----------------------------------------------------------------------
+    """An esedb database. A database contains a default table, which
+    provides the key => value mappings, and any number of named tables
+    created with EseDBCursor.table(). All the tables share one instance,
+    so they share one cache, log stream and checkpoint. This class contains
+    a JET_INSTANCE and will open/create the database.
+    
+    Insert/Delete/Update/Lookup functionality is provided by the 
+    EseDBCursor class. One database can have many cursors and the
+    database is automatically closed when the last cursor is closed.
+    
+    The EseDB contains a lock used to synchronize updates by 
+    multiple cursors. This isn't really needed, as esent supports highly 
+    concurrent access to data, but if we allow multiple threads to update the 
+    database at the same time then we will face the problem of two threads 
+    updating the same record at the same time, which will generate a 
+    write-conflict error. Instead of dealing with those complexities we 
+    simply restrict updates to one thread at a time. For read operations the
+    snapshot isolation provided by esent transactions is sufficient.
+    
+    """
+    
+    def __init__(self, instancename, filename):
+        self._filename = filename
+        self._directory = Path.GetDirectoryName(filename)
+        self._instancename = instancename
+        self._datatable = 'esedb_data'
+        self._namedtableprefix = 'esedb_table_'
+        self._keycolumn = 'key'
+        self._valuecolumn = 'value'
+        self._versioncolumn = 'version'
+        self._generationcolumn = 'generation'
+        self._compressedcolumn = 'compressed'
+        self._smallvaluecolumn = 'smallvalue'
+        self._blobtable = 'esedb_blobs'
+        self._blobdigestcolumn = 'blobdigest'
+        self._blobidcolumn = 'blobid'
+        self._externalcolumn = 'externalfile'
+        self._countercolumn = 'counter'
+        self._expirycolumn = 'expires'
+        self._externaldirectory = '%s.files' % filename
+        self._sweptTables = set()
+        self._deferredDeletes = {}
+        self._numCursors = 0
+        self._critsecs = [thread.allocate_lock() for i in range(31)]
+        self._generationLock = thread.allocate_lock()
+        self._lastGeneration = 0
+        self._instance = None    
+        self._basename = 'wdb'
+        self._hotkeysfile = Path.Combine(self._directory, '%s.hot' % self._basename)
+        self._prereadThread = None
+        self._stopPreread = False
+        self._recordCounts = {}
+        self._indexes = {}
+        self.hotKeys = _HotKeys(4096)
+        
+    def openCursor(self, flag, lazyflush, layout, codec=None, growth=None, external=None):
+        """Creates a new cursor on the database. This function will
+        initialize esent and create the database if necessary. The
+        layout is only used when the database is created. If a codec
+        is given the cursor compresses the values it writes. If growth
+        is given the database file grows by that many pages at a time
+        from now on. If external is given the cursor writes values
+        larger than that many bytes to side files.
+        
+        This routine is synchronized by the global registry object.
+        Cursors are opened while the registry is locked.
+        
+        """
+        _registry.assertLocked()
+        readonly = False
+        create = False
+        if flag == 'r':
+            readonly = True
+        if flag == 'c' and not File.Exists(self._filename):
+            create = True
+        if flag == 'n':
+            self._deleteDatabaseAndLogfiles()
+            create = True            
+                    
+        warmcache = False
+        if None == self._instance:
+            self._instance = self._createInstance()    
+            grbit = InitGrbit.None
+            if EsentVersion.SupportsWindows7Features:
+                grbit = Windows7Grbits.ReplayIgnoreLostLogs
+            Api.JetInit2(self._instance, grbit)
+            warmcache = not create
+        if None != growth:
+            InstanceParameters(self._instance).DbExtensionSize = growth
+            
+        if create:
+            try:
+                self._createDatabase(layout)
+            except:
+                # Don't leave a partially created database lying around
+                Api.JetTerm(self._instance)
+                self._deleteDatabaseAndLogfiles()
+                raise
+                
+        cursor = self._createCursor(readonly, lazyflush, codec=codec, external=external)
+        if warmcache:
+            # The database is attached now, so the cache can be warmed
+            self._startPreread(readonly)
+        return cursor
+
+    def openScanCursor(self, readonly, lazyflush, table=None):
+        """Creates a new cursor on the database which is used to scan
+        the table sequentially. The database must already be open.
+        
+        """
+        _registry.lock()
+        try:
+            return self._createCursor(readonly, lazyflush, sequential=True, table=table)
+        finally:
+            _registry.unlock()
+
+    def openSweepCursor(self, lazyflush, table=None):
+        """Creates a new cursor on the database which is used by an
+        _ExpirySweeper. The database must already be open.
+        
+        """
+        _registry.lock()
+        try:
+            return self._createCursor(False, lazyflush, table=table)
+        finally:
+            _registry.unlock()
+
+    def openTableCursor(self, table, readonly, lazyflush, layout, codec=None, external=None):
+        """Creates a new cursor on the named table, creating the table
+        with the given layout if it doesn't exist. The database must
+        already be open.
+        
+        """
+        if not isinstance(table, str) or not re.match(r'^[A-Za-z][A-Za-z0-9_]{0,51}$', table):
+            raise EseDBError('invalid table name %r' % (table,))
+        _registry.lock()
+        try:
+            return self._createCursor(readonly, lazyflush, table=table, layout=layout, codec=codec, external=external)
+        finally:
+            _registry.unlock()
+
+    def indexes(self, table=None):
+        """Returns a dictionary of index names to the _IndexColumn objects
+        of the secondary indexes of the table. The dictionary is shared by
+        all the cursors on the table, so an index added by one cursor is
+        maintained by all of them.
+        
+        """
+        tablename = self._tableName(table)
+        if not self._indexes.has_key(tablename):
+            self._indexes[tablename] = {}
+        return self._indexes[tablename]
+
+    def addIndex(self, sesid, tableid, column, populate):
+        """Adds a secondary index over an _IndexColumn to the table.
+        The column is added first and populate() is called to fill it in
+        for the existing records. The index is created afterwards so that
+        esent builds it from sorted runs instead of inserting the entries
+        one at a time. The caller should hold the write lock.
+        
+        """
+        with _EseTransaction(sesid) as trx:
+            column.columnid = self._addRecordColumn(sesid, tableid, column)
+            trx.commit(lazyflush=True)
+        try:
+            populate()
+            with _EseTransaction(sesid) as trx:
+                indexdef = '+%s\0\0' % column.storedName()
+                indexcreate = self._makeIndexCreate(
+                    column.storedName(),
+                    indexdef,
+                    CreateIndexGrbit.IndexIgnoreAnyNull,
+                    JET_coltyp.LongText == column.coltyp)
+                Api.JetCreateIndex2(sesid, tableid, Array[JET_INDEXCREATE]([indexcreate]), 1)
+                trx.commit(lazyflush=True)
+        except:
+            # Don't leave a column without an index behind, it would
+            # be mistaken for an index when the table is opened
+            with _EseTransaction(sesid) as trx:
+                Api.JetDeleteColumn(sesid, tableid, column.storedName())
+                trx.commit(lazyflush=True)
+            raise
+
+    def recordCount(self, table=None):
+        """Returns the Counter caching the number of records in the table."""
+        tablename = self._tableName(table)
+        if not self._recordCounts.has_key(tablename):
+            self._recordCounts[tablename] = Counter()
+        return self._recordCounts[tablename]
+        
+    def closeCursor(self, esedbCursor):
+        _registry.lock()
+        try:
+            self._numCursors -= 1
+            if 0 == self._numCursors:
+                # The last cursor on the database has been closed
+                # unregister this object and terminate esent
+                _registry.unregisterDB(self)
+                self._sweptTables = set()
+                self._deferredDeletes = {}
+                self._stopPrereadThread()
+                self._saveHotKeys()
+                Api.JetTerm(self._instance)
+                self._instance = None
+        finally:
+            _registry.unlock()
+
+    def _startPreread(self, readonly):
+        """Starts a background thread that reads the keys saved
+        when the database was last closed into the cache.
+        
+        """
+        if not File.Exists(self._hotkeysfile):
+            return
+        keys = self.hotKeys.load(self._hotkeysfile)
+        if keys:
+            self._stopPreread = False
+            self._prereadThread = threading.Thread(target = self._prereadKeys, args = (keys, readonly))
+            # Warming the cache shouldn't keep the process alive
+            self._prereadThread.daemon = True
+            self._prereadThread.start()
+
+    def _stopPrereadThread(self):
+        """Stops the preread thread, if it is running."""
+        if None != self._prereadThread:
+            self._stopPreread = True
+            self._prereadThread.join()
+            self._prereadThread = None
+
+    def _prereadKeys(self, keys, readonly):
+        """Reads the records with the given normalized keys into the
+        cache. The keys are sorted, so the reads are issued in key order.
+        This runs on a background thread and is best-effort: errors are
+        ignored.
+        
+        """
+        batchsize = 64
+        sesid = Api.JetBeginSession(self._instance, '', '')
+        tableid = None
+        try:
+            if readonly:
+                grbit = OpenDatabaseGrbit.ReadOnly
+            else:
+                grbit = OpenDatabaseGrbit.None
+            (wrn, dbid) = Api.JetOpenDatabase(sesid, self._filename, '', grbit)
+            tableid = Api.JetOpenTable(
+                sesid,
+                dbid,
+                self._datatable,
+                None,
+                0,
+                OpenTableGrbit.ReadOnly)
+            i = 0
+            while i < len(keys) and not self._stopPreread:
+                batch = keys[i:i+batchsize]
+                if EsentVersion.SupportsWindows7Features:
+                    # Issue asynchronous reads for the batch. Esent can
+                    # preread fewer keys than it was given, in which case
+                    # the next batch starts with the first key it skipped.
+                    preread = Windows7Api.JetPrereadKeys(
+                        sesid,
+                        tableid,
+                        Array[Array[Byte]](batch),
+                        Array[int]([k.Length for k in batch]),
+                        len(batch),
+                        PrereadKeysGrbit.Forward)
+                    if 0 == preread:
+                        # Make progress by reading the first key
+                        self._seekNormalizedKey(sesid, tableid, batch[0])
+                        preread = 1
+                else:
+                    for k in batch:
+                        self._seekNormalizedKey(sesid, tableid, k)
+                    preread = len(batch)
+                i += preread
+        except EsentErrorException:
+            pass
+        finally:
+            if None != tableid:
+                try:
+                    Api.JetCloseTable(sesid, tableid)
+                except EsentErrorException:
+                    pass
+            Api.JetEndSession(sesid, EndSessionGrbit.None)
+
+    def _seekNormalizedKey(self, sesid, tableid, key):
+        """Seeks for a record with the given normalized key, which reads
+        it into the cache.
+        
+        """
+        Api.MakeKey(sesid, tableid, key, MakeKeyGrbit.NormalizedKey)
+        Api.TrySeek(sesid, tableid, SeekGrbit.SeekEQ)
+
+    def _saveHotKeys(self):
+        """Saves the sample of hot keys so they can be preread the
+        next time the database is opened.
+        
+        """
+        try:
+            self.hotKeys.save(self._hotkeysfile)
+        except (System.IO.IOException, System.UnauthorizedAccessException):
+            # This happens if the directory is read-only. Warming the
+            # cache is an optimization so the error is ignored.
+            pass
+            
+    def getWriteLock(self, hash=None):
+        """
+        Gets a write-lock on the database. If no hash value is specified
+        then all locks are taken.
+
+        """
+        self._lock(lambda l: l.acquire(), hash)
+            
+    def unlock(self, hash=None):
+        """
+        Releases a write-lock on the database. If no hash value is specified
+        then all locks are released.
+
+        """
+        self._lock(lambda l: l.release(), hash)
+
+    def getWriteLocks(self, hashes):
+        """
+        Gets the write-locks for a set of hash values and returns the
+        locks taken, for unlockWriteLocks(). Each lock is taken once, in
+        the same order as getWriteLock() takes all of them, so callers
+        can't deadlock.
+
+        """
+        locks = sorted(set(hash % len(self._critsecs) for hash in hashes))
+        for i in locks:
+            self._critsecs[i].acquire()
+        return locks
+
+    def unlockWriteLocks(self, locks):
+        """
+        Releases the write-locks returned by getWriteLocks().
+
+        """
+        for i in reversed(locks):
+            self._critsecs[i].release()
+
+    def _lock(self, f, hash=None):
+        """
+        Applies a function to a database lock. If no hash value is specified
+        the function is applied to all locks.
+
+        """
+        if None == hash:
+            for l in self._critsecs:            
+                f(l)
+        else:
+            i = hash % len(self._critsecs)
+            f(self._critsecs[i])
+            
+    def _createInstance(self):
+        """Create the JET_INSTANCE and set the system parameters. The
+        important changes here are to reduce the logfile size, turn
+        on circular logging and turn off the temporary database.
+        
+        """
+        instance = Api.JetCreateInstance(self._instancename)
+        parameters = InstanceParameters(instance)
+        parameters.WaypointLatency = 1
+        parameters.SystemDirectory = self._directory
+        parameters.TempDirectory = self._directory
+        parameters.LogFileDirectory = self._directory
+        parameters.BaseName = self._basename
+        parameters.CircularLog = True
+        parameters.NoInformationEvent = True
+        parameters.CreatePathIfNotExist = True
+        parameters.LogFileSize = 1024
+        parameters.MaxTemporaryTables = 0
+                    
+        return instance
+
+    def _deleteDatabaseAndLogfiles(self):
+        """Delete the database and logfiles."""
+        if File.Exists(self._filename):
+            File.Delete(self._filename)
+        self._deleteFilesMatching(self._directory, '%s*.log' % self._basename)
+        self._deleteFilesMatching(self._directory, '%s.chk' % self._basename)
+        self._deleteFilesMatching(self._directory, '%s.hot' % self._basename)
+        if Directory.Exists(self._externaldirectory):
+            Directory.Delete(self._externaldirectory, True)
+            
+    def _deleteFilesMatching(self, directory, pattern):
+        """Delete files in the directory matching the pattern."""
+        if Directory.Exists(directory):
+            files = Directory.GetFiles(directory, pattern)
+            for f in files:
+                File.Delete(f)
+        
+    def _createIndex(self, sesid, tableid, layout):
+        indexdef = layout.keyformat.indexDefinition(self._keycolumn)
+        indexcreate = self._makeIndexCreate(
+            'primary',
+            indexdef,
+            CreateIndexGrbit.IndexUnique | CreateIndexGrbit.IndexPrimary,
+            layout.keyformat.localeCollation)
+        Api.JetCreateIndex2(sesid, tableid, Array[JET_INDEXCREATE]([indexcreate]), 1)
+
+    def _makeIndexCreate(self, name, indexdef, grbit, localeCollation):
+        """Returns a JET_INDEXCREATE for an index. Text is sorted with the
+        collation of the current culture. Binary and fixed columns are
+        compared bytewise, so no locale is needed for them.
+        
+        """
+        if not localeCollation:
+            return JET_INDEXCREATE(
+                szIndexName = name,
+                szKey = indexdef,
+                cbKey = indexdef.Length,
+                grbit = grbit,
+                cbKeyMost = SystemParameters.KeyMost)
+
+        idxUnicode = JET_UNICODEINDEX(
+            lcid = CultureInfo.CurrentCulture.LCID,
+            dwMapFlags = Conversions.LCMapFlagsFromCompareOptions(CompareOptions.None))
+        return JET_INDEXCREATE(
+            szIndexName = name,
+            szKey = indexdef,
+            cbKey = indexdef.Length,
+            grbit = grbit,
+            cbKeyMost = SystemParameters.KeyMost,
+            pidxUnicode = idxUnicode)
+    
+    def _createDatabase(self, layout):
+        """Create the database, table and columns."""
+        sesid = Api.JetBeginSession(self._instance, '', '')        
+        try:
+            dbid = Api.JetCreateDatabase(
+                sesid,
+                self._filename,
+                '',
+                CreateDatabaseGrbit.OverwriteExisting)
+            with _EseTransaction(sesid) as trx:
+                self._createTable(sesid, dbid, self._datatable, layout)
+                trx.commit(lazyflush=True)
+            Api.JetCloseDatabase(sesid, dbid, CloseDatabaseGrbit.None)
+            Api.JetDetachDatabase(sesid, self._filename)
+            
+            # As the database is newly created we know there are no records
+            # and none of the named tables exist
+            self._recordCounts = {}
+            self._indexes = {}
+            self.recordCount().set(0)
+        finally:
+            Api.JetEndSession(sesid, EndSessionGrbit.None)
+
+    def _createTable(self, sesid, dbid, tablename, layout):
+        """Create a table with the given layout. The session should
+        already be in a transaction.
+        
+        """
+        tableid = Api.JetCreateTable(
+            sesid,
+            dbid,
+            tablename,
+            layout.initialpages,
+            layout.density)
+        self._addKeyColumn(sesid, tableid, self._keycolumn, layout.keyformat)
+        if None != layout.recordcolumns:
+            for column in layout.recordcolumns:
+                self._addRecordColumn(sesid, tableid, column)
+        elif layout.binaryvalues:
+            self._addBinaryColumn(sesid, tableid, self._valuecolumn)
+        else:
+            self._addTextColumn(sesid, tableid, self._valuecolumn)
+        if None != layout.smallvaluesize:
+            self._addSmallValueColumn(sesid, tableid, self._smallvaluecolumn, layout)
+        self._addVersionColumn(sesid, tableid, self._versioncolumn)
+        self._addGenerationColumn(sesid, tableid, self._generationcolumn)
+        self._addCounterColumn(sesid, tableid, self._countercolumn)
+        if None == layout.recordcolumns:
+            self._addCompressedColumn(sesid, tableid, self._compressedcolumn)
+        if layout.dedup:
+            self._addBlobReferenceColumns(sesid, tableid)
+            self._createBlobTable(sesid, dbid)
+        if layout.external:
+            self._addExternalColumn(sesid, tableid)
+        if layout.expiry:
+            self._addExpiryColumn(sesid, tableid)
+        self._createIndex(sesid, tableid, layout)
+        Api.JetCloseTable(sesid, tableid)
+
+    def _createBlobTable(self, sesid, dbid):
+        """Create the table used by _BlobStore, unless it exists already.
+        It is shared by all the deduplicated tables in the database. The
+        session should already be in a transaction.
+        
+        """
+        (found, tableid) = Api.TryOpenTable(sesid, dbid, self._blobtable, OpenTableGrbit.None)
+        if found:
+            Api.JetCloseTable(sesid, tableid)
+            return
+        tableid = Api.JetCreateTable(sesid, dbid, self._blobtable, 16, 100)
+        refcountgrbit = ColumndefGrbit.ColumnEscrowUpdate
+        if EsentVersion.SupportsServer2003Features:
+            refcountgrbit |= Server2003Grbits.ColumnDeleteOnZero
+        columndefs = [
+            ('digest', JET_COLUMNDEF(
+                coltyp = JET_coltyp.Binary,
+                cbMax = 32,
+                grbit = ColumndefGrbit.ColumnNotNULL), None),
+            ('id', JET_COLUMNDEF(
+                coltyp = JET_coltyp.Long,
+                grbit = ColumndefGrbit.ColumnFixed | ColumndefGrbit.ColumnAutoincrement), None),
+            ('data', JET_COLUMNDEF(
+                coltyp = JET_coltyp.LongBinary,
+                grbit = ColumndefGrbit.None), None),
+            # Escrow columns must have a default value
+            ('refcount', JET_COLUMNDEF(
+                coltyp = JET_coltyp.Long,
+                grbit = refcountgrbit), BitConverter.GetBytes(Int32(0))),
+            ]
+        for (name, columndef, default) in columndefs:
+            if None == default:
+                Api.JetAddColumn(sesid, tableid, name, columndef, None, 0)
+            else:
+                Api.JetAddColumn(sesid, tableid, name, columndef, default, default.Length)
+        indexcreate = self._makeIndexCreate(
+            'primary',
+            '+digest\0+id\0\0',
+            CreateIndexGrbit.IndexUnique | CreateIndexGrbit.IndexPrimary,
+            False)
+        Api.JetCreateIndex2(sesid, tableid, Array[JET_INDEXCREATE]([indexcreate]), 1)
+        Api.JetCloseTable(sesid, tableid)
+
+    def _addTextColumn(self, sesid, tableid, column):
+        """Add a new text column to the given table and return its id."""
+        grbit = ColumndefGrbit.None
+        if EsentVersion.SupportsWindows7Features:
+            grbit = Windows7Grbits.ColumnCompressed        
+        columndef = JET_COLUMNDEF(
+            cp = JET_CP.Unicode,
+            coltyp = JET_coltyp.LongText,
+            grbit = grbit)
+        return Api.JetAddColumn(
+            sesid,
+            tableid,
+            column,
+            columndef,
+            None,
+            0)
+
+    def _addKeyColumn(self, sesid, tableid, column, keyformat):
+        """Add the key column for the given key format to the table."""
+        if keyformat.composite:
+            for (i, f) in enumerate(keyformat.formats):
+                self._addKeyColumn(sesid, tableid, keyformat.columnName(column, i), f)
+        elif keyformat.hashed:
+            self._addHashedKeyColumns(sesid, tableid, column, keyformat)
+        elif JET_coltyp.LongText == keyformat.coltyp:
+            self._addTextColumn(sesid, tableid, column)
+        elif JET_coltyp.LongBinary == keyformat.coltyp:
+            self._addBinaryColumn(sesid, tableid, column)
+        else:
+            if VistaColtyp.GUID == keyformat.coltyp and not EsentVersion.SupportsVistaFeatures:
+                raise EseDBError('uuid keys require Windows Vista or later')
+            columndef = JET_COLUMNDEF(
+                coltyp = keyformat.coltyp,
+                grbit = ColumndefGrbit.ColumnFixed | ColumndefGrbit.ColumnNotNULL)
+            Api.JetAddColumn(
+                sesid,
+                tableid,
+                column,
+                columndef,
+                None,
+                0)
+
+    def _addHashedKeyColumns(self, sesid, tableid, column, keyformat):
+        """Add the columns of a _HashedKeyFormat to the table. The key
+        column holds the full key and the other columns are indexed.
+        
+        """
+        self._addTextColumn(sesid, tableid, column)
+        columndefs = [
+            (keyformat.hashColumn, JET_COLUMNDEF(
+                coltyp = JET_coltyp.Currency,
+                grbit = ColumndefGrbit.ColumnFixed | ColumndefGrbit.ColumnNotNULL)),
+            (keyformat.sequenceColumn, JET_COLUMNDEF(
+                coltyp = JET_coltyp.Long,
+                grbit = ColumndefGrbit.ColumnFixed | ColumndefGrbit.ColumnAutoincrement)),
+            ]
+        if keyformat.ordered:
+            columndefs.append((keyformat.prefixColumn, JET_COLUMNDEF(
+                cp = JET_CP.Unicode,
+                coltyp = JET_coltyp.Text,
+                cbMax = 2 * keyformat.prefixLength,
+                grbit = ColumndefGrbit.ColumnNotNULL)))
+        for (name, columndef) in columndefs:
+            Api.JetAddColumn(
+                sesid,
+                tableid,
+                name,
+                columndef,
+                None,
+                0)
+
+    def _addBinaryColumn(self, sesid, tableid, column):
+        """Add a new binary column to the given table and return its id."""
+        grbit = ColumndefGrbit.None
+        if EsentVersion.SupportsWindows7Features:
+            grbit = Windows7Grbits.ColumnCompressed        
+        columndef = JET_COLUMNDEF(
+            coltyp = JET_coltyp.LongBinary,
+            grbit = grbit)
+        return Api.JetAddColumn(
+            sesid,
+            tableid,
+            column,
+            columndef,
+            None,
+            0)
+
+    def _addRecordColumn(self, sesid, tableid, column):
+        """Add a column of a record table to the given table and return
+        its id. Text and binary columns are long value columns, other types are stored in
+        fixed columns which are kept in the record.
+        
+        """
+        if JET_coltyp.LongText == column.coltyp:
+            return self._addTextColumn(sesid, tableid, column.storedName())
+        elif JET_coltyp.LongBinary == column.coltyp:
+            return self._addBinaryColumn(sesid, tableid, column.storedName())
+        else:
+            columndef = JET_COLUMNDEF(
+                coltyp = column.coltyp,
+                grbit = ColumndefGrbit.ColumnFixed)
+            return Api.JetAddColumn(
+                sesid,
+                tableid,
+                column.storedName(),
+                columndef,
+                None,
+                0)
+
+    def _addSmallValueColumn(self, sesid, tableid, column, layout):
+        """Add a column for values of up to layout.smallvaluesize bytes.
+        This isn't a long value column, so small values are stored in the
+        record itself and reading one only touches the page of the record.
+        
+        """
+        if layout.binaryvalues:
+            columndef = JET_COLUMNDEF(
+                coltyp = JET_coltyp.Binary,
+                cbMax = layout.smallvaluesize)
+        else:
+            columndef = JET_COLUMNDEF(
+                cp = JET_CP.Unicode,
+                coltyp = JET_coltyp.Text,
+                cbMax = layout.smallvaluesize)
+        return Api.JetAddColumn(
+            sesid,
+            tableid,
+            column,
+            columndef,
+            None,
+            0)
+
+    def _addCompressedColumn(self, sesid, tableid, column):
+        """Add a column holding values compressed by a _ZlibCodec. The
+        value column of a record is null when its value is in this column.
+        Esent compression is not used as the data is already compressed.
+        
+        """
+        columndef = JET_COLUMNDEF(
+            coltyp = JET_coltyp.LongBinary,
+            grbit = ColumndefGrbit.None)
+        return Api.JetAddColumn(
+            sesid,
+            tableid,
+            column,
+            columndef,
+            None,
+            0)
+
+    def _addBlobReferenceColumns(self, sesid, tableid):
+        """Add the columns holding the digest and id of the row in the
+        blob table which holds the value of a record. The value column
+        of a record is null when its value is in the blob table.
+        
+        """
+        columndefs = [
+            (self._blobdigestcolumn, JET_COLUMNDEF(
+                coltyp = JET_coltyp.Binary,
+                cbMax = 32,
+                grbit = ColumndefGrbit.None)),
+            (self._blobidcolumn, JET_COLUMNDEF(
+                coltyp = JET_coltyp.Long,
+                grbit = ColumndefGrbit.ColumnFixed)),
+            ]
+        for (name, columndef) in columndefs:
+            Api.JetAddColumn(
+                sesid,
+                tableid,
+                name,
+                columndef,
+                None,
+                0)
+
+    def _addExternalColumn(self, sesid, tableid):
+        """Add the column holding the name of the side file of a value,
+        and return its id. The value column of a record is null when its
+        value is in a side file. The column is indexed so that the names
+        in use can be found without reading every record.
+        
+        """
+        columndef = JET_COLUMNDEF(
+            cp = JET_CP.Unicode,
+            coltyp = JET_coltyp.Text,
+            cbMax = 64,
+            grbit = ColumndefGrbit.None)
+        columnid = Api.JetAddColumn(
+            sesid,
+            tableid,
+            self._externalcolumn,
+            columndef,
+            None,
+            0)
+        indexcreate = self._makeIndexCreate(
+            self._externalcolumn,
+            '+%s\0\0' % self._externalcolumn,
+            CreateIndexGrbit.IndexIgnoreAnyNull,
+            False)
+        Api.JetCreateIndex2(sesid, tableid, Array[JET_INDEXCREATE]([indexcreate]), 1)
+        return columnid
+
+    def _addExpiryColumn(self, sesid, tableid):
+        """Add the column holding the time a record expires, in UTC. It is
+        null for records which don't expire, which aren't in its index, so
+        the expired records are found without reading the others.
+        
+        """
+        columndef = JET_COLUMNDEF(
+            coltyp = JET_coltyp.DateTime,
+            grbit = ColumndefGrbit.ColumnFixed)
+        Api.JetAddColumn(
+            sesid,
+            tableid,
+            self._expirycolumn,
+            columndef,
+            None,
+            0)
+        indexcreate = self._makeIndexCreate(
+            self._expirycolumn,
+            '+%s\0\0' % self._expirycolumn,
+            CreateIndexGrbit.IndexIgnoreAnyNull,
+            False)
+        Api.JetCreateIndex2(sesid, tableid, Array[JET_INDEXCREATE]([indexcreate]), 1)
+
+    def _externalFiles(self, table, threshold):
+        """Returns an _ExternalFiles for the side files of a table."""
+        tablename = self._tableName(table)
+        if not self._deferredDeletes.has_key(tablename):
+            self._deferredDeletes[tablename] = _DeferredDeletes()
+        return _ExternalFiles(
+            Path.Combine(self._externaldirectory, tablename), threshold, self._deferredDeletes[tablename])
+
+    def _sweepExternalFiles(self, sesid, tableid, columnid, files):
+        """Deletes the side files of a table which no record refers to.
+        They are left behind if esedb stops after writing a file but before
+        committing its record, or after committing a record but before
+        deleting the file of the value it replaced.
+        
+        """
+        referenced = set()
+        with _EseTransaction(sesid):
+            dupid = Api.JetDupCursor(sesid, tableid, DupCursorGrbit.None)
+            try:
+                Api.JetSetCurrentIndex(sesid, dupid, self._externalcolumn)
+                found = Api.TryMoveFirst(sesid, dupid)
+                while found:
+                    referenced.add(Api.RetrieveColumnAsString(sesid, dupid, columnid))
+                    found = Api.TryMoveNext(sesid, dupid)
+            finally:
+                Api.JetCloseTable(sesid, dupid)
+        files.deleteUnreferenced(referenced)
+
+    def _addVersionColumn(self, sesid, tableid, column):
+        """Add a version column to the given table. Esent increments the
+        column automatically each time the record is updated.
+        
+        """
+        columndef = JET_COLUMNDEF(
+            coltyp = JET_coltyp.Long,
+            grbit = ColumndefGrbit.ColumnVersion)
+        Api.JetAddColumn(
+            sesid,
+            tableid,
+            column,
+            columndef,
+            None,
+            0)
+            
+    def _addGenerationColumn(self, sesid, tableid, column):
+        """Add the generation column to the given table. It is set every
+        time the value of a record is written, so a key which is deleted
+        and inserted again doesn't get the versions it had before, and
+        writes which don't change the value don't change the version.
+        
+        """
+        columndef = JET_COLUMNDEF(coltyp = JET_coltyp.Currency)
+        Api.JetAddColumn(
+            sesid,
+            tableid,
+            column,
+            columndef,
+            None,
+            0)
+
+    def newGeneration(self):
+        """Returns the generation of a newly written value, which is
+        larger than any returned before. Generations are taken from the
+        clock so they keep increasing when the database is reopened.
+        
+        """
+        self._generationLock.acquire()
+        try:
+            self._lastGeneration = max(self._lastGeneration + 1, DateTime.UtcNow.Ticks)
+            return self._lastGeneration
+        finally:
+            self._generationLock.release()
+
+    def _addCounterColumn(self, sesid, tableid, column):
+        """Add the counter column to the given table. It is changed with
+        escrow updates, which don't conflict with each other, so it has to
+        have a default value.
+        
+        """
+        columndef = JET_COLUMNDEF(
+            coltyp = JET_coltyp.Long,
+            grbit = ColumndefGrbit.ColumnFixed | ColumndefGrbit.ColumnEscrowUpdate)
+        default = BitConverter.GetBytes(Int32(0))
+        Api.JetAddColumn(
+            sesid,
+            tableid,
+            column,
+            columndef,
+            default,
+            default.Length)
+
+    def _createCursor(self, readonly, lazyflush, sequential=False, table=None, layout=None, codec=None, external=None):
+        """Creates a new EseDBCursor. If sequential is true the table is
+        opened with a hint that it will be scanned sequentially, which
+        makes esent read ahead.
+        
+        The cursor is opened on the default table, or on the named table
+        if one is given. A named table that doesn't exist is created with
+        the given layout.
+        
+        """
+        sesid = Api.JetBeginSession(self._instance, '', '')
+        if readonly:
+            grbit = AttachDatabaseGrbit.ReadOnly
+        else:
+            grbit = AttachDatabaseGrbit.None
+        Api.JetAttachDatabase(sesid, self._filename, grbit)
+        if readonly:
+            grbit = OpenDatabaseGrbit.ReadOnly
+        else:
+            grbit = OpenDatabaseGrbit.None
+        (wrn, dbid) = Api.JetOpenDatabase(sesid, self._filename, '', grbit)
+        if sequential:
+            grbit = OpenTableGrbit.Sequential
+        else:
+            grbit = OpenTableGrbit.None
+        tablename = self._tableName(table)
+        (found, tableid) = Api.TryOpenTable(sesid, dbid, tablename, grbit)
+        if not found:
+            if readonly or None == layout:
+                Api.JetEndSession(sesid, EndSessionGrbit.None)
+                raise EseDBError('table %s does not exist' % table)
+            with _EseTransaction(sesid) as trx:
+                self._createTable(sesid, dbid, tablename, layout)
+                trx.commit(lazyflush=True)
+            self.recordCount(table).set(0)
+            tableid = Api.JetOpenTable(
+                sesid,
+                dbid,
+                tablename,
+                None,
+                0,
+                grbit)
+        if sequential and EsentVersion.SupportsWindows7Features:
+            Api.JetSetTableSequential(sesid, tableid, Windows7Grbits.Forward)
+        layout = self._getTableLayout(sesid, tableid)
+        if None != layout.recordcolumns:
+            # Records are stored in columns, not as one value
+            codec = None
+        if None != codec and None == layout.compressedcolumnid and not readonly:
+            # Tables created by older versions of esedb don't have the column
+            # for compressed values. Other cursors wouldn't know the column
+            # was added, so it can only be added by the first cursor.
+            if 0 != self._numCursors:
+                Api.JetEndSession(sesid, EndSessionGrbit.None)
+                raise EseDBError('compression can only be enabled on this database when it is first opened')
+            with _EseTransaction(sesid) as trx:
+                layout.compressedcolumnid = self._addCompressedColumn(sesid, tableid, self._compressedcolumn)
+                trx.commit(lazyflush=True)
+        if None != external and None == layout.externalcolumnid and not readonly:
+            # As with the compressed column, only the first cursor can add
+            # the column for side files
+            if 0 != self._numCursors:
+                Api.JetEndSession(sesid, EndSessionGrbit.None)
+                raise EseDBError('external values can only be enabled on this database when it is first opened')
+            with _EseTransaction(sesid) as trx:
+                layout.externalcolumnid = self._addExternalColumn(sesid, tableid)
+                trx.commit(lazyflush=True)
+        externalfiles = None
+        if None != layout.externalcolumnid:
+            if readonly:
+                external = None
+            externalfiles = self._externalFiles(table, external)
+            tablename = self._tableName(table)
+            if not readonly and not tablename in self._sweptTables:
+                self._sweepExternalFiles(sesid, tableid, layout.externalcolumnid, externalfiles)
+                self._sweptTables.add(tablename)
+        indexes = self.indexes(table)
+        for column in layout.indexcolumns:
+            if not indexes.has_key(column.name):
+                indexes[column.name] = column
+        blobstore = None
+        if None != layout.blobdigestcolumnid:
+            blobstore = _BlobStore(sesid, Api.JetOpenTable(sesid, dbid, self._blobtable, None, 0, OpenTableGrbit.None))
+        cursor = EseDBCursor(self, sesid, tableid, lazyflush, layout, readonly, table, codec, blobstore, externalfiles)
+        self._numCursors += 1
+        return cursor
+
+    def _tableName(self, table):
+        """Returns the name of the esent table holding the given table."""
+        if None == table:
+            return self._datatable
+        return self._namedtableprefix + table
+
+    def _getTableLayout(self, sesid, tableid):
+        """Returns a _TableLayout describing the columns of the table."""
+        columns = dict((c.Name, c) for c in Api.GetTableColumns(sesid, tableid))
+        layout = _TableLayout()
+        layout.keycolumnid = columns[self._keycolumn].Columnid
+        if columns.has_key(self._valuecolumn):
+            layout.valuecolumnid = columns[self._valuecolumn].Columnid
+            layout.binaryvalues = JET_coltyp.LongBinary == columns[self._valuecolumn].Coltyp
+        else:
+            # A record table stores each column of the value separately
+            recordcolumns = [_RecordColumn.fromColumnInfo(c) for c in columns.values()]
+            layout.recordcolumns = sorted([c for c in recordcolumns if None != c], key=lambda c: c.position)
+        if columns.has_key(_HashedKeyFormat.hashColumn):
+            prefixcolumnid = None
+            if columns.has_key(_HashedKeyFormat.prefixColumn):
+                prefixcolumnid = columns[_HashedKeyFormat.prefixColumn].Columnid
+            layout.keyformat = _HashedKeyFormat(
+                None != prefixcolumnid,
+                columns[_HashedKeyFormat.hashColumn].Columnid,
+                prefixcolumnid)
+        elif columns.has_key(_CompositeKeyFormat.columnName(self._keycolumn, 1)):
+            formats = [self._keyFormatOfColumn(columns[self._keycolumn])]
+            columnids = []
+            name = _CompositeKeyFormat.columnName(self._keycolumn, 1)
+            while columns.has_key(name):
+                formats.append(self._keyFormatOfColumn(columns[name]))
+                columnids.append(columns[name].Columnid)
+                name = _CompositeKeyFormat.columnName(self._keycolumn, len(formats))
+            layout.keyformat = _CompositeKeyFormat(formats, columnids)
+        else:
+            layout.keyformat = self._keyFormatOfColumn(columns[self._keycolumn])
+        indexcolumns = [_IndexColumn.fromColumnInfo(c) for c in columns.values()]
+        layout.indexcolumns = [c for c in indexcolumns if None != c]
+        # Databases created by older versions of esedb don't have a version column
+        if columns.has_key(self._versioncolumn):
+            layout.versioncolumnid = columns[self._versioncolumn].Columnid
+        # Tables created by older versions of esedb don't have a generation column
+        if columns.has_key(self._generationcolumn):
+            layout.generationcolumnid = columns[self._generationcolumn].Columnid
+        if columns.has_key(self._compressedcolumn):
+            layout.compressedcolumnid = columns[self._compressedcolumn].Columnid
+        if columns.has_key(self._smallvaluecolumn):
+            layout.smallvaluecolumnid = columns[self._smallvaluecolumn].Columnid
+            layout.smallvaluesize = columns[self._smallvaluecolumn].MaxLength
+        if columns.has_key(self._blobdigestcolumn):
+            layout.blobdigestcolumnid = columns[self._blobdigestcolumn].Columnid
+            layout.blobidcolumnid = columns[self._blobidcolumn].Columnid
+        if columns.has_key(self._externalcolumn):
+            layout.externalcolumnid = columns[self._externalcolumn].Columnid
+        # Databases created by older versions of esedb don't have a counter column
+        if columns.has_key(self._countercolumn):
+            layout.countercolumnid = columns[self._countercolumn].Columnid
+        if columns.has_key(self._expirycolumn):
+            layout.expirycolumnid = columns[self._expirycolumn].Columnid
+            layout.expiryindex = self._expirycolumn
+        return layout
+
+    def _keyFormatOfColumn(self, column):
+        """Returns the key format of a key column, from its type."""
+        for keyformat in [_textKeys, _ordinalKeys] + _keyFormats.values():
+            if keyformat.coltyp == column.Coltyp:
+                return keyformat
+        raise EseDBError('unknown key column type %s' % column.Coltyp)
+
+    def _filename(self):
+        """Returns the path of the database"""
+        return self._filename
+        
+    filename = property(_filename, doc='path of the database')
+
+
+#-----------------------------------------------------------------------
+class EseDBError(Exception):
+#-----------------------------------------------------------------------
+    """Esedb exception"""
+    
+    def __init__(self, message):
+        self._message = message
+        
+    def __repr__(self):
+        return 'EseDBError(%s)' % self._message
+
+    __str__ = __repr__
+
+    
+#-----------------------------------------------------------------------
+class EseDBCursorClosedError(EseDBError):
+#-----------------------------------------------------------------------
+    """Raised when a method is called on a closed cursor."""
+    
+    def __init__(self):
+        EseDBError.__init__(self, 'cursor is closed')
+    
+    
+#-----------------------------------------------------------------------
+class EseDBTransaction(object):
+#-----------------------------------------------------------------------
+    """A transaction started with EseDBCursor.transaction(). Everything
+    the cursor does between the start of the transaction and its commit
+    or rollback is atomic. This object can be used in a with statement,
+    which commits the transaction if the block ends normally and rolls
+    it back otherwise.
+    
+    Savepoints are nested esent transactions, begun on top of the
+    transaction and any earlier savepoints.
+    
+    """
+
+    # Esent allows 7 levels of nested transactions. The transaction uses
+    # one and the methods of the cursor begin one more on top of the
+    # savepoints (the blob store works in the method's transaction).
+    _maxSavepoints = 7 - 2
+
+    def __init__(self, cursor, durable):
+        self._cursor = cursor
+        self._durable = durable
+        self._trx = _EseTransaction(cursor._sesid)
+        self._trx.begin()
+        # The nested transactions of the savepoints, innermost last
+        self._savepoints = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etyp, einst, etb):
+        if self.active:
+            if None == etyp:
+                self.commit()
+            else:
+                self.rollback()
+
+    @property
+    def active(self):
+        """True until the transaction is committed or rolled back."""
+        return self._trx._inTransaction
+
+    def commit(self):
+        """Commits the transaction. Unless the transaction is durable the
+        commit is flushed to disk lazily.
+        
+        """
+        self._checkActive()
+        while self._savepoints:
+            self._savepoints.pop().commit()
+        self._trx.commit(lazyflush=not self._durable)
+        self._cursor._endTransaction(self, committed=True)
+
+    def rollback(self):
+        """Rolls back the transaction, undoing all of its changes."""
+        self._checkActive()
+        while self._savepoints:
+            self._savepoints.pop().rollback()
+        self._trx.rollback()
+        self._cursor._endTransaction(self, committed=False)
+
+    def savepoint(self):
+        """Returns a savepoint, which rollback_to() can undo the changes
+        made after. Esent only allows a few levels of nested transactions
+        and the methods of the cursor use one of them, so at most five
+        savepoints can be held at once. EseDBError is raised for more.
+        
+        """
+        self._checkActive()
+        if len(self._savepoints) >= self._maxSavepoints:
+            raise EseDBError('too many savepoints, at most %d can be held' % self._maxSavepoints)
+        savepoint = _EseTransaction(self._cursor._sesid)
+        savepoint.begin()
+        self._savepoints.append(savepoint)
+        return savepoint
+
+    def rollback_to(self, savepoint):
+        """Undoes the changes made since the savepoint was taken, including
+        the changes of any later savepoints, which are discarded. The
+        savepoint can be rolled back to again.
+        
+        """
+        self._checkSavepoint(savepoint)
+        while True:
+            s = self._savepoints.pop()
+            s.rollback()
+            if s is savepoint:
+                break
+        self._cursor._rolledBack()
+        savepoint.begin()
+        self._savepoints.append(savepoint)
+
+    def release(self, savepoint):
+        """Discards the savepoint, and any later savepoints, keeping the
+        changes made since it was taken as part of the transaction.
+        
+        """
+        self._checkSavepoint(savepoint)
+        while True:
+            s = self._savepoints.pop()
+            s.commit()
+            if s is savepoint:
+                break
+
+    def _checkActive(self):
+        if not self.active:
+            raise EseDBError('transaction has already ended')
+
+    def _checkSavepoint(self, savepoint):
+        self._checkActive()
+        if savepoint not in self._savepoints:
+            raise EseDBError('unknown savepoint')
+
+
+#-----------------------------------------------------------------------
+class EseDBCursor(object):
+#-----------------------------------------------------------------------
+    """A cursor on an esedb database. A cursor contains a JET_SESID and
+    a JET_TABLEID along with a reference to the underlying EseDB.
+    
+    """
+        
+    # Decorator that checks self (args[0]) isn't closed
+    def cursorMustBeOpen(func):
+        def checked_func(*args, **kwargs):
+            args[0]._checkNotClosed()
+            return func(*args, **kwargs)
+        # Promote the documentation so doctest will work
+        checked_func.__doc__ = func.__doc__
+        return checked_func
+
+    # Decorator that retries a write of self (args[0]) which conflicts with
+    # the transaction of another cursor, until that transaction has ended.
+    # A write inside a transaction isn't retried because it would see the
+    # same snapshot and conflict again.
+    def retryOnWriteConflict(func):
+        def retrying_func(*args, **kwargs):
+            cursor = args[0]
+            if None != cursor._transaction:
+                return func(*args, **kwargs)
+            deadline = time.time() + cursor._writeConflictTimeout
+            delay = 0.001
+            while True:
+                try:
+                    return func(*args, **kwargs)
+                except EsentWriteConflictException:
+                    # The write was rolled back, which the cached record
+                    # count doesn't know about
+                    cursor._rolledBack()
+                    if time.time() >= deadline:
+                        raise EseDBError('the write conflicts with a transaction which has not ended')
+                    time.sleep(delay)
+                    delay = min(2 * delay, 0.1)
+        retrying_func.__doc__ = func.__doc__
+        return retrying_func
+
+    # Seconds a write waits for a conflicting transaction to end
+    _writeConflictTimeout = 10.0
+        
+    def __init__(self, database, sesid, tableid, lazyflush, layout, readonly=False, table=None, codec=None,
+                 blobstore=None, externalfiles=None):
+        """Initialize a new EseDBCursor on the specified database. The
+        cursor is on the default table unless the name of a table is
+        given. Values written by the cursor are compressed with the
+        codec, if there is one. The values of a deduplicated table are
+        kept in the blob store, which the cursor closes. Large values
+        are kept in the side files of the table, if it has them.
+        
+        """
+        self._database = database
+        self._table = table
+        self._recordCount = database.recordCount(table)
+        self._readonly = readonly
+        self._sesid = sesid
+        self._tableid = tableid
+        self._lazyflush = lazyflush
+        self._keycolumnid = layout.keycolumnid
+        self._valuecolumnid = layout.valuecolumnid
+        self._versioncolumnid = layout.versioncolumnid
+        self._generationcolumnid = layout.generationcolumnid
+        self._countercolumnid = layout.countercolumnid
+        self._expirycolumnid = layout.expirycolumnid
+        self._expiryindex = layout.expiryindex
+        self._sweeper = None
+        self._compressedcolumnid = layout.compressedcolumnid
+        self._smallvaluecolumnid = layout.smallvaluecolumnid
+        self._smallvaluesize = layout.smallvaluesize
+        # The columns a value can be in, in the order they are read
+        if None != self._smallvaluecolumnid:
+            self._valuecolumnids = (self._smallvaluecolumnid, self._valuecolumnid)
+        else:
+            self._valuecolumnids = (self._valuecolumnid,)
+        self._codec = codec
+        self._blobstore = blobstore
+        self._blobdigestcolumnid = layout.blobdigestcolumnid
+        self._blobidcolumnid = layout.blobidcolumnid
+        self._externalfiles = externalfiles
+        self._externalcolumnid = layout.externalcolumnid
+        if None != externalfiles:
+            _EseTransaction.addListener(sesid, externalfiles)
+        self._binaryvalues = layout.binaryvalues
+        self._keyformat = layout.keyformat
+        self._recordcolumns = layout.recordcolumns
+        self._indexes = database.indexes(table)
+        self._transaction = None
+        self._isopen = True
+        self._encoding = Encoding.Unicode
+        self._reads = 0
+        self._buffer = Array.CreateInstance(Byte, 0)
+        
+    def __del__(self):
+        """Called when garbage collection is removing the object. Close it."""
+        self.close()
+        
+    @cursorMustBeOpen
+    def __getitem__(self, key): 
+        """Returns the value of the record with the specified key.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['a'] = 'somedata'
+        >>> x['a']
+        'somedata'
+        >>> x.close()
+
+        If the key isn't present in the database then a KeyError
+        is raised.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['a']
+        Traceback (most recent call last):
+        ...
+        KeyError: key 'a' was not found
+        >>> x.close()
+        
+        """
+        with _EseTransaction(self._sesid):
+            self._seekForKey(key)
+            return self._retrieveCurrentRecordValue()
+
+    @cursorMustBeOpen
+    @retryOnWriteConflict
+    def __setitem__(self, key, value): 
+        """Sets the value of the record with the specified key.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['key'] = 'value'
+        >>> x.close()                
+        
+        """
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                self._insertOrUpdate(key, value)
+                trx.commit(self._lazyflush)
+        finally:
+            self._database.unlock(hash=hash(key))
+            
+    @cursorMustBeOpen
+    @retryOnWriteConflict
+    def __delitem__(self, key): 
+        """Deletes the record with the specified key.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['key'] = 'value'
+        >>> del x['key']
+        >>> x.close()
+
+        If the key isn't present in the database then a KeyError
+        is raised.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> del x['a']
+        Traceback (most recent call last):
+        ...
+        KeyError: key 'a' was not found
+        >>> x.close()
+        
+        """
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                self._seekForKey(key)
+                self._deleteCurrentRecord()
+                trx.commit(self._lazyflush)
+        finally:
+            self._database.unlock(hash=hash(key))
+
+    @cursorMustBeOpen
+    def __len__(self):
+        """Returns the number of records in the database.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> len(x)
+        0
+        >>> x['foo'] = 'bar'
+        >>> len(x)
+        1
+        >>> x.close()
+        
+        """
+        # If there is no cached length we have to scan the database
+        if None == self._recordCount.get():
+            self._database.getWriteLock()
+            if None == self._recordCount.get():
+                try:
+                    with _EseTransaction(self._sesid) as trx:
+                        if Api.TryMoveFirst(self._sesid, self._tableid):
+                            self._recordCount.set(Api.JetIndexRecordCount(self._sesid, self._tableid, 0))
+                        else:
+                            self._recordCount.set(0)
+                finally:
+                    self._database.unlock()
+        return self._recordCount.get()
+            
+    @cursorMustBeOpen
+    def __contains__(self, key):
+        """Returns True if the database contains the specified key,
+        otherwise returns False.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['foo'] = 'bar'
+        >>> 'foo' in x
+        True
+        >>> 'baz' in x
+        False
+        >>> 'baz' not in x
+        True
+        >>> x.close()
+            
+        """
+        return self.has_key(key)
+        
+    def close(self):
+        """Close the database. After being closed this object can no
+        longer be used
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x.close()                
+        >>> x.has_key('a')
+        Traceback (most recent call last):
+        ...
+        EseDBCursorClosedError: EseDBError(cursor is closed)
+        
+        """
+        if self._isopen:
+            if None != self._sweeper:
+                self._sweeper.stop()
+                self._sweeper = None
+            if None != self._transaction:
+                self._transaction.rollback()
+            if None != self._blobstore:
+                self._blobstore.close()
+            if None != self._externalfiles:
+                self._externalfiles.close()
+                _EseTransaction.removeListener(self._sesid)
+            Api.JetCloseTable(self._sesid, self._tableid)
+            self._tableid = None
+            Api.JetEndSession(self._sesid, EndSessionGrbit.None)
+            self._sesid = None
+            # Tell the database this cursor has been closed. The database is
+            # refcounted and closing the last cursor will close the database.
+            self._database.closeCursor(self)
+            self._isopen = False
+        
+    @cursorMustBeOpen
+    @retryOnWriteConflict
+    def clear(self):
+        """Removes all records from the database.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['key'] = 'value'
+        >>> x['anotherkey'] = 'anothervalue'
+        >>> x.clear()
+        >>> len(x)
+        0
+        >>> 'key' in x
+        False
+        >>> x.close()
+        
+        """   
+        # clear() could be optimized by just deleting and
+        # recreating the table
+        self._database.getWriteLock()
+        try:
+            n = 0
+            # Do deletes in batches to improve performance
+            with _EseTransaction(self._sesid) as trx:
+                Api.MoveBeforeFirst(self._sesid, self._tableid)
+                while Api.TryMoveNext(self._sesid, self._tableid):
+                    n += 1
+                    if 0 == (n%100):
+                        trx.commit(lazyflush=True)
+                        trx.begin()                    
+                    self._deleteCurrentRecord()
+        finally:
+            self._database.unlock()    
+        
+    @cursorMustBeOpen
+    def iterkeys(self):
+        """Returns each key contained in the database. These
+        are returned in sorted order.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> for k in x.iterkeys():
+        ...        print k    
+        ...        
+        a
+        b
+        c
+        >>> x.close()
+        
+        """
+        return self._iterateAndYield(self._retrieveCurrentRecordKey)
+            
+    @cursorMustBeOpen
+    def keys(self):
+        """Returns a list of all keys in the database. The
+        list is in sorted order.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> x.keys()
+        ['a', 'b', 'c']
+        >>> x.close()                
+    
+        """
+        return list(self.iterkeys())
+
+    @cursorMustBeOpen
+    def itervalues(self):
+        """Returns each value contained in the database. These
+        are returned in key order.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> for k in x.itervalues():
+        ...        print k    
+        ...        
+        256
+        128
+        64
+        >>> x.close()
+        
+        """
+        return self._iterateAndYield(self._retrieveCurrentRecordValue)
+        
+    @cursorMustBeOpen
+    def values(self):
+        """Returns a list of all values in the database. The
+        values are returned in key order.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> x.values()
+        ['256', '128', '64']
+        >>> x.close()    
+        
+        """
+        return list(self.itervalues())
+            
+    @cursorMustBeOpen
+    def iteritems(self, lazy=False):
+        """Return each key/value pair contained in the database. These
+        are returned in key order.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> for (k,v) in x.iteritems():
+        ...        print '%s => %s' % (k,v)    
+        ...        
+        a => 256
+        b => 128
+        c => 64
+        >>> x.close()
+
+        If lazy is true then the values are returned as LazyValue objects
+        and are only retrieved when their get() method is called.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> for (k,v) in x.iteritems(lazy=True):
+        ...        if k == 'b': print v.get()
+        ...        
+        128
+        >>> x.close()
+
+        """
+        if lazy:
+            return self._iterateAndYield(self._retrieveCurrentRecordLazily)
+        return self._iterateAndYield(self._retrieveCurrentRecord)
+            
+    __iter__ = iteritems
+
+    @cursorMustBeOpen
+    def scan(self, chunksize=256, prefetch=4):
+        """Return each key/value pair contained in the database, in key
+        order. This is intended for jobs that read the entire database.
+        The records are read by a background thread, on a separate cursor
+        opened for sequential access, in chunks of chunksize records. At
+        most prefetch chunks are read ahead of the caller.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> for (k,v) in x.scan():
+        ...        print '%s => %s' % (k,v)    
+        ...        
+        a => 256
+        b => 128
+        c => 64
+        >>> x.close()
+
+        Each chunk is read in its own transaction. The background cursor
+        is closed when the iteration finishes, when the close() method of
+        the returned iterator is called or when the iterator is garbage
+        collected.
+
+        """
+        if chunksize < 1 or prefetch < 1:
+            raise EseDBError('chunksize and prefetch must be positive')
+        cursor = self._database.openScanCursor(self._readonly, self._lazyflush, self._table)
+        return _EseScan(cursor, chunksize, prefetch)
+
+    @cursorMustBeOpen
+    def items(self, lazy=False):
+        """Returns a list of all items in the database as a list of
+        (key, value) tuples. The items are returned in key order. If lazy
+        is true then the values are LazyValue objects.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> x.items()
+        [('a', '256'), ('b', '128'), ('c', '64')]
+        >>> x.close()    
+                
+        """
+        return list(self.iteritems(lazy))
+            
+    @cursorMustBeOpen
+    def has_key(self, key):
+        """Returns True if the database contains the specified key,
+        otherwise returns False.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['key'] = 'value'
+        >>> x.has_key('key')
+        True
+        >>> x.has_key('not_a_key')
+        False
+        >>> x.close()
+
+        A key which can't be converted to the key type of the database
+        isn't in the database.
+            
+        """
+        try:
+            key = self._keyformat.normalize(key)
+        except EseDBError:
+            return False
+        with _EseTransaction(self._sesid):   
+            return self._has_key(key)
+                
+    @cursorMustBeOpen
+    def set_location(self, key):
+        """Sets the cursor to the record specified by the key and returns
+        a pair (key, value) for the record.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['key'] = 'value'
+        >>> x.set_location('key')
+        ('key', 'value')
+        >>> x.close()        
+        
+        If the key doesn't exist in the database then the location is set
+        to the next highest key and that record is returned.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['b'] = 'value'
+        >>> x.set_location('a')
+        ('b', 'value')
+        >>> x.close()                
+        
+        If no matching key is found then KeyError is raised.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['a'] = 'value'
+        >>> x.set_location('b')
+        Traceback (most recent call last):
+        ...
+        KeyError: no key matching 'b' was found
+        >>> x.close()                
+        
+        """
+        with _EseTransaction(self._sesid):        
+            self._makeKey(key)
+            if not self._skipExpired(self._tableid, Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekGE), Api.TryMoveNext):
+                raise KeyError('no key matching \'%s\' was found' % (key,))
+            return self._retrieveCurrentRecord()
+
+    @cursorMustBeOpen
+    def first(self):
+        """Sets the cursor to the first record in the database and returns
+        a (key, value) for the record.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> x.first()
+        ('a', '256')
+        >>> x.close()            
+        
+        If the database is empty a KeyError is raised.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x.first()
+        Traceback (most recent call last):
+        ...
+        KeyError: database is empty
+        >>> x.close()            
+        
+        """
+        with _EseTransaction(self._sesid):        
+            if not self._skipExpired(self._tableid, Api.TryMoveFirst(self._sesid, self._tableid), Api.TryMoveNext):
+                raise KeyError('database is empty')    
+            return self._retrieveCurrentRecord()
+    
+    @cursorMustBeOpen
+    def last(self):
+        """Sets the cursor to the last record in the database and returns
+        a (key, value) for the record.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x.last()
+        ('c', '64')
+        >>> x.close()            
+
+        If the database is empty a KeyError is raised.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x.last()
+        Traceback (most recent call last):
+        ...
+        KeyError: database is empty
+        >>> x.close()            
+        
+        """
+        with _EseTransaction(self._sesid):        
+            if not self._skipExpired(self._tableid, Api.TryMoveLast(self._sesid, self._tableid), Api.TryMovePrevious):
+                raise KeyError('database is empty')        
+            return self._retrieveCurrentRecord()
+
+    @cursorMustBeOpen
+    def next(self):
+        """Sets the cursor to the next record in the database and returns
+        a (key, value) for the record.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> x.first()
+        ('a', '256')
+        >>> x.next()
+        ('b', '128')
+        >>> x.close()            
+
+        A KeyError is raised when the end of the table is reached or if 
+        the table is empty.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x.next()
+        Traceback (most recent call last):
+        ...
+        KeyError: end of database
+        >>> x.close()                    
+    
+        """
+        with _EseTransaction(self._sesid):        
+            if not self._skipExpired(self._tableid, Api.TryMoveNext(self._sesid, self._tableid), Api.TryMoveNext):
+                raise KeyError('end of database')        
+            return self._retrieveCurrentRecord()
+        
+    @cursorMustBeOpen
+    def previous(self):
+        """Sets the cursor to the previous item in the database and returns
+        a (key, value) for the record.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['c'] = 64
+        >>> x['b'] = 128
+        >>> x.last()
+        ('c', '64')
+        >>> x.previous()
+        ('b', '128')
+        >>> x.close()            
+
+        A KeyError is raised when the end of the table is reached or if 
+        the table is empty.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x.previous()
+        Traceback (most recent call last):
+        ...
+        KeyError: end of database
+        >>> x.close()                    
+        
+        """
+        with _EseTransaction(self._sesid):        
+            if not self._skipExpired(self._tableid, Api.TryMovePrevious(self._sesid, self._tableid), Api.TryMovePrevious):
+                raise KeyError('end of database')        
+            return self._retrieveCurrentRecord()        
+
+    @cursorMustBeOpen
+    def firstkey(self):
+        """Sets the cursor to the first record in the database and returns
+        the key of the record.
+        
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> x.firstkey()
+        'a'
+        >>> x.close()            
+        
+        If the database is empty None is returned.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x.firstkey()
+        >>> x.close()            
+        
+        """
+        with _EseTransaction(self._sesid):        
+            if not self._skipExpired(self._tableid, Api.TryMoveFirst(self._sesid, self._tableid), Api.TryMoveNext):
+                return None    
+            return self._retrieveCurrentRecordKey()
+        
+    @cursorMustBeOpen
+    def nextkey(self, key):
+        """Returns the key that follows key in the traversal.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['b'] = 128
+        >>> x['a'] = 256
+        >>> x.nextkey('a')
+        'b'
+        >>> x.close()            
 
-        If the key isn't present in the database then a KeyError
-        is raised.
+        If there are no matching records None is returned.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['a']
-        Traceback (most recent call last):
-        ...
-        KeyError: key 'a' was not found
-        >>> x.close()
+        >>> x.nextkey('x')
+        >>> x.close()            
         
-        """
-        with _EseTransaction(self._sesid):
-            self._seekForKey(key)
-            return self._retrieveCurrentRecordValue()
+        The following code prints every key in the database, without having
+        to create a list in memory that contains them all:
 
+        >>> db = open('wdbtest.db', 'n')
+        >>> for i in range(10): db['%d'%i] = '%d'% (i*i)
+        ...
+        >>> k = db.firstkey()
+        >>> while k != None:
+        ...     print k
+        ...     k = db.nextkey(k)
+        0
+        1
+        2
+        3
+        4
+        5
+        6
+        7
+        8
+        9
+        >>> db.close()
+    
+        """    
+        with _EseTransaction(self._sesid): 
+            if not self._trySeekForKey(key):
+                return None
+            if not self._skipExpired(self._tableid, Api.TryMoveNext(self._sesid, self._tableid), Api.TryMoveNext):
+                return None
+            return self._retrieveCurrentRecordKey()
+            
     @cursorMustBeOpen
-    def __setitem__(self, key, value): 
-        """Sets the value of the record with the specified key.
+    @retryOnWriteConflict
+    def pop(self, key, default=_unspecified):
+        """If key is in the dictionary, remove it and return its value, else
+        return default. 
         
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['key'] = 'value'
-        >>> x.close()                
+        >>> x['a'] = 64
+        >>> x.pop('a', 'X')
+        '64'
+        >>> x.pop('b', 'X')
+        'X'
+        >>> x.close()              
+        
+        If default is not given and key is not in the dictionary, a
+        KeyError is raised.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['a'] = 64
+        >>> x.pop('b')
+        Traceback (most recent call last):
+        ...
+        KeyError: no key matching 'b' was found
+        >>> x.close()
         
         """
-        key = str(key)
-        self._database.getWriteLock(hash=key.GetHashCode())
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
         try:
             with _EseTransaction(self._sesid) as trx:
-                self._insertOrUpdate(key, value)
-                trx.commit(self._lazyflush)
+                if self._trySeekForKey(key):
+                    value = self._retrieveCurrentRecordValue()
+                    self._deleteCurrentRecord()
+                    trx.commit(self._lazyflush)
+                    return value                    
+                elif default is _unspecified:
+                    raise KeyError('no key matching \'%s\' was found' % (key,))
+                else:
+                    return default            
         finally:
-            self._database.unlock(hash=key.GetHashCode())
-            
+            self._database.unlock(hash=hash(key))        
+
     @cursorMustBeOpen
-    def __delitem__(self, key): 
-        """Deletes the record with the specified key.
+    @retryOnWriteConflict
+    def popitem(self):
+        """Remove and return an arbitrary (key, value) pair from the dictionary.
+        popitem() is useful to destructively iterate over a dictionary, as often
+        used in set algorithms.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['key'] = 'value'
-        >>> del x['key']
-        >>> x.close()
+        >>> x['a'] = 64
+        >>> x.popitem()
+        ('a', '64')
 
-        If the key isn't present in the database then a KeyError
-        is raised.
-        
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> del x['a']
+        If the dictionary is empty, calling popitem() raises a KeyError.
+
+        >>> x.popitem()
         Traceback (most recent call last):
         ...
-        KeyError: key 'a' was not found
-        >>> x.close()
+        KeyError: database is empty
+        >>> x.close()            
         
         """
-        key = str(key)
-        self._database.getWriteLock(hash=key.GetHashCode())
+        self._database.getWriteLock()
         try:
             with _EseTransaction(self._sesid) as trx:
-                self._seekForKey(key)
+                if not self._skipExpired(self._tableid, Api.TryMoveLast(self._sesid, self._tableid), Api.TryMovePrevious):
+                    raise KeyError('database is empty')        
+                value = self._retrieveCurrentRecord()            
                 self._deleteCurrentRecord()
                 trx.commit(self._lazyflush)
+                return value
         finally:
-            self._database.unlock(hash=key.GetHashCode())
-
+            self._database.unlock()
+            
     @cursorMustBeOpen
-    def __len__(self):
-        """Returns the number of records in the database.
-        
+    @retryOnWriteConflict
+    def setdefault(self, key, default=None):
+        """If key is in the dictionary, return its value. If not, insert key with
+        a value of default and return default. Default defaults to None.
+
         >>> x = open('wdbtest.db', flag='nf')
-        >>> len(x)
-        0
-        >>> x['foo'] = 'bar'
-        >>> len(x)
-        1
-        >>> x.close()
-        
+        >>> x['a'] = 64
+        >>> x.setdefault('a')
+        '64'
+        >>> x.setdefault('b', 'X')
+        'X'
+        >>> x.setdefault('c')
+        >>> x.items()
+        [('a', '64'), ('b', 'X'), ('c', None)]
+        >>> x.close()            
+
         """
-        # If there is no cached length we have to scan the database
-        if None == self._database.cachedRecordCount.get():
-            self._database.getWriteLock()
-            if None == self._database.cachedRecordCount.get():
-                try:
-                    with _EseTransaction(self._sesid) as trx:
-                        if Api.TryMoveFirst(self._sesid, self._tableid):
-                            self._database.cachedRecordCount.set(Api.JetIndexRecordCount(self._sesid, self._tableid, 0))
-                        else:
-                            self._database.cachedRecordCount.set(0)
-                finally:
-                    self._database.unlock()
-        return self._database.cachedRecordCount.get()
-            
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                if self._trySeekForKey(key):
+                    return self._retrieveCurrentRecordValue()
+                else:
+                    self._insertItem(key, default)
+                    trx.commit(self._lazyflush)
+                    return default
+        finally:
+            self._database.unlock(hash=hash(key))        
+
     @cursorMustBeOpen
-    def __contains__(self, key):
-        """Returns True if the database contains the specified key,
-        otherwise returns False.
+    @retryOnWriteConflict
+    def update(self, other=None, **keywords):
+        """Updates the dictionary with the key/value pairs from other,
+        overwriting existing keys. update() accepts either a dictionary,
+        and iterable of key/value pairs or as a set of keyword arguments
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['foo'] = 'bar'
-        >>> 'foo' in x
-        True
-        >>> 'baz' in x
-        False
-        >>> 'baz' not in x
-        True
+        >>> x.update(foo=1, bar=2)
+        >>> x.items()
+        [('bar', '2'), ('foo', '1')]
+        >>> d = { 'baz': '3' }
+        >>> x.update(d)
+        >>> x.items()
+        [('bar', '2'), ('baz', '3'), ('foo', '1')]
+        >>> i = [ ('qux', '4') ]
+        >>> x.update(i)
+        >>> x.items()
+        [('bar', '2'), ('baz', '3'), ('foo', '1'), ('qux', '4')]
         >>> x.close()
             
         """
-        return self.has_key(key)
-        
-    def close(self):
-        """Close the database. After being closed this object can no
-        longer be used
-
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x.close()                
-        >>> x.has_key('a')
-        Traceback (most recent call last):
-        ...
-        EseDBCursorClosedError: EseDBError(cursor is closed)
-        
-        """
-        if self._isopen:
-            Api.JetCloseTable(self._sesid, self._tableid)
-            self._tableid = None
-            Api.JetEndSession(self._sesid, EndSessionGrbit.None)
-            self._sesid = None
-            # Tell the database this cursor has been closed. The database is
-            # refcounted and closing the last cursor will close the database.
-            self._database.closeCursor(self)
-            self._isopen = False
-        
+        # Lock all keys and use big transactions
+        self._database.getWriteLock()
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                if isinstance(other, dict):
+                    self._updateItems(other.iteritems(), trx)
+                elif other:
+                    self._updateItems(other, trx)
+                if keywords:
+                    self._updateItems(keywords.items(), trx)
+                trx.commit(self._lazyflush)
+        finally:
+            self._database.unlock()     
+            
     @cursorMustBeOpen
-    def clear(self):
-        """Removes all records from the database.
+    @retryOnWriteConflict
+    def set(self, key, value, ttl=None):
+        """Sets the value of the record with the specified key. If ttl is
+        given the record expires after that many seconds, after which it
+        is treated as absent. The database must have been created with
+        expiry.
 
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['key'] = 'value'
-        >>> x['anotherkey'] = 'anothervalue'
-        >>> x.clear()
-        >>> len(x)
-        0
-        >>> 'key' in x
+        >>> x = open('wdbtest.db', flag='nf', expiry=True)
+        >>> x.set('a', 'somedata', ttl=3600)
+        >>> x['a']
+        'somedata'
+        >>> x.set('b', 'otherdata', ttl=0.001)
+        >>> import time; time.sleep(0.01)
+        >>> x.has_key('b')
         False
         >>> x.close()
-        
-        """   
-        # clear() could be optimized by just deleting and
-        # recreating the table
-        self._database.getWriteLock()
+
+        Setting a value without a ttl, with set() or any other method,
+        makes the record permanent again. Expired records are skipped by
+        reads and replaced by writes, but they stay in the table, and are
+        counted by len(), until sweep_expired() deletes them.
+
+        """
+        expires = None
+        if None != ttl:
+            self._checkHasExpiryColumn()
+            if not isinstance(ttl, (int, long, float)) or ttl <= 0:
+                raise EseDBError('ttl must be a positive number of seconds')
+            expires = DateTime.UtcNow.AddSeconds(ttl)
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
         try:
-            n = 0
-            # Do deletes in batches to improve performance
             with _EseTransaction(self._sesid) as trx:
-                Api.MoveBeforeFirst(self._sesid, self._tableid)
-                while Api.TryMoveNext(self._sesid, self._tableid):
-                    n += 1
-                    if 0 == (n%100):
-                        trx.commit(lazyflush=True)
-                        trx.begin()                    
-                    self._deleteCurrentRecord()
+                self._insertOrUpdate(key, value, expires)
+                trx.commit(self._lazyflush)
         finally:
-            self._database.unlock()    
+            self._database.unlock(hash=hash(key))
+
+    @cursorMustBeOpen
+    def get_into(self, key, buffer):
+        """Retrieves the raw bytes of the value of the record with the
+        specified key into buffer and returns the size of the value, or
+        None if the value is None. The buffer can be a System.Array[Byte]
+        or a bytearray, otherwise EseDBError is raised.
         
+        A System.Array[Byte] is filled directly, without allocating any
+        memory. It can't be grown, so if the returned size is larger than
+        the array the value has been truncated and the caller should retry
+        with a bigger array. A bytearray is grown if it is too small to
+        hold the value.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['a'] = 'somedata'
+        >>> b = bytearray()
+        >>> x.get_into('a', b)
+        16
+        >>> str(b).decode('utf-16')
+        u'somedata'
+        >>> x.close()
+
+        If the key isn't present in the database then a KeyError
+        is raised.
+
+        """
+        self._checkHasValueColumn()
+        self._checkBuffer(buffer)
+        with _EseTransaction(self._sesid):
+            self._seekForKey(key)
+            return self._retrieveCurrentRecordValueInto(buffer)
+
     @cursorMustBeOpen
-    def iterkeys(self):
-        """Returns each key contained in the database. These
-        are returned in sorted order.
+    def iter_into(self, buffer):
+        """Return each key contained in the database, in key order, as a
+        tuple of (key, size). The value of the record is retrieved into
+        buffer, which is reused for every record, so no memory is allocated
+        for the values. See get_into() for the buffer types that can be used.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['c'] = 64
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> for k in x.iterkeys():
-        ...        print k    
-        ...        
-        a
-        b
-        c
+        >>> x['b'] = 'bb'
+        >>> x['a'] = 'a'
+        >>> b = bytearray()
+        >>> for (k, size) in x.iter_into(b):
+        ...        print k, size
+        ...
+        a 2
+        b 4
         >>> x.close()
-        
+
         """
-        return self._iterateAndYield(self._retrieveCurrentRecordKey)
-            
+        self._checkHasValueColumn()
+        self._checkBuffer(buffer)
+        return self._iterateAndYield(
+            lambda: (self._retrieveCurrentRecordKey(), self._retrieveCurrentRecordValueInto(buffer)))
+
     @cursorMustBeOpen
-    def keys(self):
-        """Returns a list of all keys in the database. The
-        list is in sorted order.
+    def get_with_version(self, key):
+        """Returns a tuple of (value, version) for the record with the
+        specified key. The version changes every time the record is
+        updated, and a key which is deleted and inserted again never gets
+        back a version it had before. Versions should only be compared
+        for equality.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['c'] = 64
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> x.keys()
-        ['a', 'b', 'c']
-        >>> x.close()                
-    
+        >>> x['a'] = 'somedata'
+        >>> (v, version) = x.get_with_version('a')
+        >>> v
+        'somedata'
+        >>> x['a'] = 'otherdata'
+        >>> x.get_with_version('a')[1] == version
+        False
+        >>> x.close()
+
+        If the key isn't present in the database then a KeyError
+        is raised.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x.get_with_version('a')
+        Traceback (most recent call last):
+        ...
+        KeyError: key 'a' was not found
+        >>> x.close()
+
         """
-        return list(self.iterkeys())
+        self._checkHasVersionColumn()
+        with _EseTransaction(self._sesid):
+            self._seekForKey(key)
+            return (self._retrieveCurrentRecordValue(), self._retrieveCurrentRecordVersion())
 
     @cursorMustBeOpen
-    def itervalues(self):
-        """Returns each value contained in the database. These
-        are returned in key order.
+    def get_if_changed(self, key, version):
+        """Returns a tuple of (value, version) for the record with the
+        specified key if the version of the record is different from
+        the given version, otherwise returns None. This lets a caller that
+        has cached a value revalidate it without retrieving the value.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['c'] = 64
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> for k in x.itervalues():
-        ...        print k    
-        ...        
-        256
-        128
-        64
+        >>> x['a'] = 'somedata'
+        >>> (v, version) = x.get_with_version('a')
+        >>> x.get_if_changed('a', version)
+        >>> x['a'] = 'otherdata'
+        >>> x.get_if_changed('a', version)[0]
+        'otherdata'
         >>> x.close()
-        
+
+        If the key isn't present in the database then a KeyError
+        is raised.
+
         """
-        return self._iterateAndYield(self._retrieveCurrentRecordValue)
-        
+        self._checkHasVersionColumn()
+        with _EseTransaction(self._sesid):
+            self._seekForKey(key)
+            currentversion = self._retrieveCurrentRecordVersion()
+            if currentversion == version:
+                return None
+            return (self._retrieveCurrentRecordValue(), currentversion)
+
     @cursorMustBeOpen
-    def values(self):
-        """Returns a list of all values in the database. The
-        values are returned in key order.
+    @retryOnWriteConflict
+    def set_if_version(self, key, value, version):
+        """Sets the value of the record with the specified key, but only
+        if the version of the record matches the given version. Returns
+        True if the record was updated and False if the record has been
+        changed since the version was retrieved.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['c'] = 64
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> x.values()
-        ['256', '128', '64']
-        >>> x.close()    
-        
+        >>> x['a'] = 'somedata'
+        >>> (v, version) = x.get_with_version('a')
+        >>> x.set_if_version('a', 'newdata', version)
+        True
+        >>> x.set_if_version('a', 'otherdata', version)
+        False
+        >>> x['a']
+        'newdata'
+        >>> x.close()
+
+        If the key isn't present in the database then a KeyError
+        is raised.
+
         """
-        return list(self.itervalues())
-            
+        self._checkHasVersionColumn()
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                self._seekForKey(key)
+                if self._retrieveCurrentRecordVersion() != version:
+                    return False
+                self._updateItem(key, value)
+                trx.commit(self._lazyflush)
+                return True
+        finally:
+            self._database.unlock(hash=hash(key))
+
     @cursorMustBeOpen
-    def iteritems(self):
-        """Return each key/value pair contained in the database. These
-        are returned in key order.
-        
+    @retryOnWriteConflict
+    def cas(self, key, expected, new, by_version=False):
+        """Sets the value of the record with the specified key to new,
+        but only if its current value is expected. Returns True if the
+        record was updated and False if it has a different value or the
+        key isn't present. The comparison and the update are done in one
+        transaction.
+
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['c'] = 64
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> for (k,v) in x.iteritems():
-        ...        print '%s => %s' % (k,v)    
-        ...        
-        a => 256
-        b => 128
-        c => 64
+        >>> x['a'] = 1
+        >>> x.cas('a', 1, 2)
+        True
+        >>> x.cas('a', 1, 3)
+        False
+        >>> x['a']
+        '2'
+        >>> x.close()
+
+        Values are compared as they are stored, so a value of 1 matches a
+        record containing '1'. If by_version is True then expected is a
+        version returned by get_with_version() and the version of the
+        record is compared instead, which avoids retrieving the value.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> x['a'] = 'somedata'
+        >>> (v, version) = x.get_with_version('a')
+        >>> x.cas('a', version, 'newdata', by_version=True)
+        True
+        >>> x.cas('a', version, 'otherdata', by_version=True)
+        False
         >>> x.close()
 
         """
-        return self._iterateAndYield(self._retrieveCurrentRecord)
-            
-    __iter__ = iteritems
+        if by_version:
+            self._checkHasVersionColumn()
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                if not self._trySeekForKey(key) or not self._currentRecordMatches(expected, by_version):
+                    return False
+                self._updateItem(key, new)
+                trx.commit(self._lazyflush)
+                return True
+        finally:
+            self._database.unlock(hash=hash(key))
 
     @cursorMustBeOpen
-    def items(self):
-        """Returns a list of all items in the database as a list of
-        (key, value) tuples. The items are returned in key order.
+    @retryOnWriteConflict
+    def put_if_absent(self, key, value):
+        """Inserts the key with the given value if it isn't present.
+        Returns True if the record was inserted and False if the key was
+        already present, in which case the record isn't changed.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['c'] = 64
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> x.items()
-        [('a', '256'), ('b', '128'), ('c', '64')]
-        >>> x.close()    
-                
+        >>> x.put_if_absent('a', 'first')
+        True
+        >>> x.put_if_absent('a', 'second')
+        False
+        >>> x['a']
+        'first'
+        >>> x.close()
+
         """
-        return list(self.iteritems())
-            
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                if self._trySeekForKey(key):
+                    return False
+                self._insertItem(key, value)
+                trx.commit(self._lazyflush)
+                return True
+        finally:
+            self._database.unlock(hash=hash(key))
+
     @cursorMustBeOpen
-    def has_key(self, key):
-        """Returns True if the database contains the specified key,
-        otherwise returns False.
+    @retryOnWriteConflict
+    def delete_if(self, key, expected, by_version=False):
+        """Deletes the record with the specified key, but only if its
+        current value is expected. Returns True if the record was deleted
+        and False if it has a different value or the key isn't present.
+        As with cas(), by_version compares the version of the record
+        instead of its value.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['key'] = 'value'
-        >>> x.has_key('key')
+        >>> x['a'] = 'somedata'
+        >>> x.delete_if('a', 'otherdata')
+        False
+        >>> x.delete_if('a', 'somedata')
         True
-        >>> x.has_key('not_a_key')
+        >>> x.has_key('a')
         False
         >>> x.close()
-            
+
         """
-        with _EseTransaction(self._sesid):   
-            return self._has_key(key)
-                
+        if by_version:
+            self._checkHasVersionColumn()
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                if not self._trySeekForKey(key) or not self._currentRecordMatches(expected, by_version):
+                    return False
+                self._deleteCurrentRecord()
+                trx.commit(self._lazyflush)
+                return True
+        finally:
+            self._database.unlock(hash=hash(key))
+
     @cursorMustBeOpen
-    def set_location(self, key):
-        """Sets the cursor to the record specified by the key and returns
-        a pair (key, value) for the record.
-        
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['key'] = 'value'
-        >>> x.set_location('key')
-        ('key', 'value')
-        >>> x.close()        
-        
-        If the key doesn't exist in the database then the location is set
-        to the next highest key and that record is returned.
-        
+    def transform(self, key, fn, default=_unspecified):
+        """Replaces the value of the record with the specified key with
+        fn(value) and returns the new value. If the key isn't present
+        then fn is called with default and the result is inserted.
+
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['b'] = 'value'
-        >>> x.set_location('a')
-        ('b', 'value')
-        >>> x.close()                
-        
-        If no matching key is found then KeyError is raised.
+        >>> x['a'] = 'abc'
+        >>> x.transform('a', lambda v: v.upper())
+        'ABC'
+        >>> x.transform('b', lambda v: v + 'x', default='')
+        'x'
+        >>> x.items()
+        [('a', 'ABC'), ('b', 'x')]
+        >>> x.close()
+
+        If default is not given and key is not in the dictionary, a
+        KeyError is raised.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['a'] = 'value'
-        >>> x.set_location('b')
+        >>> x.transform('a', lambda v: v)
         Traceback (most recent call last):
         ...
-        KeyError: no key matching 'b' was found
-        >>> x.close()                
-        
+        KeyError: no key matching 'a' was found
+        >>> x.close()
+
+        The value is read without taking the write lock, so fn can be
+        slow without blocking other writers. The write lock is only held
+        while the result is written. If the record was changed in the
+        meantime then fn is called again with the new value, so it should
+        not have side effects. Inside a transaction() the value read is the
+        one seen by the transaction, and if another cursor has changed it
+        since the transaction started the write conflict is raised instead.
+
         """
-        with _EseTransaction(self._sesid):        
-            self._makeKey(key)
-            if not Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekGE):
-                raise KeyError('no key matching \'%s\' was found' % key)
-            return self._retrieveCurrentRecord()
+        key = self._keyformat.normalize(key)
+        while True:
+            with _EseTransaction(self._sesid):
+                found = self._trySeekForKey(key)
+                if found:
+                    value = self._retrieveCurrentRecordValue()
+                    stamp = self._retrieveCurrentRecordStamp()
+                elif default is _unspecified:
+                    raise KeyError('no key matching \'%s\' was found' % (key,))
+                else:
+                    value = default
+            newvalue = fn(value)
+            self._database.getWriteLock(hash=hash(key))
+            try:
+                with _EseTransaction(self._sesid) as trx:
+                    if found != self._trySeekForKey(key):
+                        continue
+                    if found:
+                        if stamp != self._retrieveCurrentRecordStamp():
+                            continue
+                        self._updateItem(key, newvalue)
+                    else:
+                        self._insertItem(key, newvalue)
+                    trx.commit(self._lazyflush)
+                    return self._storedValue(newvalue)
+            except EsentWriteConflictException:
+                # Another session, possibly in a different process, has
+                # updated the record. Inside a transaction() the retry would
+                # read the same snapshot and conflict again, so the whole
+                # transaction has to be retried by the caller.
+                if None != self._transaction:
+                    raise
+                continue
+            finally:
+                self._database.unlock(hash=hash(key))
 
     @cursorMustBeOpen
-    def first(self):
-        """Sets the cursor to the first record in the database and returns
-        a (key, value) for the record.
-        
+    @retryOnWriteConflict
+    def incr(self, key, delta=1):
+        """Adds delta to the counter of the record with the specified key
+        and returns the new count. The counter is a 32-bit integer kept
+        alongside the value of the record. If the key isn't present a
+        record with a count of delta is inserted. Its value is None, or a
+        record with every column None for a database created with columns,
+        and it isn't added to the secondary indexes.
+
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> x.first()
-        ('a', '256')
-        >>> x.close()            
-        
-        If the database is empty a KeyError is raised.
+        >>> x.incr('hits')
+        1
+        >>> x.incr('hits', 10)
+        11
+        >>> x.counter('hits')
+        11
+        >>> x.close()
+
+        The count is changed with an escrow update, which esent merges with
+        the changes made by other cursors instead of treating them as
+        conflicting writes. Incrementing an existing counter doesn't take
+        the write lock and reads nothing but the record's count.
+
+        delta has to be a 32-bit integer. If the new count doesn't fit in a
+        32-bit integer EseDBError is raised and the counter isn't changed.
+
+        """
+        self._checkHasCounterColumn()
+        if not isinstance(delta, (int, long)) or not Int32.MinValue <= delta <= Int32.MaxValue:
+            raise EseDBError('delta must be a 32-bit integer')
+        key = self._keyformat.normalize(key)
+        with _EseTransaction(self._sesid) as trx:
+            if self._trySeekForKey(key):
+                count = self._escrowCounter(delta)
+                trx.commit(self._lazyflush)
+                return count
+        # The record has to be inserted. This is done under the write lock
+        # and in a new transaction, which sees a record inserted by
+        # another cursor in the meantime.
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                if not self._trySeekForKey(key):
+                    self._insertItem(key, self._emptyValue(), extract=False)
+                    self._seekForKey(key)
+                count = self._escrowCounter(delta)
+                trx.commit(self._lazyflush)
+                return count
+        finally:
+            self._database.unlock(hash=hash(key))
+
+    @cursorMustBeOpen
+    def counter(self, key):
+        """Returns the counter of the record with the specified key, which
+        is 0 if the key isn't present or incr() has never been called for
+        it.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x.first()
-        Traceback (most recent call last):
-        ...
-        KeyError: database is empty
-        >>> x.close()            
-        
+        >>> x.counter('a')
+        0
+        >>> x.incr('a', 5)
+        5
+        >>> x.counter('a')
+        5
+        >>> x.close()
+
+        """
+        self._checkHasCounterColumn()
+        key = self._keyformat.normalize(key)
+        with _EseTransaction(self._sesid):
+            if not self._trySeekForKey(key):
+                return 0
+            return Api.RetrieveColumnAsInt32(self._sesid, self._tableid, self._countercolumnid)
+
+    @cursorMustBeOpen
+    def get_columns(self, key, *names):
+        """Returns a tuple of the values of the named columns of the record
+        with the specified key. Only the named columns are retrieved. If
+        no names are given all the columns are returned, in the order they
+        were declared. The database must have been created with columns.
+
+        >>> x = open('wdbtest.db', flag='nf', columns=[('name', str), ('count', int)])
+        >>> x['a'] = {'name': 'alpha', 'count': 1}
+        >>> x.get_columns('a', 'count')
+        (1,)
+        >>> x.get_columns('a')
+        ('alpha', 1)
+        >>> x.close()
+
+        If the key isn't present in the database then a KeyError
+        is raised.
+
         """
-        with _EseTransaction(self._sesid):        
-            if not Api.TryMoveFirst(self._sesid, self._tableid):
-                raise KeyError('database is empty')    
-            return self._retrieveCurrentRecord()
-    
+        self._checkIsRecordTable()
+        if names:
+            columns = [self._getRecordColumn(name) for name in names]
+        else:
+            columns = self._recordcolumns
+        with _EseTransaction(self._sesid):
+            self._seekForKey(key)
+            return tuple(c.retrieve(self._sesid, self._tableid) for c in columns)
+
     @cursorMustBeOpen
-    def last(self):
-        """Sets the cursor to the last record in the database and returns
-        a (key, value) for the record.
+    @retryOnWriteConflict
+    def set_columns(self, key, columns):
+        """Updates the given columns of the record with the specified key
+        in place. Columns is a dictionary of column names to values. The
+        other columns of the record are not changed, or rewritten, so
+        updating a small column of a large record is cheap. The database
+        must have been created with columns.
 
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['c'] = 64
-        >>> x['b'] = 128
-        >>> x.last()
-        ('c', '64')
-        >>> x.close()            
+        >>> x = open('wdbtest.db', flag='nf', columns=[('name', str), ('count', int)])
+        >>> x['a'] = ('alpha', 1)
+        >>> x.set_columns('a', {'count': 2})
+        >>> x['a'] == {'name': 'alpha', 'count': 2}
+        True
+        >>> x.close()
 
-        If the database is empty a KeyError is raised.
+        If the key isn't present in the database then a KeyError
+        is raised.
 
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x.last()
-        Traceback (most recent call last):
-        ...
-        KeyError: database is empty
-        >>> x.close()            
-        
         """
-        with _EseTransaction(self._sesid):        
-            if not Api.TryMoveLast(self._sesid, self._tableid):
-                raise KeyError('database is empty')        
-            return self._retrieveCurrentRecord()
+        self._checkIsRecordTable()
+        updates = [(self._getRecordColumn(name), v) for (name, v) in columns.iteritems()]
+        key = self._keyformat.normalize(key)
+        self._database.getWriteLock(hash=hash(key))
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                self._seekForKey(key)
+                if self._indexes:
+                    # The extractors need the whole record
+                    record = self._retrieveCurrentRecordValue()
+                    record.update(columns)
+                with _EseUpdate(self._sesid, self._tableid, JET_prep.Replace) as u:
+                    self._setGenerationColumn()
+                    for (column, v) in updates:
+                        column.set(self._sesid, self._tableid, v)
+                    if self._indexes:
+                        self._setIndexColumns(record)
+                    u.update()
+                trx.commit(self._lazyflush)
+        finally:
+            self._database.unlock(hash=hash(key))
 
     @cursorMustBeOpen
-    def next(self):
-        """Sets the cursor to the next record in the database and returns
-        a (key, value) for the record.
+    def create_index(self, name, extractor, index_type=str):
+        """Creates a secondary index over the values of the records.
+        extractor is called with the value of each record, as it is
+        retrieved from the database, and returns the value to index, which
+        is converted to index_type. The types are the same as for the columns
+        option of open(). Records for which the extractor returns None
+        are not indexed. The index is maintained every time a record is
+        written and is updated in the same transaction as the record.
 
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> x.first()
-        ('a', '256')
-        >>> x.next()
-        ('b', '128')
-        >>> x.close()            
+        If the database already has records the index is built from them,
+        with one sort, before this method returns.
+
+        Extractors can't be saved in the database. When a database with
+        indexes is opened for writing the extractors have to be given with
+        the indexes option of open() or table(). Calling create_index()
+        again with the same name and type replaces the extractor without
+        rebuilding the index.
+
+        Building the index doesn't change the versions of the records.
 
-        A KeyError is raised when the end of the table is reached or if 
-        the table is empty.
-        
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x.next()
-        Traceback (most recent call last):
-        ...
-        KeyError: end of database
-        >>> x.close()                    
-    
+        >>> x['a'] = 'apple'
+        >>> x['b'] = 'banana'
+        >>> x['c'] = 'avocado'
+        >>> x.create_index('initial', lambda v: v[0])
+        >>> x.lookup('initial', 'a')
+        ['a', 'c']
+        >>> x.close()
+
         """
-        with _EseTransaction(self._sesid):        
-            if not Api.TryMoveNext(self._sesid, self._tableid):
-                raise KeyError('end of database')        
-            return self._retrieveCurrentRecord()
-        
+        column = _IndexColumn.fromDeclaration(name, index_type, extractor)
+        self._database.getWriteLock()
+        try:
+            if self._indexes.has_key(name):
+                existing = self._indexes[name]
+                if existing.coltyp != column.coltyp:
+                    raise EseDBError('index %s already exists with a different type' % name)
+                existing.extractor = extractor
+                return
+            self._database.addIndex(self._sesid, self._tableid, column, lambda: self._populateIndexColumn(column))
+            self._indexes[name] = column
+        finally:
+            self._database.unlock()
+
     @cursorMustBeOpen
-    def previous(self):
-        """Sets the cursor to the previous item in the database and returns
-        a (key, value) for the record.
-        
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['c'] = 64
-        >>> x['b'] = 128
-        >>> x.last()
-        ('c', '64')
-        >>> x.previous()
-        ('b', '128')
-        >>> x.close()            
+    def lookup(self, name, value):
+        """Returns a list of the keys of the records whose value in the
+        named secondary index is equal to value, in key order.
 
-        A KeyError is raised when the end of the table is reached or if 
-        the table is empty.
-        
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x.previous()
-        Traceback (most recent call last):
-        ...
-        KeyError: end of database
-        >>> x.close()                    
-        
+        >>> x.create_index('length', len, int)
+        >>> x['a'] = 'aa'
+        >>> x['b'] = 'bbb'
+        >>> x['c'] = 'cc'
+        >>> x.lookup('length', 2)
+        ['a', 'c']
+        >>> x.close()
+
         """
-        with _EseTransaction(self._sesid):        
-            if not Api.TryMovePrevious(self._sesid, self._tableid):
-                raise KeyError('end of database')        
-            return self._retrieveCurrentRecord()        
+        column = self._getIndexColumn(name)
+        return self._retrieveIndexKeys(column, value, value)
 
     @cursorMustBeOpen
-    def firstkey(self):
-        """Sets the cursor to the first record in the database and returns
-        the key of the record.
-        
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> x.firstkey()
-        'a'
-        >>> x.close()            
-        
-        If the database is empty None is returned.
+    def index_range(self, name, lo=None, hi=None):
+        """Returns a list of the keys of the records whose value in the
+        named secondary index is between lo and hi, inclusive, ordered by
+        the index value. If lo or hi is None the range is open at that end.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x.firstkey()
-        >>> x.close()            
-        
+        >>> x.create_index('length', len, int)
+        >>> x['a'] = 'aaaa'
+        >>> x['b'] = 'b'
+        >>> x['c'] = 'cc'
+        >>> x.index_range('length', 1, 2)
+        ['b', 'c']
+        >>> x.close()
+
         """
-        with _EseTransaction(self._sesid):        
-            if not Api.TryMoveFirst(self._sesid, self._tableid):
-                return None    
-            return self._retrieveCurrentRecordKey()
-        
+        column = self._getIndexColumn(name)
+        return self._retrieveIndexKeys(column, lo, hi)
+
     @cursorMustBeOpen
-    def nextkey(self, key):
-        """Returns the key that follows key in the traversal.
+    def prefix_items(self, prefix):
+        """Returns a list of the (key, value) tuples of the records whose
+        keys start with the components in prefix, in key order. The
+        database must have tuple keys. The records are found with an index
+        range, so only the matching part of the index is read.
 
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['b'] = 128
-        >>> x['a'] = 256
-        >>> x.nextkey('a')
-        'b'
-        >>> x.close()            
+        >>> x = open('wdbtest.db', flag='nf', key_type=(str, int, str))
+        >>> x[('a', 1, 'x')] = 'ax'
+        >>> x[('a', 2, 'y')] = 'ay'
+        >>> x[('b', 1, 'z')] = 'bz'
+        >>> x.prefix_items(('a',))
+        [(('a', 1, 'x'), 'ax'), (('a', 2, 'y'), 'ay')]
+        >>> x.prefix_items(('a', 2))
+        [(('a', 2, 'y'), 'ay')]
+        >>> x.close()
 
-        If there are no matching records None is returned.
+        """
+        return self._retrievePrefix(prefix, self._retrieveCurrentRecord)
 
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x.nextkey('x')
-        >>> x.close()            
-        
-        The following code prints every key in the database, without having
-        to create a list in memory that contains them all:
+    @cursorMustBeOpen
+    def prefix_keys(self, prefix):
+        """Returns a list of the keys which start with the components in
+        prefix, in key order. The database must have tuple keys.
+
+        >>> x = open('wdbtest.db', flag='nf', key_type=(str, int))
+        >>> x[('a', 10)] = 'a10'
+        >>> x[('a', 9)] = 'a9'
+        >>> x[('b', 1)] = 'b1'
+        >>> x.prefix_keys(('a',))
+        [('a', 9), ('a', 10)]
+        >>> x.close()
+
+        """
+        return self._retrievePrefix(prefix, self._retrieveCurrentRecordKey)
 
-        >>> db = open('wdbtest.db', 'n')
-        >>> for i in range(10): db['%d'%i] = '%d'% (i*i)
-        ...
-        >>> k = db.firstkey()
-        >>> while k != None:
-        ...     print k
-        ...     k = db.nextkey(k)
-        0
-        1
-        2
-        3
-        4
-        5
-        6
-        7
-        8
-        9
-        >>> db.close()
-    
-        """    
-        with _EseTransaction(self._sesid): 
-            self._makeKey(key)
-            if not Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekEQ):
-                return None
-            if not Api.TryMoveNext(self._sesid, self._tableid):
-                return None
-            return self._retrieveCurrentRecordKey()
-            
     @cursorMustBeOpen
-    def pop(self, key, default=_unspecified):
-        """If key is in the dictionary, remove it and return its value, else
-        return default. 
-        
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['a'] = 64
-        >>> x.pop('a', 'X')
-        '64'
-        >>> x.pop('b', 'X')
-        'X'
-        >>> x.close()              
-        
-        If default is not given and key is not in the dictionary, a
-        KeyError is raised.
+    def table(self, name, binary_values=False, ordinal_keys=False, key_type=str, columns=None, inline_threshold=None,
+              hashed_keys=False, unordered_keys=False, space=None, initial_pages=None, density=None, dedup=False,
+              expiry=False, indexes=None):
+        """Returns a new cursor on the table with the given name, which is
+        stored in the same database file as this one. The table is created
+        if it doesn't exist, using the binary_values, ordinal_keys, key_type,
+        columns, inline_threshold, hashed_keys and unordered_keys options
+        described in open(); the options of an existing table are detected
+        when it is opened. The space, initial_pages, density, dedup, expiry
+        and indexes options of open() can be used as well. All the tables of a
+        database share one esent instance, so they share the cache,
+        transaction logs and checkpoint instead of paying for an instance
+        each.
+
+        The returned cursor compresses values, and writes large values to
+        side files, in the same way as this cursor. It has to be closed
+        like any other cursor. The database stays open until all of its
+        cursors are closed.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['a'] = 64
-        >>> x.pop('b')
-        Traceback (most recent call last):
-        ...
-        KeyError: no key matching 'b' was found
+        >>> t = x.table('other')
+        >>> t['a'] = 'otherdata'
+        >>> x.has_key('a')
+        False
+        >>> t['a']
+        'otherdata'
+        >>> t.close()
         >>> x.close()
+
+        Tables can't be created in a database opened read-only.
         
         """
-        self._database.getWriteLock(hash=key.GetHashCode())
-        try:
-            with _EseTransaction(self._sesid) as trx:
-                self._makeKey(key)
-                if Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekEQ):
-                    value = self._retrieveCurrentRecordValue()
-                    self._deleteCurrentRecord()
-                    trx.commit(self._lazyflush)
-                    return value                    
-                elif default is _unspecified:
-                    raise KeyError('no key matching \'%s\' was found' % key)
-                else:
-                    return default            
-        finally:
-            self._database.unlock(hash=key.GetHashCode())        
+        layout = _makeTableLayout(
+            binary_values, ordinal_keys, key_type, columns, inline_threshold, hashed_keys, unordered_keys,
+            space, initial_pages, density, dedup, expiry)
+        external = None
+        if None != self._externalfiles:
+            external = self._externalfiles.threshold
+            layout.external = None != external
+        cursor = self._database.openTableCursor(name, self._readonly, self._lazyflush, layout, self._codec, external)
+        cursor._openIndexes(indexes)
+        return cursor
 
     @cursorMustBeOpen
-    def popitem(self):
-        """Remove and return an arbitrary (key, value) pair from the dictionary.
-        popitem() is useful to destructively iterate over a dictionary, as often
-        used in set algorithms.
+    def space_usage(self):
+        """Returns a tuple of the number of pages owned by the table and
+        the number of those pages which are free. A page split adds a page
+        to the table, so comparing the pages in use after loading the same
+        records with different space options shows how many splits each
+        of them causes.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x['a'] = 64
-        >>> x.popitem()
-        ('a', '64')
+        >>> (owned, available) = x.space_usage()
+        >>> owned >= available
+        True
+        >>> x.close()
 
-        If the dictionary is empty, calling popitem() raises a KeyError.
+        """
+        owned = clr.Reference[int]()
+        available = clr.Reference[int]()
+        Api.JetGetTableInfo(self._sesid, self._tableid, owned, JET_TblInfo.SpaceOwned)
+        Api.JetGetTableInfo(self._sesid, self._tableid, available, JET_TblInfo.SpaceAvailable)
+        return (owned.Value, available.Value)
+
+    @cursorMustBeOpen
+    def sweep_expired(self, batchsize=100):
+        """Deletes the expired records and returns the number deleted. The
+        records are found with an index on their expiry time, so the cost
+        depends on the number of expired records, not the size of the
+        table. Each batch of batchsize records is deleted in its own
+        transaction, holding the write locks of its keys. Records written
+        by a transaction which hasn't ended are left for a later sweep.
+
+        >>> x = open('wdbtest.db', flag='nf', expiry=True)
+        >>> x.set('a', 'somedata', ttl=0.001)
+        >>> x['b'] = 'otherdata'
+        >>> import time; time.sleep(0.01)
+        >>> x.sweep_expired()
+        1
+        >>> len(x)
+        1
+        >>> x.close()
 
-        >>> x.popitem()
-        Traceback (most recent call last):
-        ...
-        KeyError: database is empty
-        >>> x.close()            
-        
         """
-        self._database.getWriteLock()
-        try:
-            with _EseTransaction(self._sesid) as trx:
-                if not Api.TryMoveLast(self._sesid, self._tableid):
-                    raise KeyError('database is empty')        
-                value = self._retrieveCurrentRecord()            
-                self._deleteCurrentRecord()
-                trx.commit(self._lazyflush)
-                return value
-        finally:
-            self._database.unlock()
-            
+        self._checkHasExpiryColumn()
+        if not isinstance(batchsize, int) or batchsize < 1:
+            raise EseDBError('batchsize must be at least 1')
+        deleted = 0
+        while True:
+            n = self._deleteExpiredBatch(batchsize)
+            deleted += n
+            if n < batchsize:
+                return deleted
+
     @cursorMustBeOpen
-    def setdefault(self, key, default=None):
-        """If key is in the dictionary, return its value. If not, insert key with
-        a value of default and return default. Default defaults to None.
+    def start_sweeper(self, interval=60, batchsize=100):
+        """Starts a background thread which calls sweep_expired() every
+        interval seconds, on a cursor of its own. The thread is stopped by
+        stop_sweeper() or when this cursor is closed. An error stops the
+        thread, and is raised by stop_sweeper().
 
-        >>> x = open('wdbtest.db', flag='nf')
-        >>> x['a'] = 64
-        >>> x.setdefault('a')
-        '64'
-        >>> x.setdefault('b', 'X')
-        'X'
-        >>> x.setdefault('c')
-        >>> x.items()
-        [('a', '64'), ('b', 'X'), ('c', None)]
-        >>> x.close()            
+        >>> x = open('wdbtest.db', flag='nf', expiry=True)
+        >>> x.start_sweeper(interval=1)
+        >>> x.close()
+
+        """
+        self._checkHasExpiryColumn()
+        if self._readonly:
+            raise EseDBError('the sweeper can\'t be started on a read-only database')
+        if None != self._sweeper:
+            raise EseDBError('the sweeper is already running')
+        if interval <= 0:
+            raise EseDBError('interval must be positive')
+        if not isinstance(batchsize, int) or batchsize < 1:
+            raise EseDBError('batchsize must be at least 1')
+        cursor = self._database.openSweepCursor(self._lazyflush, self._table)
+        self._sweeper = _ExpirySweeper(cursor, interval, batchsize)
+
+    @cursorMustBeOpen
+    def stop_sweeper(self):
+        """Stops the thread started by start_sweeper(), if it is running.
+        If the thread was stopped by an error then the error is raised,
+        and the sweeper can be started again.
 
         """
-        self._database.getWriteLock(hash=key.GetHashCode())
-        try:
-            with _EseTransaction(self._sesid) as trx:
-                self._makeKey(key)
-                if Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekEQ):
-                    return self._retrieveCurrentRecordValue()
-                else:
-                    self._insertItem(key, default)
-                    trx.commit(self._lazyflush)
-                    return default
-        finally:
-            self._database.unlock(hash=key.GetHashCode())        
+        if None != self._sweeper:
+            sweeper = self._sweeper
+            self._sweeper = None
+            sweeper.stop()
+            if None != sweeper.error:
+                raise sweeper.error
 
     @cursorMustBeOpen
-    def update(self, other=None, **keywords):
-        """Updates the dictionary with the key/value pairs from other,
-        overwriting existing keys. update() accepts either a dictionary,
-        and iterable of key/value pairs or as a set of keyword arguments
+    def transaction(self, durable=False):
+        """Starts a transaction and returns an EseDBTransaction. All the
+        reads and writes done by the cursor until the transaction is
+        committed are atomic and are committed together, and reads see
+        the earlier writes of the transaction. The transaction is usually
+        used in a with statement, which commits it if the block ends
+        normally and rolls it back if an exception is raised.
 
         >>> x = open('wdbtest.db', flag='nf')
-        >>> x.update(foo=1, bar=2)
-        >>> x.items()
-        [('bar', '2'), ('foo', '1')]
-        >>> d = { 'baz': '3' }
-        >>> x.update(d)
+        >>> with x.transaction():
+        ...     x['a'] = 1
+        ...     x['b'] = int(x['a']) + 1
         >>> x.items()
-        [('bar', '2'), ('baz', '3'), ('foo', '1')]
-        >>> i = [ ('qux', '4') ]
-        >>> x.update(i)
+        [('a', '1'), ('b', '2')]
+        >>> tx = x.transaction()
+        >>> del x['a']
+        >>> x.has_key('a')
+        False
+        >>> tx.rollback()
+        >>> x.has_key('a')
+        True
+        >>> x.close()
+
+        Each write inside the transaction only takes the write lock while
+        it is being made. A write to the same record from another cursor
+        waits for the transaction to end, and raises EseDBError if it
+        hasn't ended after 10 seconds.
+        Unless durable is True the commit is flushed to disk lazily.
+        Other cursors, including ones returned by table(), aren't part
+        of the transaction.
+
+        A savepoint lets part of a transaction be undone without rolling
+        back all of it.
+
+        >>> x = open('wdbtest.db', flag='nf')
+        >>> with x.transaction() as tx:
+        ...     x['a'] = 1
+        ...     sp = tx.savepoint()
+        ...     x['b'] = 2
+        ...     tx.rollback_to(sp)
         >>> x.items()
-        [('bar', '2'), ('baz', '3'), ('foo', '1'), ('qux', '4')]
+        [('a', '1')]
         >>> x.close()
-            
+
         """
-        # Lock all keys and use big transactions
-        self._database.getWriteLock()
-        try:
-            with _EseTransaction(self._sesid) as trx:
-                if isinstance(other, dict):
-                    self._updateItems(other.iteritems(), trx)
-                elif other:
-                    self._updateItems(other, trx)
-                if keywords:
-                    self._updateItems(keywords.items(), trx)
-                trx.commit(self._lazyflush)
-        finally:
-            self._database.unlock()     
-            
+        if None != self._transaction:
+            raise EseDBError('cursor is already in a transaction')
+        self._transaction = EseDBTransaction(self, durable)
+        return self._transaction
+
     @cursorMustBeOpen
     def sync(self):
         """Forces any unwritten data to be written to disk. This method
@@ -1382,6 +4411,52 @@ class EseDBCursor(object):
         if not self._isopen:
             raise EseDBCursorClosedError()
 
+    def _endTransaction(self, transaction, committed):
+        """Called by an EseDBTransaction when it ends."""
+        assert transaction is self._transaction, 'not the transaction of the cursor'
+        self._transaction = None
+        if not committed:
+            self._rolledBack()
+
+    def _rolledBack(self):
+        """Called when changes made by the cursor in an EseDBTransaction
+        have been rolled back.
+        
+        """
+        # The cached record count includes the inserts and deletes that
+        # were rolled back
+        self._recordCount.set(None)
+
+    def _checkIsRecordTable(self):
+        """Throw an exception if the table doesn't have record columns."""
+        if None == self._recordcolumns:
+            raise EseDBError('the database was not created with columns')
+
+    def _checkHasValueColumn(self):
+        """Throw an exception if the table stores records instead of values."""
+        if None == self._valuecolumnid:
+            raise EseDBError('the database stores records in columns')
+
+    def _checkBuffer(self, buffer):
+        """Throw an exception if values can't be retrieved into buffer."""
+        if not isinstance(buffer, (Array[Byte], bytearray)):
+            raise EseDBError('buffer must be a System.Array[Byte] or a bytearray')
+
+    def _checkHasVersionColumn(self):
+        """Throw an exception if the table doesn't have a version column."""
+        if None == self._versioncolumnid:
+            raise EseDBError('database does not have a version column')
+
+    def _checkHasCounterColumn(self):
+        """Throw an exception if the table doesn't have a counter column."""
+        if None == self._countercolumnid:
+            raise EseDBError('database does not have a counter column')
+
+    def _checkHasExpiryColumn(self):
+        """Throw an exception if the table doesn't have an expiry column."""
+        if None == self._expirycolumnid:
+            raise EseDBError('database was not created with expiry')
+
     def _iterateAndYield(self, f):
         """Iterate over all the records and yield the result
         of calling f() each time.
@@ -1395,7 +4470,7 @@ class EseDBCursor(object):
         """
         with _EseTransaction(self._sesid) as trx:
             Api.MoveBeforeFirst(self._sesid, self._tableid)
-            while Api.TryMoveNext(self._sesid, self._tableid):
+            while self._skipExpired(self._tableid, Api.TryMoveNext(self._sesid, self._tableid), Api.TryMoveNext):
                 value = f()
                 trx.commit()
                 yield value
@@ -1409,8 +4484,7 @@ class EseDBCursor(object):
         transaction.
             
         """
-        self._makeKey(key)
-        return Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekEQ)
+        return self._trySeekForKey(key)
                 
     def _updateItems(self, items, trx):
         """Insert or update the given key/value tuples. A transaction must
@@ -1422,85 +4496,826 @@ class EseDBCursor(object):
             self._insertOrUpdate(k, v)
             trx.pulse()        
                 
-    def _insertOrUpdate(self, key, value):
+    def _insertOrUpdate(self, key, value, expires=None):
         """Inserts the given key/value if the key doesn't exist. Updates the
         given key with the specified value if the key does exist. The cursor
         should already be in a transaction.
         
         """
         if self._has_key(key):
-            self._updateItem(key, value)
+            self._updateItem(key, value, expires)
         else:
-            self._insertItem(key, value)                    
+            self._insertItem(key, value, expires)                    
         
-    def _updateItem(self, key, value):
+    def _updateItem(self, key, value, expires=None):
         """Update the given key with the specified value. The key must
         exist, the cursor should already be in a transaction and the
-        cursor must be positioned on the record.
+        cursor must be positioned on the record. The record expires at
+        the given time, or never.
         
         """
         with _EseUpdate(self._sesid, self._tableid, JET_prep.Replace) as u:
+            self._setGenerationColumn()
             self._setValueColumn(value)
+            self._setIndexColumns(value)
+            self._setExpiryColumn(expires)
             u.update()
 
-    def _insertItem(self, key, value):
+    def _insertItem(self, key, value, expires=None, extract=True):
         """Update the given key with the specified value. The key must
-        not exist and the cursor should already be in a transaction.
+        not exist and the cursor should already be in a transaction. If
+        extract is False the secondary index columns are left null instead
+        of being set from the value.
         
         """
+        if None != self._expirycolumnid:
+            # An expired record which hasn't been swept yet is replaced
+            if self._keyformat.trySeek(self._sesid, self._tableid, self._keycolumnid, key):
+                self._deleteCurrentRecord()
         with _EseUpdate(self._sesid, self._tableid, JET_prep.Insert) as u:
             self._setKeyColumn(key)
+            self._setGenerationColumn()
             self._setValueColumn(value)
+            if extract:
+                self._setIndexColumns(value)
+            self._setExpiryColumn(expires)
             u.update()
-            self._database.cachedRecordCount.increment()
+            self._recordCount.increment()
 
     def _deleteCurrentRecord(self):
+        reference = self._retrieveBlobReference(RetrieveColumnGrbit.None)
+        external = self._retrieveExternalName(RetrieveColumnGrbit.None)
         Api.JetDelete(self._sesid, self._tableid)
-        self._database.cachedRecordCount.decrement()    
+        self._recordCount.decrement()    
+        if None != reference:
+            self._blobstore.release(*reference)
+        if None != external:
+            self._externalfiles.release(external)
             
+    def _sampleCurrentKey(self, tableid):
+        """Periodically adds the key of the current record of the table
+        to the hot key sample of the database. This is called whenever the
+        value of a record is retrieved, and only one read in sixteen is
+        sampled to keep the cost off the read path.
+        
+        """
+        if None != self._table:
+            # Only the default table is preread when the database is opened
+            return
+        self._reads += 1
+        if 0 == (self._reads % 16):
+            normalizedkey = Api.RetrieveKey(self._sesid, tableid, RetrieveKeyGrbit.None)
+            self._database.hotKeys.record(normalizedkey)
+
     def _retrieveCurrentRecord(self):
         """Returns a tuple of (key, value) for the current record."""
         return (self._retrieveCurrentRecordKey(), self._retrieveCurrentRecordValue())
         
+    def _retrieveCurrentRecordLazily(self):
+        """Returns a tuple of (key, LazyValue) for the current record."""
+        bookmark = Api.GetBookmark(self._sesid, self._tableid)
+        return (self._retrieveCurrentRecordKey(), LazyValue(self, bookmark))
+
+    @cursorMustBeOpen
+    def _retrieveValueAtBookmark(self, bookmark):
+        """Returns the value of the record with the given bookmark. If the
+        cursor isn't on that record the value is read with a duplicate
+        cursor, so the position of this cursor, which iteration continues
+        from, doesn't change.
+        
+        """
+        with _EseTransaction(self._sesid):
+            try:
+                current = Api.GetBookmark(self._sesid, self._tableid)
+            except EsentNoCurrentRecordException:
+                current = None
+            if None != current and tuple(current) == tuple(bookmark):
+                return self._retrieveCurrentRecordValue()
+            tableid = Api.JetDupCursor(self._sesid, self._tableid, DupCursorGrbit.None)
+            try:
+                if not Api.TryGotoBookmark(self._sesid, tableid, bookmark, bookmark.Length):
+                    raise KeyError('record has been deleted')
+                return self._retrieveCurrentRecordValue(tableid)
+            finally:
+                Api.JetCloseTable(self._sesid, tableid)
+
     def _retrieveCurrentRecordKey(self):
-        """Gets the key of the current record."""
-        return Api.RetrieveColumnAsString(self._sesid, self._tableid, self._keycolumnid)
+        """Gets the key of the current record. If the key format allows it
+        the key is read from the index entry instead of the record.
+        
+        """
+        return self._keyformat.retrieveKey(self._sesid, self._tableid, self._keycolumnid, RetrieveColumnGrbit.RetrieveFromIndex)
+
+    def _retrieveCurrentRecordValue(self, tableid=None):
+        """Gets the value of the current record of the cursor, or of a
+        duplicate of the cursor if its tableid is given.
+        
+        """
+        if None == tableid:
+            tableid = self._tableid
+        self._sampleCurrentKey(tableid)
+        if None != self._recordcolumns:
+            return dict((c.name, c.retrieve(self._sesid, tableid)) for c in self._recordcolumns)
+        for columnid in self._valuecolumnids:
+            if self._binaryvalues:
+                data = Api.RetrieveColumn(self._sesid, tableid, columnid)
+                if None != data:
+                    return _byteEncoding.GetString(data)
+            else:
+                value = Api.RetrieveColumnAsString(self._sesid, tableid, columnid)
+                if None != value:
+                    return value
+        data = self._retrieveBlobData(tableid)
+        if None == data:
+            data = self._retrieveExternalData(tableid)
+        if None != data:
+            if self._binaryvalues:
+                return _byteEncoding.GetString(data)
+            return self._encoding.GetString(data)
+        return self._retrieveCompressedValue(tableid)
+
+    def _retrieveExternalName(self, grbit, tableid=None):
+        """Returns the name of the side file holding the value of the
+        current record, or None if the value isn't in a side file.
+        
+        """
+        if None == self._externalcolumnid:
+            return None
+        if None == tableid:
+            tableid = self._tableid
+        return Api.RetrieveColumnAsString(self._sesid, tableid, self._externalcolumnid, self._encoding, grbit)
+
+    def _retrieveExternalData(self, tableid):
+        """Returns the bytes of the value of the current record from its
+        side file, or None if the value isn't in a side file.
+        
+        """
+        name = self._retrieveExternalName(RetrieveColumnGrbit.None, tableid)
+        if None == name:
+            return None
+        return self._externalfiles.read(name)
+
+    def _retrieveBlobReference(self, grbit, tableid=None):
+        """Returns the (digest, id) of the blob store row holding the value
+        of the current record, or None if the value isn't in the blob store.
+        
+        """
+        if None == self._blobstore:
+            return None
+        if None == tableid:
+            tableid = self._tableid
+        digest = Api.RetrieveColumn(self._sesid, tableid, self._blobdigestcolumnid, grbit, None)
+        if None == digest:
+            return None
+        return (digest, Api.RetrieveColumnAsInt32(self._sesid, tableid, self._blobidcolumnid, grbit))
+
+    def _retrieveBlobData(self, tableid):
+        """Returns the bytes of the value of the current record from the
+        blob store, or None if the value isn't in the blob store.
+        
+        """
+        reference = self._retrieveBlobReference(RetrieveColumnGrbit.None, tableid)
+        if None == reference:
+            return None
+        return self._blobstore.retrieve(*reference)
+
+    def _retrieveCompressedValue(self, tableid):
+        """Gets the value of the current record from the compressed value
+        column. This is only called when the value column is null, so a
+        record that isn't compressed costs nothing extra to read unless
+        its value is None.
+        
+        """
+        if None == self._compressedcolumnid:
+            return None
+        data = Api.RetrieveColumn(self._sesid, tableid, self._compressedcolumnid)
+        if None == data:
+            return None
+        # Decompression doesn't need the codec, so any cursor can read
+        # compressed values
+        value = zlib.decompress(_byteEncoding.GetString(data))
+        if self._binaryvalues:
+            return value
+        return value.decode('utf-8')
+
+    def _retrieveCurrentRecordValueInto(self, buffer):
+        """Retrieves the raw value of the current record into buffer and
+        returns the size of the value, or None if the value is null.
+        
+        """
+        self._sampleCurrentKey(self._tableid)
+        for columnid in self._valuecolumnids:
+            size = self._retrieveColumnInto(columnid, buffer)
+            if None != size:
+                return size
+        data = self._retrieveBlobData(self._tableid)
+        if None != data:
+            return self._copyBytesInto(buffer, data)
+        name = self._retrieveExternalName(RetrieveColumnGrbit.None)
+        if None != name:
+            if isinstance(buffer, Array[Byte]):
+                # The file is mapped straight into the buffer
+                return self._externalfiles.readInto(name, buffer)
+            return self._copyBytesInto(buffer, self._externalfiles.read(name))
+        return self._retrieveCompressedValueInto(buffer)
+
+    def _retrieveColumnInto(self, columnid, buffer):
+        """Retrieves a column of the current record into buffer and
+        returns the size of the column, or None if the column is null.
+        
+        """
+        if isinstance(buffer, Array[Byte]):
+            (wrn, size) = Api.JetRetrieveColumn(
+                self._sesid, self._tableid, columnid, buffer, buffer.Length, RetrieveColumnGrbit.None, None)
+            if JET_wrn.ColumnNull == wrn:
+                return None
+            return size
+
+        # Other buffer types are filled from a cursor-wide byte array, which
+        # grows to the size of the largest value seen.
+        (wrn, size) = Api.JetRetrieveColumn(
+            self._sesid, self._tableid, columnid, self._buffer, self._buffer.Length, RetrieveColumnGrbit.None, None)
+        if JET_wrn.ColumnNull == wrn:
+            return None
+        if size > self._buffer.Length:
+            self._buffer = Array.CreateInstance(Byte, size)
+            (wrn, size) = Api.JetRetrieveColumn(
+                self._sesid, self._tableid, columnid, self._buffer, self._buffer.Length, RetrieveColumnGrbit.None, None)
+        self._copyInto(buffer, self._buffer, size)
+        return size
+
+    def _retrieveCompressedValueInto(self, buffer):
+        """Decompresses the value of the current record into buffer, in
+        the same format as the value column, and returns the size of the
+        value or None if the value is null.
+        
+        """
+        value = self._retrieveCompressedValue(self._tableid)
+        if None == value:
+            return None
+        if self._binaryvalues:
+            data = _byteEncoding.GetBytes(value)
+        else:
+            data = self._encoding.GetBytes(value)
+        return self._copyBytesInto(buffer, data)
+
+    def _copyBytesInto(self, buffer, data):
+        """Copies a byte array into either type of buffer and returns the
+        size of the data.
+        
+        """
+        if isinstance(buffer, Array[Byte]):
+            Array.Copy(data, buffer, min(data.Length, buffer.Length))
+        else:
+            self._copyInto(buffer, data, data.Length)
+        return data.Length
+
+    def _copyInto(self, buffer, data, size):
+        """Copies the first size bytes of data into a bytearray, which is
+        grown if necessary.
+        
+        """
+        if data.Length != size:
+            # Only the start of the cursor-wide array holds the value
+            value = Array.CreateInstance(Byte, size)
+            Array.Copy(data, value, size)
+            data = value
+        # The slice assignment copies the whole array at once, and grows
+        # the bytearray if it is shorter than the value
+        buffer[0:size] = data
+
+    def _retrieveCurrentRecordStamp(self):
+        """Gets a stamp that changes when the current record is updated.
+        This is the version of the record, or its value for tables created
+        without a version column.
+        
+        """
+        if None != self._versioncolumnid:
+            return self._retrieveCurrentRecordVersion()
+        return self._retrieveCurrentRecordValue()
+
+    def _currentRecordMatches(self, expected, by_version):
+        """Returns True if the current record has the expected value, or
+        the expected version if by_version is True. The cursor should
+        already be in a transaction.
+        
+        """
+        if by_version:
+            return self._retrieveCurrentRecordVersion() == expected
+        return self._retrieveCurrentRecordValue() == self._storedValue(expected)
+
+    def _escrowCounter(self, delta):
+        """Adds delta to the counter of the current record and returns the
+        new count. The cursor should already be in a transaction, which is
+        rolled back by the EseDBError raised if the count overflows.
+        
+        """
+        count = Api.EscrowUpdate(self._sesid, self._tableid, self._countercolumnid, delta) + delta
+        if not Int32.MinValue <= count <= Int32.MaxValue:
+            raise EseDBError('the counter would overflow a 32-bit integer')
+        return count
+
+    def _retrieveCurrentRecordVersion(self):
+        """Gets the version of the current record. This is the generation
+        of its value for tables which have a generation column. Older
+        tables use the esent version column, which esent starts again for
+        every inserted record and increments on every update.
+        
+        """
+        if None != self._generationcolumnid:
+            return Api.RetrieveColumnAsInt64(self._sesid, self._tableid, self._generationcolumnid)
+        version = Api.RetrieveColumnAsInt32(self._sesid, self._tableid, self._versioncolumnid)
+        if None == version:
+            return 0
+        return version
+        
+    def _emptyValue(self):
+        """Returns the value of a record inserted by incr(), which is an
+        empty record for a record table and None otherwise.
+        
+        """
+        if None != self._recordcolumns:
+            return {}
+        return None
+
+    def _setExpiryColumn(self, expires):
+        """Sets the expiry time of the record, or clears it if expires is
+        None. An update should be prepared.
+        
+        """
+        if None != self._expirycolumnid:
+            Api.SetColumn(self._sesid, self._tableid, self._expirycolumnid, expires)
+
+    def _isExpired(self, tableid):
+        """Returns True if the current record of the table has expired."""
+        expires = Api.RetrieveColumnAsDateTime(self._sesid, tableid, self._expirycolumnid)
+        return None != expires and expires <= DateTime.UtcNow
+
+    def _skipExpired(self, tableid, found, move):
+        """Moves off expired records, calling move() until a record which
+        hasn't expired is found. Found is the result of the move which
+        positioned the cursor. Returns False if no record is found.
+        
+        """
+        if None == self._expirycolumnid:
+            return found
+        while found and self._isExpired(tableid):
+            found = move(self._sesid, tableid)
+        return found
+
+    def _deleteExpiredBatch(self, batchsize):
+        """Deletes up to batchsize expired records in one transaction and
+        returns the number deleted. The records are found by walking the
+        expiry index from its start to the current time. Only the write
+        locks of the keys found are taken, and each record is checked
+        again once they are held, in case it was replaced. A record
+        written by a transaction which hasn't ended is skipped.
+        
+        """
+        now = DateTime.UtcNow
+        with _EseTransaction(self._sesid):
+            keys = self._retrieveExpiredKeys(now, batchsize)
+        if not keys:
+            return 0
+        deleted = 0
+        locks = self._database.getWriteLocks(hash(key) for key in keys)
+        try:
+            with _EseTransaction(self._sesid) as trx:
+                for key in keys:
+                    if not self._keyformat.trySeek(self._sesid, self._tableid, self._keycolumnid, key):
+                        continue
+                    if not self._isExpired(self._tableid):
+                        continue
+                    try:
+                        self._deleteCurrentRecord()
+                    except EsentWriteConflictException:
+                        continue
+                    deleted += 1
+                trx.commit(self._lazyflush)
+                return deleted
+        finally:
+            self._database.unlockWriteLocks(locks)
+
+    def _retrieveExpiredKeys(self, now, batchsize):
+        """Returns the keys of up to batchsize records which expired at or
+        before now. A duplicate cursor is used so the position of this
+        cursor doesn't change. The cursor should already be in a
+        transaction.
+        
+        """
+        keys = []
+        tableid = Api.JetDupCursor(self._sesid, self._tableid, DupCursorGrbit.None)
+        try:
+            Api.JetSetCurrentIndex(self._sesid, tableid, self._expiryindex)
+            found = Api.TryMoveFirst(self._sesid, tableid)
+            if found:
+                Api.MakeKey(self._sesid, tableid, now, MakeKeyGrbit.NewKey)
+                found = Api.TrySetIndexRange(
+                    self._sesid,
+                    tableid,
+                    SetIndexRangeGrbit.RangeUpperLimit | SetIndexRangeGrbit.RangeInclusive)
+            while found and len(keys) < batchsize:
+                keys.append(self._keyformat.retrieveKey(
+                    self._sesid, tableid, self._keycolumnid, RetrieveColumnGrbit.RetrieveFromPrimaryBookmark))
+                found = Api.TryMoveNext(self._sesid, tableid)
+        finally:
+            Api.JetCloseTable(self._sesid, tableid)
+        return keys
 
-    def _retrieveCurrentRecordValue(self):
-        """Gets the value of the current record."""
-        return Api.RetrieveColumnAsString(self._sesid, self._tableid, self._valuecolumnid)
+    def _setGenerationColumn(self):
+        """Sets a new generation for the value of the record. An update
+        should be prepared.
         
+        """
+        if None != self._generationcolumnid:
+            Api.SetColumn(self._sesid, self._tableid, self._generationcolumnid, Int64(self._database.newGeneration()))
+
     def _setKeyColumn(self, key):
         """Sets the key column. An update should be prepared."""
-        Api.SetColumn(self._sesid, self._tableid, self._keycolumnid, str(key), self._encoding)
+        self._keyformat.setColumn(self._sesid, self._tableid, self._keycolumnid, key)
 
     def _setValueColumn(self, value):
         """Sets the value column. An update should be prepared."""
         # Here we want to store None as a null column, instead of the string 'None'
         # This is different than the key column, which we store a 'None' (to avoid 
         # null keys in the database).
+        if None != self._recordcolumns:
+            for (column, v) in self._recordValues(value):
+                column.set(self._sesid, self._tableid, v)
+            return
         if None == value:
             data = None
+        elif self._binaryvalues:
+            data = _valueToBytes(value)
         else:
             data = str(value)        
-        Api.SetColumn(self._sesid, self._tableid, self._valuecolumnid, data, self._encoding, SetColumnGrbit.IntrinsicLV)
-                
+        if None != self._externalcolumnid:
+            # Like the compressed column, the external column is always set
+            data = self._setExternalColumn(data)
+        if None != self._compressedcolumnid:
+            # The compressed column is always set, to clear a compressed
+            # value that is being replaced
+            compressed = self._compressValue(data)
+            Api.SetColumn(self._sesid, self._tableid, self._compressedcolumnid, compressed, SetColumnGrbit.IntrinsicLV)
+            if None != compressed:
+                data = None
+        grbit = SetColumnGrbit.IntrinsicLV
+        if None != self._smallvaluecolumnid:
+            # Small values go in the record, large ones are kept out
+            # of it so they don't take space in the primary index
+            if None != data and self._storedSize(data) <= self._smallvaluesize:
+                self._setDataColumn(self._smallvaluecolumnid, data, SetColumnGrbit.None)
+                data = None
+            else:
+                self._setDataColumn(self._smallvaluecolumnid, None, SetColumnGrbit.None)
+            grbit = SetColumnGrbit.SeparateLV
+        if None != self._blobstore:
+            self._setBlobReference(data)
+            data = None
+        self._setDataColumn(self._valuecolumnid, data, grbit)
+
+    def _setExternalColumn(self, data):
+        """Writes the data of a value to a side file if it is larger than
+        the threshold and sets the external column to the name of the file,
+        or clears it. The file of the value the record held before is
+        released. Returns the data to store in the record, which is None if
+        the value went to a side file. An update should be prepared.
+        
+        """
+        old = self._retrieveExternalName(RetrieveColumnGrbit.RetrieveCopy)
+        name = None
+        threshold = self._externalfiles.threshold
+        if None != data and None != threshold and self._storedSize(data) > threshold:
+            if not self._binaryvalues:
+                data = self._encoding.GetBytes(data)
+            name = self._externalfiles.write(data, not self._lazyflush)
+            data = None
+        Api.SetColumn(self._sesid, self._tableid, self._externalcolumnid, name, self._encoding)
+        if None != old:
+            self._externalfiles.release(old)
+        return data
+
+    def _setBlobReference(self, data):
+        """Stores the data of a value in the blob store and sets the columns
+        referring to it, or clears them if data is None. The reference to
+        the value the record held before is released. An update should be
+        prepared.
+        
+        """
+        # The copy buffer holds the reference of the record being replaced,
+        # or nothing for an insert
+        old = self._retrieveBlobReference(RetrieveColumnGrbit.RetrieveCopy)
+        new = None
+        if None != data:
+            if not self._binaryvalues:
+                data = self._encoding.GetBytes(data)
+            digest = _BlobStore.digest(data)
+            if None != old and tuple(old[0]) == tuple(digest):
+                # The record already refers to this value
+                return
+            new = (digest, self._blobstore.acquire(digest, data))
+        if None == new:
+            Api.SetColumn(self._sesid, self._tableid, self._blobdigestcolumnid, None)
+            Api.SetColumn(self._sesid, self._tableid, self._blobidcolumnid, None)
+        else:
+            Api.SetColumn(self._sesid, self._tableid, self._blobdigestcolumnid, new[0])
+            Api.SetColumn(self._sesid, self._tableid, self._blobidcolumnid, Int32(new[1]))
+        if None != old:
+            self._blobstore.release(*old)
+
+    def _setDataColumn(self, columnid, data, grbit):
+        """Sets a column holding the data of a value, which is a byte
+        array for a binary value or a string for a text value.
+        
+        """
+        if self._binaryvalues:
+            Api.SetColumn(self._sesid, self._tableid, columnid, data, grbit)
+        else:
+            Api.SetColumn(self._sesid, self._tableid, columnid, data, self._encoding, grbit)
+
+    def _storedSize(self, data):
+        """Returns the number of bytes used to store the data of a value."""
+        if self._binaryvalues:
+            return data.Length
+        return 2 * len(data)
+
+    def _compressValue(self, data):
+        """Returns the compressed bytes of the data for a value column, or
+        None if the value should be stored uncompressed. Values are only
+        compressed if they get smaller.
+        
+        """
+        if None == self._codec or None == data or len(data) < self._codec.threshold:
+            return None
+        if self._binaryvalues:
+            raw = _byteEncoding.GetString(data)
+        else:
+            # Text is compressed as UTF-8, which is smaller than the
+            # UTF-16 stored in the value column
+            raw = data.encode('utf-8')
+        compressed = self._codec.compress(raw)
+        if len(compressed) >= self._storedSize(data):
+            return None
+        return _byteEncoding.GetBytes(compressed)
+
+    def _openIndexes(self, indexes):
+        """Gives the extractors of the secondary indexes of the table to a
+        newly opened cursor, creating the indexes which don't exist. The
+        cursor is closed if this fails, so it isn't returned to the caller.
+        Writes need the extractor of every index, so a cursor which can
+        write is only opened once they all have one.
+        
+        """
+        try:
+            if None != indexes:
+                if not isinstance(indexes, dict):
+                    raise EseDBError('indexes must be a dictionary of names to (extractor, type) tuples')
+                for (name, declaration) in indexes.iteritems():
+                    if not isinstance(declaration, tuple) or 2 != len(declaration):
+                        raise EseDBError('index %s must be given as an (extractor, type) tuple' % (name,))
+                    if self._readonly and not self._indexes.has_key(name):
+                        raise EseDBError('index %s does not exist' % (name,))
+                    (extractor, index_type) = declaration
+                    self.create_index(name, extractor, index_type)
+            if not self._readonly:
+                missing = sorted(c.name for c in self._indexes.values() if None == c.extractor)
+                if missing:
+                    raise EseDBError('no extractor was given for index %s, use the indexes option' % ', '.join(missing))
+        except:
+            self.close()
+            raise
+
+    def _setIndexColumns(self, value):
+        """Sets the columns of the secondary indexes from the output of
+        their extractors. An update should be prepared.
+        
+        """
+        if not self._indexes:
+            return
+        value = self._storedValue(value)
+        for column in self._indexes.values():
+            column.set(self._sesid, self._tableid, column.extractor(value))
+
+    def _storedValue(self, value):
+        """Returns a value as it will be retrieved from the database.
+        Extractors are always called with this, so an index built from
+        the existing records matches one maintained as records are written.
+        
+        """
+        if None != self._recordcolumns:
+            return dict((c.name, v) for (c, v) in self._recordValues(value))
+        if None == value:
+            return None
+        if self._binaryvalues:
+            return _byteEncoding.GetString(_valueToBytes(value))
+        return str(value)
+
+    def _getIndexColumn(self, name):
+        """Returns the _IndexColumn of the named secondary index."""
+        if not self._indexes.has_key(name):
+            raise EseDBError('unknown index %r' % (name,))
+        return self._indexes[name]
+
+    def _populateIndexColumn(self, column):
+        """Sets the column of a new secondary index for every record in
+        the table. The write lock should be held.
+        
+        """
+        with _EseTransaction(self._sesid) as trx:
+            Api.MoveBeforeFirst(self._sesid, self._tableid)
+            while Api.TryMoveNext(self._sesid, self._tableid):
+                indexvalue = column.extractor(self._retrieveCurrentRecordValue())
+                if None != indexvalue:
+                    with _EseUpdate(self._sesid, self._tableid, JET_prep.Replace) as u:
+                        column.set(self._sesid, self._tableid, indexvalue)
+                        u.update()
+                    trx.pulse()
+
+    def _retrievePrefix(self, prefix, f):
+        """Returns a list of the results of calling f() on each record whose
+        key starts with the given components.
+        
+        """
+        if not self._keyformat.composite:
+            raise EseDBError('the database does not have tuple keys')
+        results = []
+        with _EseTransaction(self._sesid):
+            self._keyformat.makeKey(self._sesid, self._tableid, prefix, MakeKeyGrbit.NewKey)
+            found = Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekGE)
+            if found:
+                self._keyformat.makeKey(
+                    self._sesid, self._tableid, prefix, MakeKeyGrbit.NewKey | MakeKeyGrbit.FullColumnEndLimit)
+                found = Api.TrySetIndexRange(
+                    self._sesid,
+                    self._tableid,
+                    SetIndexRangeGrbit.RangeUpperLimit | SetIndexRangeGrbit.RangeInclusive)
+            try:
+                found = self._skipExpired(self._tableid, found, Api.TryMoveNext)
+                while found:
+                    results.append(f())
+                    found = self._skipExpired(self._tableid, Api.TryMoveNext(self._sesid, self._tableid), Api.TryMoveNext)
+            finally:
+                # Other methods move this cursor and mustn't be limited
+                # to the range
+                Api.ResetIndexRange(self._sesid, self._tableid)
+        return results
+
+    def _retrieveIndexKeys(self, column, lo, hi):
+        """Returns the keys of the records whose value in the index is
+        between lo and hi, which can be None. A duplicate cursor is used
+        so the position of this cursor doesn't change.
+        
+        """
+        keys = []
+        with _EseTransaction(self._sesid):
+            tableid = Api.JetDupCursor(self._sesid, self._tableid, DupCursorGrbit.None)
+            try:
+                Api.JetSetCurrentIndex(self._sesid, tableid, column.storedName())
+                if None == lo:
+                    found = Api.TryMoveFirst(self._sesid, tableid)
+                else:
+                    column.makeKey(self._sesid, tableid, lo, MakeKeyGrbit.NewKey)
+                    found = Api.TrySeek(self._sesid, tableid, SeekGrbit.SeekGE)
+                if found and None != hi:
+                    column.makeKey(self._sesid, tableid, hi, MakeKeyGrbit.NewKey | MakeKeyGrbit.FullColumnEndLimit)
+                    found = Api.TrySetIndexRange(
+                        self._sesid,
+                        tableid,
+                        SetIndexRangeGrbit.RangeUpperLimit | SetIndexRangeGrbit.RangeInclusive)
+                found = self._skipExpired(tableid, found, Api.TryMoveNext)
+                while found:
+                    # The key is in the bookmark of the secondary index entry,
+                    # so for most key formats the record isn't read
+                    keys.append(self._keyformat.retrieveKey(
+                        self._sesid, tableid, self._keycolumnid, RetrieveColumnGrbit.RetrieveFromPrimaryBookmark))
+                    found = self._skipExpired(tableid, Api.TryMoveNext(self._sesid, tableid), Api.TryMoveNext)
+            finally:
+                Api.JetCloseTable(self._sesid, tableid)
+        return keys
+
+    def _recordValues(self, value):
+        """Returns a list of (column, value) tuples for every column of a
+        record table. The record can be a dictionary of column names to
+        values, where missing columns are null, or a tuple of values in
+        the order the columns were declared.
+        
+        """
+        if isinstance(value, dict):
+            for name in value.iterkeys():
+                self._getRecordColumn(name)
+            return [(c, value.get(c.name)) for c in self._recordcolumns]
+        if isinstance(value, (tuple, list)):
+            if len(value) != len(self._recordcolumns):
+                raise EseDBError('expected %d column values, got %d' % (len(self._recordcolumns), len(value)))
+            return zip(self._recordcolumns, value)
+        raise EseDBError('records must be dictionaries or tuples')
+
+    def _getRecordColumn(self, name):
+        """Returns the record column with the given name."""
+        for c in self._recordcolumns:
+            if c.name == name:
+                return c
+        raise EseDBError('unknown column %r' % (name,))
+
     def _makeKey(self, key):
         """Construct a key for the given value."""
-        Api.MakeKey(self._sesid, self._tableid, str(key), self._encoding, MakeKeyGrbit.NewKey)
+        self._keyformat.makeKey(self._sesid, self._tableid, key, MakeKeyGrbit.NewKey)
+
+    def _trySeekForKey(self, key):
+        """Seek for the specified key, returning False if it isn't found.
+        An expired record isn't found, but the cursor is left on it.
+        
+        """
+        if not self._keyformat.trySeek(self._sesid, self._tableid, self._keycolumnid, key):
+            return False
+        return None == self._expirycolumnid or not self._isExpired(self._tableid)
 
     def _seekForKey(self, key):
         """Seek for the specified key. A KeyError exception is raised if the
         key isn't found.
         
         """
-        self._makeKey(key)
-        if not Api.TrySeek(self._sesid, self._tableid, SeekGrbit.SeekEQ):
-            raise KeyError('key \'%s\' was not found' % key)
+        if not self._trySeekForKey(key):
+            raise KeyError('key \'%s\' was not found' % (key,))
 
+
+def _spacePreset(space):
+    """Returns the (initial pages, density, growth) of a space preset, or
+    the values used when no preset is given.
+    
+    """
+    if None == space:
+        return (32, 100, None)
+    if not _spacePresets.has_key(space):
+        raise EseDBError('unknown space preset %r' % (space,))
+    return _spacePresets[space]
+
+def _makeTableLayout(binary_values, ordinal_keys, key_type, columns, inline_threshold=None,
+                     hashed_keys=False, unordered_keys=False, space=None, initial_pages=None, density=None,
+                     dedup=False, expiry=False):
+    """Returns the _TableLayout for a new table created with the given
+    options. See open() for a description of the options.
+    
+    """
+    if isinstance(key_type, tuple):
+        if len(key_type) < 2 or False in [_keyFormats.has_key(t) for t in key_type]:
+            raise EseDBError('invalid key type')
+        keyformat = _CompositeKeyFormat([_keyFormats[t] for t in key_type])
+    elif not _keyFormats.has_key(key_type):
+        raise EseDBError('invalid key type')
+    else:
+        keyformat = _keyFormats[key_type]
+    if ordinal_keys:
+        if str != key_type:
+            raise EseDBError('ordinal keys must be strings')
+        keyformat = _ordinalKeys
+    if hashed_keys or unordered_keys:
+        if str != key_type or ordinal_keys:
+            raise EseDBError('hashed keys must be strings sorted by locale')
+        keyformat = _HashedKeyFormat(not unordered_keys)
+    recordcolumns = None
+    if None != columns:
+        if binary_values:
+            raise EseDBError('binary_values cannot be used with columns')
+        recordcolumns = [_RecordColumn.fromDeclaration(name, pytype, i) for (i, (name, pytype)) in enumerate(columns)]
+        if not recordcolumns:
+            raise EseDBError('no columns were declared')
+        if len(set(c.name for c in recordcolumns)) != len(recordcolumns):
+            raise EseDBError('duplicate column name')
+    if None != inline_threshold:
+        if None != columns:
+            raise EseDBError('inline_threshold cannot be used with columns')
+        if not isinstance(inline_threshold, int) or inline_threshold < 2 or inline_threshold > 255:
+            raise EseDBError('inline_threshold must be between 2 and 255')
+        if not binary_values:
+            # Text is stored as UTF-16
+            inline_threshold -= inline_threshold % 2
+    (presetpages, presetdensity, presetgrowth) = _spacePreset(space)
+    if None == initial_pages:
+        initial_pages = presetpages
+    if None == density:
+        density = presetdensity
+    if not isinstance(initial_pages, int) or initial_pages < 1:
+        raise EseDBError('initial_pages must be at least 1')
+    if not isinstance(density, int) or density < 20 or density > 100:
+        raise EseDBError('density must be between 20 and 100')
+    if dedup and None != columns:
+        raise EseDBError('dedup cannot be used with columns')
+    return _TableLayout(
+        binaryvalues=binary_values,
+        keyformat=keyformat,
+        recordcolumns=recordcolumns,
+        smallvaluesize=inline_threshold,
+        initialpages=initial_pages,
+        density=density,
+        dedup=dedup,
+        expiry=expiry)
     
 #-----------------------------------------------------------------------
-def open(filename, flag='cf', mode=0):
+def open(filename, flag='cf', mode=0, binary_values=False, ordinal_keys=False, key_type=str, columns=None,
+         compression=None, compression_threshold=256, inline_threshold=None, hashed_keys=False,
+         unordered_keys=False, space=None, initial_pages=None, density=None, growth=None, dedup=False,
+         external_threshold=None, expiry=False, indexes=None):
 #-----------------------------------------------------------------------
     """Open an esent database and return an EseDBCursor object. Filename is
     the path to the database, including the extension. Flag specifies
@@ -1520,12 +5335,177 @@ def open(filename, flag='cf', mode=0):
     As well as the database file, this will create transaction logs and
     a checkpoint file in the same directory as the database (if read/write
     access is requested). The logs and checkpoint will start with a prefix
-    of 'wdb'.
+    of 'wdb'. When the database is closed a sample of recently read keys is
+    saved in 'wdb.hot' and those records are read into the cache by a
+    background thread the next time the database is opened.
     
     If lazyflush is true, then the transaction logs will be written in
     a lazy fashion. This will preserve database consistency, but some data
     will be lost if there is an unexpected shutdown (crash).
 
+    If binary_values is true a newly created database stores values as raw
+    bytes instead of Unicode text, which halves the space used by byte
+    strings such as pickles. Values are returned as byte strings. This
+    option only applies when the database is created; an existing database
+    keeps the value format it was created with.
+
+    If ordinal_keys is true a newly created database stores keys as UTF-8
+    bytes and orders them bytewise (by Unicode code point) instead of using
+    the collation of the current culture. Key creation is cheaper and the
+    sort order is the same on every machine. Like binary_values this only
+    applies when the database is created.
+
+    key_type selects the type of the keys of a newly created database: str
+    (the default), int, uuid.UUID or datetime.datetime. Non-string keys are
+    stored in a fixed-size native column with a numeric index, so integer
+    keys sort numerically and take 8 bytes. Keys are converted to key_type
+    when they are stored and are returned as key_type. The key type of an
+    existing database is detected when it is opened.
+
+    >>> db = open('wdbtest.db', 'n', key_type=int)
+    >>> for i in [10, 9, 100]: db[i] = i
+    ...
+    >>> db.keys()
+    [9, 10, 100]
+    >>> db.close()
+
+    key_type can also be a tuple of two or more of those types, for tuple
+    keys. Each component is stored in its own column and the index is over
+    all of them, so keys sort by their first component, then their second,
+    and so on, each in the order of its type. prefix_items() and
+    prefix_keys() find the keys starting with some leading components
+    using an index range.
+
+    >>> db = open('wdbtest.db', 'n', key_type=(str, int))
+    >>> for i in [10, 9, 100]: db[('tenant', i)] = i
+    ...
+    >>> db.prefix_keys(('tenant',))
+    [('tenant', 9), ('tenant', 10), ('tenant', 100)]
+    >>> db.close()
+
+    columns declares the columns of the records of a newly created
+    database, as a sequence of (name, type) tuples. The types are str,
+    int, float, bool, datetime.datetime and bytearray. Each column is
+    stored in a native esent column instead of serializing the value into
+    one string, and a single column can be updated in place with
+    set_columns(). Records are set as dictionaries of column names to
+    values or as tuples of values in column order, and are returned as
+    dictionaries. Missing columns are None.
+
+    More tables can be created in the same database file with the table()
+    method of the returned cursor.
+
+    If compression is a zlib compression level, from 1 (fastest) to 9
+    (smallest), values of at least compression_threshold characters (or
+    bytes) written through the returned cursor are compressed, if that
+    makes them smaller. Each record is marked as compressed or not, so a
+    database can hold a mix of both and any cursor can read them. Values
+    of databases created with columns are not compressed.
+
+    >>> db = open('wdbtest.db', 'n', compression=6)
+    >>> db['a'] = 'abc' * 1000
+    >>> db['a'] == 'abc' * 1000
+    True
+    >>> db.close()
+
+    If inline_threshold is given a newly created database keeps values of
+    up to that many bytes (text takes two bytes per character) in a column
+    stored in the record, so reading a small value only touches the page
+    of its record. Larger values are always stored outside the record,
+    which keeps the primary index small. The threshold can be at most 255;
+    a good choice is a size just above that of most values. Like
+    binary_values this only applies when the database is created.
+
+    Keys longer than the maximum index key size are truncated in the index,
+    so keys with a long common prefix collide there. If hashed_keys is true
+    a newly created database indexes the first 32 characters of each key
+    and a 64-bit hash of the whole key instead. A seek then costs the same
+    for any key length and compares the full key, so colliding keys are
+    handled correctly. Keys are only ordered by their first 32 characters,
+    and keys are compared exactly, including case. If unordered_keys is
+    true only the hash is indexed: keys are returned in no particular
+    order, set_location() can't be used and no locale is needed.
+
+    A new table starts with initial_pages pages and its pages are filled
+    to density percent before new pages are started. The defaults of 32
+    pages and 100% suit keys which are appended in order; when keys are
+    inserted in random order a lower density leaves room in each page, so
+    fewer pages have to be split. Growth is the number of pages the
+    database file grows by when it is full. Unlike the other options it
+    applies whenever the database is opened, so a large load into an
+    existing database can ask for the file to grow in big steps. The space
+    option selects a preset for these values, which the other options
+    override: 'append' for keys inserted in order and 'random' for keys
+    inserted in random order. space_usage() reports the pages a table uses.
+
+    >>> db = open('wdbtest.db', 'n', space='random')
+    >>> db['a'] = 'value'
+    >>> db.close()
+
+    If dedup is true a newly created database stores each distinct value
+    once, in a table shared by all the deduplicated tables of the database,
+    and records only hold a reference to it. Storing a value which is
+    already stored just adds a reference, and the cache holds one copy of
+    each popular value. Reading a value takes an extra seek, so this suits
+    large values which are shared by many records. Values small enough for
+    inline_threshold stay in their record, and values which compression
+    makes smaller are stored compressed in their record instead.
+
+    >>> db = open('wdbtest.db', 'n', dedup=True)
+    >>> db['a'] = 'shared' * 1000
+    >>> db['b'] = 'shared' * 1000
+    >>> db['a'] == db['b']
+    True
+    >>> db.close()
+
+    If external_threshold is given, values larger than that many bytes are
+    written to side files in a directory next to the database (named after
+    the database with '.files' appended) and records only hold the name of
+    the file. Huge values then don't fill the version store or the cache,
+    and they are read with memory-mapped I/O. A file is deleted when the
+    transaction which replaces or deletes its value commits, and a file
+    written by a transaction which rolls back is deleted straight away.
+    Like compression this applies to the values written while the option
+    is given, and any cursor can read the values.
+
+    >>> db = open('wdbtest.db', 'n', external_threshold=1024*1024)
+    >>> db['a'] = 'x' * 1024 * 1024
+    >>> len(db['a'])
+    1048576
+    >>> db.close()
+
+    If expiry is true a newly created database can hold records which
+    expire, set with the ttl argument of set(). The expiry time of each
+    record is stored in an indexed column, so reads skip expired records
+    and sweep_expired(), or the background thread of start_sweeper(),
+    deletes them without scanning the whole table.
+
+    >>> db = open('wdbtest.db', 'n', expiry=True)
+    >>> db.set('session', 'data', ttl=3600)
+    >>> db.start_sweeper(interval=60)
+    >>> db.close()
+
+    indexes gives the secondary indexes of the table, as a dictionary of
+    index names to (extractor, type) tuples; see create_index(). Indexes
+    which don't exist are created. Extractors aren't stored in the
+    database, so a database with indexes can only be opened for writing
+    if the extractor of every index is given, otherwise EseDBError is
+    raised. A database opened read-only doesn't need them.
+
+    >>> db = open('wdbtest.db', 'n', indexes={'length': (len, int)})
+    >>> db['a'] = 'aa'
+    >>> db.close()
+    >>> db = open('wdbtest.db', 'w', indexes={'length': (len, int)})
+    >>> db.lookup('length', 2)
+    ['a']
+    >>> db.close()
+
+    >>> db = open('wdbtest.db', 'n', columns=[('name', str), ('count', int)])
+    >>> db['a'] = ('alpha', 1)
+    >>> db['a'] == {'name': 'alpha', 'count': 1}
+    True
+    >>> db.close()
+
     >>> db = open('wdbtest.db', 'n')
     >>> for i in range(10): db['%d'%i] = '%d'% (i*i)
     ...
@@ -1573,6 +5553,25 @@ def open(filename, flag='cf', mode=0):
             lazyflush = flag[1] == 'f'
     else:
         raise EseDBError('invalid flag')
+
+    layout = _makeTableLayout(
+        binary_values, ordinal_keys, key_type, columns, inline_threshold, hashed_keys, unordered_keys,
+        space, initial_pages, density, dedup, expiry)
+    if None == growth:
+        growth = _spacePreset(space)[2]
+    elif not isinstance(growth, int) or growth < 1:
+        raise EseDBError('growth must be at least 1')
+    codec = None
+    if None != compression:
+        if None != columns:
+            raise EseDBError('compression cannot be used with columns')
+        codec = _ZlibCodec(compression, compression_threshold)
+    if None != external_threshold:
+        if None != columns:
+            raise EseDBError('external_threshold cannot be used with columns')
+        if not isinstance(external_threshold, int) or external_threshold < 1:
+            raise EseDBError('external_threshold must be at least 1')
+        layout.external = True
     
     _registry.lock()
     try:
@@ -1581,9 +5580,11 @@ def open(filename, flag='cf', mode=0):
             newDB = _EseDB(instancename, filename)
             _registry.registerDB(newDB)
         db = _registry.getDB(filename)
-        return db.openCursor(mode, lazyflush)                
+        cursor = db.openCursor(mode, lazyflush, layout, codec, growth, external_threshold)
     finally:
-        _registry.unlock()            
+        _registry.unlock()
+    cursor._openIndexes(indexes)
+    return cursor            
 
     
 # Set global esent options
@@ -1593,6 +5594,15 @@ SystemParameters.DatabasePageSize = 8192
 SystemParameters.CacheSizeMin = 8192
 SystemParameters.CacheSizeMax = 2**30
 
+# Space presets giving (initial pages, density, growth). Appended keys
+# fill each page completely, random inserts leave a fifth of each page
+# free for the keys that land between existing ones. Both grow the
+# file 8MB at a time.
+_spacePresets = {
+    'append': (32, 100, 1024),
+    'random': (256, 80, 1024),
+    }
+
 # A global object to perform filename => EseDB mappings
 _registry = _EseDBRegistry()
 
@@ -42,8 +42,8 @@ def insertRetrieveTest():
 	print 'Retrieved %d records in %s' % (len(keys), timer.Elapsed)	
 	db.close()
 
-def insertTest(keys):
-	db = esedb.open(database, 'n', True)
+def insertTest(keys, key_type=str, dedup=False):
+	db = esedb.open(database, 'n', True, key_type=key_type, dedup=dedup)
 	data = 'XXXXXXXXXXXXXXXX'
 	timer = Stopwatch.StartNew()
 	for x in keys:
@@ -52,6 +52,17 @@ def insertTest(keys):
 	db.close()
 	return timer.Elapsed
 
+def spaceTest(keys, space):
+	db = esedb.open(database, 'n', True, space=space)
+	data = 'XXXXXXXXXXXXXXXX'
+	timer = Stopwatch.StartNew()
+	for x in keys:
+		db[x] = data
+	timer.Stop()
+	(owned, available) = db.space_usage()
+	db.close()
+	return (timer.Elapsed, owned - available)
+
 def repeatedRetrieveTest(numretrieves):
 	db = esedb.open(database, 'r')
 	(key, data) = db.first()
@@ -71,6 +82,17 @@ def retrieveTest(keys):
 	db.close()
 	return timer.Elapsed
 
+def retrieveIntoTest(size, numretrieves):
+	db = esedb.open(database, 'n', True, binary_values=True)
+	db['key'] = 'X' * size
+	buffer = bytearray()
+	timer = Stopwatch.StartNew()
+	for i in xrange(0, numretrieves):
+		db.get_into('key', buffer)
+	timer.Stop()
+	db.close()
+	return timer.Elapsed
+
 def scanTest():
 	db = esedb.open(database, 'r')
 	timer = Stopwatch.StartNew()
@@ -110,6 +132,17 @@ random.shuffle(keys)
 time = insertTest(keys)
 print 'randomly inserted %d records in %s (lazy commit)' % (len(keys), time)
 
+# Insert the same keys into a database with native integer keys
+time = insertTest(keys, int)
+print 'randomly inserted %d integer records in %s (lazy commit)' % (len(keys), time)
+
+# Every record has the same value, so a deduplicated database stores it once
+time = insertTest(keys, dedup=True)
+print 'randomly inserted %d records with deduplicated values in %s (lazy commit)' % (len(keys), time)
+
+# Restore the string-keyed database for the remaining tests
+time = insertTest(keys)
+
 # Now scan all the records in key order. As the database was closed and reopened
 # we will be starting with no data cached
 time = scanTest()
@@ -121,3 +154,21 @@ random.shuffle(keys)
 time = retrieveTest(keys)
 print 'randomly retrieved %d records in %s' % (len(keys), time)
 
+# Insert the same keys in order and in random order with each space preset.
+# Every page split adds a page, so the pages used beyond those of an ordered
+# append at full density are roughly the number of splits
+keys = sorted(str(k) for k in range(1000000))
+(time, basepages) = spaceTest(keys, 'append')
+for space in ['append', 'random']:
+	for (order, shuffle) in [('appended', False), ('randomly inserted', True)]:
+		if shuffle:
+			random.shuffle(keys)
+		else:
+			keys.sort()
+		(time, pages) = spaceTest(keys, space)
+		print '%s %d records with %s preset in %s, %d pages (~%d splits)' % (order, len(keys), space, time, pages, pages - basepages)
+
+# Retrieve a large value into a reused bytearray
+numretrieves = 1000
+time = retrieveIntoTest(1024 * 1024, numretrieves)
+print 'retrieved a 1MB value into a bytearray %d times in %s' % (numretrieves, time)
@@ -61,7 +61,8 @@ class EseDbShelf(shelve.Shelf):
     """    
 
     def __init__(self, filename, flag='cf', protocol=None, writeback=False):
-        shelve.Shelf.__init__(self, esedb.open(filename, flag), protocol, writeback)
+        # Pickles are byte strings, so new shelves store them in a binary column
+        shelve.Shelf.__init__(self, esedb.open(filename, flag, binary_values=True), protocol, writeback)
 
     def set_location(self, key):
         """Sets the cursor to the entry specified by the key and returns
@@ -5,14 +5,20 @@
 #-----------------------------------------------------------------------
 
 import unittest
+import datetime
+import gc
+import hashlib
 import random
+import uuid
 import threading
+import time
 import esedb
 import System
 
 from System.IO import Directory
+from System.IO import File
 from System.IO import Path
-from esedb import Counter, EseDBError, EseDBCursorClosedError
+from esedb import Counter, EseDBError, EseDBCursorClosedError, LazyValue
 
 import clr
 clr.AddReferenceByPartialName('Esent.Interop')
@@ -230,6 +236,109 @@ class EsedbSingleDBFixture(unittest.TestCase):
         self._db.sync()
         self._db['foo'] = 'bar'
         self._db.sync()
+
+    def testGetIntoByteArray(self):
+        self._db['key'] = 'value'
+        buffer = System.Array.CreateInstance(System.Byte, 64)
+        size = self._db.get_into('key', buffer)
+        self.assertEqual('value', System.Text.Encoding.Unicode.GetString(buffer, 0, size))
+
+    def testGetIntoGrowsBytearray(self):
+        self._db['key'] = 'value'
+        buffer = bytearray()
+        size = self._db.get_into('key', buffer)
+        self.assertEqual(10, size)
+        self.assertEqual(u'value', str(buffer[:size]).decode('utf-16'))
+
+    def testGetIntoOverwritesStartOfLongerBytearray(self):
+        self._db['key'] = 'value'
+        buffer = bytearray('\xff' * 12)
+        self.assertEqual(10, self._db.get_into('key', buffer))
+        self.assertEqual(12, len(buffer))
+        self.assertEqual(u'value', str(buffer[:10]).decode('utf-16'))
+        self.assertEqual(bytearray('\xff\xff'), buffer[10:])
+
+    def testGetIntoReusesBytearrayForSmallerValue(self):
+        self._db['a'] = 'a much longer value'
+        self._db['b'] = 'short'
+        buffer = bytearray()
+        self.assertEqual(38, self._db.get_into('a', buffer))
+        self.assertEqual(10, self._db.get_into('b', buffer))
+        self.assertEqual(u'short', str(buffer[:10]).decode('utf-16'))
+
+    def testGetIntoUnsupportedBufferRaisesError(self):
+        self._db['key'] = 'value'
+        self.assertRaises(EseDBError, self._db.get_into, 'key', memoryview(bytearray(16)))
+        self.assertRaises(EseDBError, self._db.iter_into, [])
+
+    def testGetIntoReturnsFullSizeWhenTruncated(self):
+        self._db['key'] = 'value'
+        buffer = System.Array.CreateInstance(System.Byte, 4)
+        self.assertEqual(10, self._db.get_into('key', buffer))
+
+    def testGetIntoReturnsNoneForNullValue(self):
+        self._db['key'] = None
+        self.assertEqual(None, self._db.get_into('key', bytearray()))
+
+    def testGetIntoRaisesKeyErrorWhenKeyNotPresent(self):
+        self.assertRaises(KeyError, self._db.get_into, 'key', bytearray())
+
+    def testIterIntoReturnsSizes(self):
+        self._db['a'] = 'x'
+        self._db['b'] = 'xyz'
+        self.assertEqual([('a', 2), ('b', 6)], list(self._db.iter_into(bytearray())))
+
+    def testGetWithVersionReturnsValue(self):
+        self._db['key'] = 'value'
+        (value, version) = self._db.get_with_version('key')
+        self.assertEqual('value', value)
+
+    def testGetWithVersionRaisesKeyErrorWhenKeyNotPresent(self):
+        self.assertRaises(KeyError, self._db.get_with_version, 'key')
+
+    def testVersionChangesOnUpdate(self):
+        self._db['key'] = 'value'
+        (_, version1) = self._db.get_with_version('key')
+        self._db['key'] = 'newvalue'
+        (_, version2) = self._db.get_with_version('key')
+        self.assertNotEqual(version1, version2)
+
+    def testGetIfChangedReturnsNoneWhenUnchanged(self):
+        self._db['key'] = 'value'
+        (_, version) = self._db.get_with_version('key')
+        self.assertEqual(None, self._db.get_if_changed('key', version))
+
+    def testGetIfChangedReturnsNewValue(self):
+        self._db['key'] = 'value'
+        (_, version) = self._db.get_with_version('key')
+        self._db['key'] = 'newvalue'
+        self.assertEqual('newvalue', self._db.get_if_changed('key', version)[0])
+
+    def testSetIfVersionFailsAfterUpdate(self):
+        self._db['key'] = 'value'
+        (_, version) = self._db.get_with_version('key')
+        self.assertEqual(True, self._db.set_if_version('key', 'a', version))
+        self.assertEqual(False, self._db.set_if_version('key', 'b', version))
+        self.assertEqual('a', self._db['key'])
+
+    def testVersionChangesWhenKeyIsInsertedAgain(self):
+        self._db['key'] = 'value'
+        (_, version) = self._db.get_with_version('key')
+        del self._db['key']
+        self._db['key'] = 'newvalue'
+        self.assertNotEqual(version, self._db.get_with_version('key')[1])
+        self.assertEqual('newvalue', self._db.get_if_changed('key', version)[0])
+        self.assertEqual(False, self._db.set_if_version('key', 'a', version))
+        self.assertEqual('newvalue', self._db['key'])
+
+    def testVersionChangesWhenKeyIsInsertedAgainAfterReopen(self):
+        self._db['key'] = 'value'
+        (_, version) = self._db.get_with_version('key')
+        del self._db['key']
+        self._db.close()
+        self._db = esedb.open(self._makeDatabasePath('test.edb'))
+        self._db['key'] = 'newvalue'
+        self.assertEqual('newvalue', self._db.get_if_changed('key', version)[0])
         
 class EsedbIterationFixture(unittest.TestCase):
     """Iteration tests for esedb. This fixture creates a database with a
@@ -345,6 +454,79 @@ class EsedbIterationFixture(unittest.TestCase):
         items.reverse()
         self.assertEqual(items, expected)
 
+    def testLazyIteritemsReturnsKeys(self):
+        keys = [k for (k, v) in self._db.iteritems(lazy=True)]
+        self.assertEqual(['a', 'b', 'c', 'd'], keys)
+
+    def testLazyIteritemsReturnsLazyValues(self):
+        for (k, v) in self._db.iteritems(lazy=True):
+            self.assertEqual(True, isinstance(v, LazyValue))
+
+    def testLazyValueWhilePositioned(self):
+        values = [v.get() for (k, v) in self._db.iteritems(lazy=True)]
+        self.assertEqual(['1', '2', '3', '4'], values)
+
+    def testLazyValueAfterIteration(self):
+        items = self._db.items(lazy=True)
+        self.assertEqual('2', items[1][1].get())
+        self.assertEqual('1', items[0][1].get())
+
+    def testLazyValueDoesNotDisturbIteration(self):
+        items = self._db.items(lazy=True)
+        keys = []
+        for (k, v) in self._db.iteritems(lazy=True):
+            keys.append(k)
+            items[0][1].get()
+        self.assertEqual(['a', 'b', 'c', 'd'], keys)
+
+    def testLazyValueAfterIterationDoesNotMoveCursor(self):
+        items = self._db.items(lazy=True)
+        self.assertEqual('2', items[1][1].get())
+        self.assertEqual(('d', '4'), self._db.previous())
+
+    def testLazyValueWhenCurrentRecordIsDeleted(self):
+        items = self._db.items(lazy=True)
+        self._db.first()
+        del self._db['a']
+        self.assertEqual('3', items[2][1].get())
+        self.assertEqual(('b', '2'), self._db.next())
+
+    def testLazyValueRaisesErrorOnClosedCursor(self):
+        items = self._db.items(lazy=True)
+        self._db.close()
+        self.assertRaises(EseDBCursorClosedError, items[0][1].get)
+
+    def testLazyValueRaisesKeyErrorForDeletedRecord(self):
+        items = self._db.items(lazy=True)
+        del self._db['a']
+        self.assertRaises(KeyError, items[0][1].get)
+
+    def testScanReturnsItems(self):
+        self.assertEqual(self._db.items(), list(self._db.scan()))
+
+    def testScanWithSmallChunks(self):
+        self.assertEqual(self._db.items(), list(self._db.scan(chunksize=1, prefetch=1)))
+
+    def testScanCanBeAbandoned(self):
+        records = self._db.scan(chunksize=1, prefetch=1)
+        self.assertEqual(('a', '1'), records.next())
+        records.close()
+        self.assertEqual(('a', '1'), self._db.first())
+
+    def testAbandonedScanIsClosedWhenCollected(self):
+        records = self._db.scan(chunksize=1, prefetch=1)
+        self.assertEqual(('a', '1'), records.next())
+        thread = records._thread
+        self.assertTrue(thread.daemon)
+        records = None
+        gc.collect()
+        gc.collect()
+        thread.join(10)
+        self.assertFalse(thread.isAlive())
+
+    def testScanRaisesErrorOnInvalidChunksize(self):
+        self.assertRaises(EseDBError, self._db.scan, 0)
+
     def testIterateAllKeys(self):
         keys = []
         k = self._db.firstkey()
@@ -491,14 +673,70 @@ class EsedbFixture(unittest.TestCase):
         self.assertEqual(0, len(db))
         db.close()
 
+    def testCloseSavesHotKeys(self):
+        db = esedb.open(self._makeDatabasePath('test.edb'), 'n')
+        for i in xrange(100):
+            db[i] = i
+        for i in xrange(100):
+            _ = db[i]
+        db.close()
+        self.assertEqual(True, File.Exists(self._makeDatabasePath('wdb.hot')))
+
+    def testOtherReadsAreSampledAsHotKeys(self):
+        db = esedb.open(self._makeDatabasePath('test.edb'), 'n')
+        for i in xrange(100):
+            db[i] = i
+        for i in xrange(100):
+            db.get_with_version(i)
+        for (k, v) in db.iteritems():
+            pass
+        db.get_into(0, bytearray())
+        db.close()
+        self.assertNotEqual(0, len(File.ReadAllLines(self._makeDatabasePath('wdb.hot'))))
+
+    def testPrereadThreadIsADaemonThread(self):
+        db = esedb.open(self._makeDatabasePath('test.edb'), 'n')
+        for i in xrange(100):
+            db[i] = i
+            _ = db[i]
+        db.close()
+        db = esedb.open(self._makeDatabasePath('test.edb'))
+        thread = db._database._prereadThread
+        if None != thread:
+            self.assertTrue(thread.daemon)
+        db.close()
+
+    def testReopenWithHotKeys(self):
+        db = esedb.open(self._makeDatabasePath('test.edb'), 'n')
+        for i in xrange(1000):
+            db[i] = i
+        for i in xrange(1000):
+            _ = db[i]
+        db.close()
+
+        db = esedb.open(self._makeDatabasePath('test.edb'), 'r')
+        self.assertEqual('500', db[500])
+        self.assertEqual(1000, len(db))
+        db.close()
+
+    def testOverwriteDeletesHotKeys(self):
+        db = esedb.open(self._makeDatabasePath('test.edb'), 'n')
+        db.close()
+        db = esedb.open(self._makeDatabasePath('test.edb'), 'n')
+        self.assertEqual(False, File.Exists(self._makeDatabasePath('wdb.hot')))
+        db.close()
 
-class EsedbClosedCursorFixture(unittest.TestCase):
-    """Tests for esedb on a closed cursor."""
+
+class EsedbBinaryValuesFixture(unittest.TestCase):
+    """Tests for databases created with binary values."""
 
     def setUp(self):
         self._dataDirectory = 'unittest_data'
         self._deleteDataDirectory()
-        self._db = esedb.open(self._makeDatabasePath('test.edb'))
+        self._database = self._makeDatabasePath('test.edb')
+        self._db = esedb.open(self._database, 'n', binary_values=True)
+
+    def tearDown(self):
         self._db.close()
         self._deleteDataDirectory()
 
@@ -508,77 +746,1890 @@ class EsedbClosedCursorFixture(unittest.TestCase):
     def _makeDatabasePath(self, filename):
         return Path.Combine(self._dataDirectory, filename)
 
-    def testGetitemRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.__getitem__, '_')
+    def testInsertAndRetrieveRecord(self):
+        self._db['key'] = 'value'
+        self.assertEqual('value', self._db['key'])
 
-    def testSetitemRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.__setitem__, '_', '_')
+    def testAllByteValues(self):
+        data = ''.join([chr(i) for i in xrange(256)])
+        self._db['key'] = data
+        self.assertEqual(data, self._db['key'])
 
-    def testDelitemRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.__delitem__, '_')
+    def testNullValue(self):
+        self._db['key'] = None
+        self.assertEqual(None, self._db['key'])
 
-    def testLenRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, len, self._db)
+    def testEmptyValue(self):
+        self._db['key'] = ''
+        self.assertEqual('', self._db['key'])
 
-    def testContainsRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.__contains__, '_')
+    def testByteArrayValue(self):
+        self._db['key'] = bytearray('abc')
+        self.assertEqual('abc', self._db['key'])
 
-    def testClearRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.clear)
+    def testNonByteValueRaisesError(self):
+        self.assertRaises(EseDBError, self._db.__setitem__, 'key', u'\u1234')
 
-    def testIterkeysRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.iterkeys)
+    def testValuesAreStoredAsBytes(self):
+        self._db['key'] = 'value'
+        self.assertEqual(5, self._db.get_into('key', bytearray()))
 
-    def testKeysRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.keys)
+    def testBinaryValuesAreDetectedOnOpen(self):
+        self._db['key'] = 'value'
+        self._db.close()
+        self._db = esedb.open(self._database, 'w')
+        self.assertEqual(5, self._db.get_into('key', bytearray()))
+        self.assertEqual('value', self._db['key'])
 
-    def testItervaluesRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.itervalues)
+    def testTextValuesAreDetectedOnOpen(self):
+        self._db.close()
+        db = esedb.open(self._database, 'n')
+        db['key'] = 'value'
+        db.close()
+        self._db = esedb.open(self._database, 'c', binary_values=True)
+        self.assertEqual(10, self._db.get_into('key', bytearray()))
+        self.assertEqual('value', self._db['key'])
 
-    def testValuesRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.values)
 
-    def testIteritemsRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.iteritems)
+class EsedbOrdinalKeysFixture(unittest.TestCase):
+    """Tests for databases created with ordinal keys."""
 
-    def testItemsRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.items)
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+        self._db = esedb.open(self._database, 'n', ordinal_keys=True)
 
-    def testHaskeyRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.has_key, '_')
+    def tearDown(self):
+        self._db.close()
+        self._deleteDataDirectory()
 
-    def testSetlocationRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.set_location, '_')
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
 
-    def testFirstRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.first)
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
 
-    def testLastRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.last)
+    def testInsertAndRetrieveRecord(self):
+        self._db['key'] = 'value'
+        self.assertEqual('value', self._db['key'])
+
+    def testEmptyKey(self):
+        self._db[''] = 'value'
+        self.assertEqual('value', self._db[''])
+        self.assertEqual([''], self._db.keys())
+
+    def testKeysAreInOrdinalOrder(self):
+        keys = ['b', 'B', 'a', 'A', '-a', 'a-', u'\u00e9', 'e', 'z']
+        for k in keys:
+            self._db[k] = k
+        keys.sort()
+        self.assertEqual(keys, self._db.keys())
 
-    def testNextRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.next)
-        
-    def testPreviousRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.previous)
+    def testUnicodeKeyRoundTrips(self):
+        key = u'\u4e2d\u6587'
+        self._db[key] = 'value'
+        self.assertEqual([key], self._db.keys())
+        self.assertEqual('value', self._db[key])
 
-    def testFirstKeyRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.firstkey)
+    def testKeysOfEveryLengthRoundTrip(self):
+        keys = ['k' * n for n in xrange(1, 40)]
+        for k in keys:
+            self._db[k] = 'value'
+        self.assertEqual(keys, self._db.keys())
 
-    def testNextKeyRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.nextkey)
-        
-    def testPopRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.pop, 'a')
+    def testLongKeyRoundTrips(self):
+        key = 'abcdefghij' * 500
+        self._db[key] = 'value'
+        self.assertEqual([key], self._db.keys())
+        self.assertEqual([(key, 'value')], list(self._db.scan()))
 
-    def testPopItemRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.popitem)
+    def testIndexLookupReturnsKeys(self):
+        self._db.create_index('value', lambda v: v)
+        self._db[u'\u4e2d'] = 'value'
+        self._db['b'] = 'value'
+        self.assertEqual(['b', u'\u4e2d'], self._db.lookup('value', 'value'))
 
-    def testSetDefaultRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.setdefault)
+    def testSetLocationFindsNextHighest(self):
+        self._db['b'] = '1'
+        self._db['B'] = '2'
+        self.assertEqual(('b', '1'), self._db.set_location('a'))
 
-    def testUpdateRaisesErrorOnClosedCursor(self):
-        self.assertRaises(EseDBCursorClosedError, self._db.update)
+    def testOrdinalKeysAreDetectedOnOpen(self):
+        self._db['b'] = '1'
+        self._db['B'] = '2'
+        self._db.close()
+        self._db = esedb.open(self._database, 'r')
+        self.assertEqual(['B', 'b'], self._db.keys())
+
+
+class EsedbTypedKeysFixture(unittest.TestCase):
+    """Tests for databases created with native key types."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testIntegerKeysAreInNumericOrder(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        for i in [10, -1, 2, 100, 2**40]:
+            db[i] = i
+        self.assertEqual([-1, 2, 10, 100, 2**40], db.keys())
+        db.close()
+
+    def testIntegerKeysAcceptStrings(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        db['10'] = 'ten'
+        self.assertEqual('ten', db[10])
+        db.close()
+
+    def testInvalidIntegerKeyRaisesError(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        try:
+            self.assertRaises(EseDBError, db.__setitem__, 'x', 'value')
+        finally:
+            db.close()
+
+    def testIntegerKeyOutOfRangeRaisesError(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        try:
+            db[2**63 - 1] = 'max'
+            db[-2**63] = 'min'
+            self.assertEqual([-2**63, 2**63 - 1], db.keys())
+            self.assertRaises(EseDBError, db.__setitem__, 2**63, 'value')
+            self.assertRaises(EseDBError, db.__setitem__, -2**63 - 1, 'value')
+            self.assertFalse(db.has_key(2**64))
+        finally:
+            db.close()
+
+    def testHasKeyWithInvalidIntegerKey(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        db[1] = 'one'
+        self.assertFalse(db.has_key('x'))
+        self.assertFalse('x' in db)
+        self.assertTrue('1' in db)
+        db.close()
+
+    def testIntegerKeysWithSetLocation(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        db[5] = 'five'
+        db[50] = 'fifty'
+        self.assertEqual((50, 'fifty'), db.set_location(6))
+        db.close()
+
+    def testIntegerKeysPopAndSetDefault(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        self.assertEqual('x', db.setdefault(1, 'x'))
+        self.assertEqual('x', db.pop(1))
+        self.assertEqual(0, len(db))
+        db.close()
+
+    def testUuidKeys(self):
+        if Esent.EsentVersion.SupportsVistaFeatures:
+            db = esedb.open(self._database, 'n', key_type=uuid.UUID)
+            k = uuid.uuid4()
+            db[k] = 'value'
+            self.assertEqual('value', db[k])
+            self.assertEqual([k], db.keys())
+            db.close()
+
+    def testDateTimeKeysAreInTimeOrder(self):
+        db = esedb.open(self._database, 'n', key_type=datetime.datetime)
+        keys = [datetime.datetime(2010, 1, 1), datetime.datetime(1999, 12, 31, 23, 59), datetime.datetime(2010, 1, 1, 0, 0, 1)]
+        for k in keys:
+            db[k] = 'value'
+        keys.sort()
+        self.assertEqual(keys, db.keys())
+        db.close()
+
+    def testTypedKeysAreRetrievedFromIndexes(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        db.create_index('value', lambda v: v)
+        for i in [3, -2**40, 7]:
+            db[i] = 'value'
+        self.assertEqual([-2**40, 3, 7], db.lookup('value', 'value'))
+        self.assertEqual([-2**40, 3, 7], list(db.iterkeys()))
+        db.close()
+
+    def testKeyTypeIsDetectedOnOpen(self):
+        db = esedb.open(self._database, 'n', key_type=int)
+        db[1] = 'one'
+        db.close()
+        db = esedb.open(self._database, 'r')
+        self.assertEqual([1], db.keys())
+        db.close()
+
+    def testInvalidKeyTypeRaisesError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', key_type=float)
+
+    def testOrdinalIntegerKeysRaiseError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', ordinal_keys=True, key_type=int)
+
+
+class EsedbRecordColumnsFixture(unittest.TestCase):
+    """Tests for databases created with typed record columns."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+        self._columns = [('name', str), ('count', int), ('ratio', float), ('flag', bool), ('when', datetime.datetime), ('data', bytearray)]
+        self._db = esedb.open(self._database, 'n', columns=self._columns)
+
+    def tearDown(self):
+        self._db.close()
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testSetAndRetrieveDictionary(self):
+        record = {
+            'name': 'alpha',
+            'count': 2**40,
+            'ratio': 0.5,
+            'flag': True,
+            'when': datetime.datetime(2010, 1, 2, 3, 4, 5),
+            'data': bytearray('\x00\xff'),
+            }
+        self._db['a'] = record
+        self.assertEqual(record, self._db['a'])
+
+    def testSetTupleAndRetrieveColumns(self):
+        when = datetime.datetime(2010, 1, 1)
+        self._db['a'] = ('alpha', 1, 1.5, False, when, bytearray('x'))
+        self.assertEqual(('alpha', 1, 1.5, False, when, bytearray('x')), self._db.get_columns('a'))
+        self.assertEqual((1.5, 'alpha'), self._db.get_columns('a', 'ratio', 'name'))
+
+    def testMissingColumnsAreNone(self):
+        self._db['a'] = {'count': 1}
+        self.assertEqual(None, self._db['a']['name'])
+        self.assertEqual((None, 1), self._db.get_columns('a', 'name', 'count'))
+
+    def testSetColumnsUpdatesOnlyTheGivenColumns(self):
+        self._db['a'] = {'name': 'alpha', 'count': 1}
+        self._db.set_columns('a', {'count': 2, 'flag': True})
+        self.assertEqual(('alpha', 2, True), self._db.get_columns('a', 'name', 'count', 'flag'))
+
+    def testSetColumnsChangesVersion(self):
+        self._db['a'] = {'count': 1}
+        (v, version) = self._db.get_with_version('a')
+        self._db.set_columns('a', {'count': 2})
+        self.assertNotEqual(version, self._db.get_with_version('a')[1])
+
+    def testSetColumnsOnMissingKeyRaisesKeyError(self):
+        self.assertRaises(KeyError, self._db.set_columns, 'a', {'count': 1})
+
+    def testUnknownColumnRaisesError(self):
+        self.assertRaises(EseDBError, self._db.__setitem__, 'a', {'nosuchcolumn': 1})
+        self._db['a'] = {'count': 1}
+        self.assertRaises(EseDBError, self._db.get_columns, 'a', 'nosuchcolumn')
+        self.assertRaises(EseDBError, self._db.set_columns, 'a', {'nosuchcolumn': 1})
+
+    def testWrongNumberOfValuesRaisesError(self):
+        self.assertRaises(EseDBError, self._db.__setitem__, 'a', ('alpha', 1))
+
+    def testInvalidValueRaisesError(self):
+        self.assertRaises(EseDBError, self._db.__setitem__, 'a', {'count': 'x'})
+
+    def testColumnsAreDetectedOnOpen(self):
+        self._db['a'] = ('alpha', 1, 1.5, False, None, None)
+        self._db.close()
+        self._db = esedb.open(self._database, 'w')
+        self.assertEqual([('a', {'name': 'alpha', 'count': 1, 'ratio': 1.5, 'flag': False, 'when': None, 'data': None})], self._db.items())
+        self.assertEqual(('alpha', 1, 1.5, False, None, None), self._db.get_columns('a'))
+
+    def testGetIntoRaisesError(self):
+        self._db['a'] = {'count': 1}
+        self.assertRaises(EseDBError, self._db.get_into, 'a', bytearray())
+
+    def testSetColumnsOnValueTableRaisesError(self):
+        self._db.close()
+        self._db = esedb.open(self._database, 'n')
+        self._db['a'] = 'value'
+        self.assertRaises(EseDBError, self._db.set_columns, 'a', {'count': 1})
+
+    def testInvalidColumnDeclarationsRaiseError(self):
+        path = self._makeDatabasePath('invalid.edb')
+        self.assertRaises(EseDBError, esedb.open, path, 'n', columns=[])
+        self.assertRaises(EseDBError, esedb.open, path, 'n', columns=[('a b', str)])
+        self.assertRaises(EseDBError, esedb.open, path, 'n', columns=[('a', complex)])
+        self.assertRaises(EseDBError, esedb.open, path, 'n', columns=[('a', str), ('a', int)])
+        self.assertRaises(EseDBError, esedb.open, path, 'n', binary_values=True, columns=[('a', str)])
+        self.assertRaises(EseDBError, esedb.open, path, 'n', columns=[('a' * 60, str)])
+
+    def testLongestColumnName(self):
+        name = 'a' * 59
+        db = esedb.open(self._makeDatabasePath('long.edb'), 'n', columns=[(name, str)])
+        db['a'] = {name: 'value'}
+        self.assertEqual({name: 'value'}, db['a'])
+        db.close()
+
+class EsedbNamedTablesFixture(unittest.TestCase):
+    """Tests for named tables stored in the same database."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+        self._db = esedb.open(self._database, 'n')
+
+    def tearDown(self):
+        self._db.close()
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testTablesAreIndependent(self):
+        t = self._db.table('other')
+        try:
+            self._db['a'] = 'default'
+            t['a'] = 'other'
+            t['b'] = 'other'
+            self.assertEqual('default', self._db['a'])
+            self.assertEqual('other', t['a'])
+            self.assertEqual(1, len(self._db))
+            self.assertEqual(2, len(t))
+            t.clear()
+            self.assertEqual(0, len(t))
+            self.assertEqual(['a'], self._db.keys())
+        finally:
+            t.close()
+
+    def testTableIsReopened(self):
+        t = self._db.table('other')
+        t['a'] = 'other'
+        t.close()
+        self._db.close()
+        self._db = esedb.open(self._database, 'r')
+        t = self._db.table('other')
+        try:
+            self.assertEqual([('a', 'other')], t.items())
+        finally:
+            t.close()
+
+    def testTableOptionsAreDetectedOnOpen(self):
+        t = self._db.table('numbers', key_type=int, columns=[('count', int)])
+        t[2] = (1,)
+        t.close()
+        t = self._db.table('numbers')
+        try:
+            self.assertEqual([2], t.keys())
+            self.assertEqual((1,), t.get_columns(2))
+        finally:
+            t.close()
+
+    def testScanOfTable(self):
+        t = self._db.table('other')
+        try:
+            t['a'] = 'other'
+            self._db['b'] = 'default'
+            self.assertEqual([('a', 'other')], list(t.scan()))
+        finally:
+            t.close()
+
+    def testDatabaseStaysOpenUntilTableIsClosed(self):
+        t = self._db.table('other')
+        self._db.close()
+        try:
+            t['a'] = 'other'
+            self.assertEqual('other', t['a'])
+        finally:
+            t.close()
+        self._db = esedb.open(self._database, 'w')
+        self.assertEqual(0, len(self._db))
+
+    def testMissingTableInReadOnlyDatabaseRaisesError(self):
+        self._db.close()
+        self._db = esedb.open(self._database, 'r')
+        self.assertRaises(EseDBError, self._db.table, 'other')
+
+    def testInvalidTableNameRaisesError(self):
+        self.assertRaises(EseDBError, self._db.table, 'no spaces')
+        self.assertRaises(EseDBError, self._db.table, '')
+
+class EsedbSecondaryIndexFixture(unittest.TestCase):
+    """Tests for secondary indexes over values."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+        self._db = esedb.open(self._database, 'n')
+
+    def tearDown(self):
+        self._db.close()
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testIndexIsBuiltFromExistingRecords(self):
+        for i in xrange(100):
+            self._db['%d' % i] = 'x' * (i % 10)
+        self._db.create_index('length', len, int)
+        self.assertEqual(sorted(['%d' % i for i in xrange(3, 100, 10)]), self._db.lookup('length', 3))
+        self.assertEqual(20, len(self._db.index_range('length', 8)))
+
+    def testIndexIsMaintainedOnWrites(self):
+        self._db.create_index('length', len, int)
+        self._db['a'] = 'aa'
+        self._db.update({'b': 'bb', 'c': 'ccc'})
+        self._db.setdefault('d', 'dd')
+        self.assertEqual(['a', 'b', 'd'], self._db.lookup('length', 2))
+        self._db['a'] = 'aaaa'
+        self._db.pop('b')
+        del self._db['d']
+        self.assertEqual([], self._db.lookup('length', 2))
+        self.assertEqual(['c', 'a'], self._db.index_range('length', 3, 4))
+
+    def testIndexRangeIsOrderedByIndexValue(self):
+        self._db.create_index('reversed', lambda v: v[::-1])
+        self._db['a'] = 'xa'
+        self._db['b'] = 'ab'
+        self._db['c'] = 'yc'
+        self.assertEqual(['a', 'b', 'c'], self._db.index_range('reversed', 'a', 'b'))
+        self.assertEqual(['c'], self._db.index_range('reversed', 'c'))
+        self.assertEqual(['a', 'b'], self._db.index_range('reversed', hi='bz'))
+
+    def testNoneIsNotIndexed(self):
+        self._db.create_index('number', lambda v: v if v.isdigit() else None, int)
+        self._db['a'] = '1'
+        self._db['b'] = 'x'
+        self.assertEqual(['a'], self._db.index_range('number'))
+
+    def testIndexSeesOtherCursors(self):
+        other = esedb.open(self._database, 'w')
+        try:
+            self._db.create_index('length', len, int)
+            other['a'] = 'aa'
+            self.assertEqual(['a'], self._db.lookup('length', 2))
+        finally:
+            other.close()
+
+    def testIndexIsDetectedOnOpen(self):
+        self._db.create_index('length', len, int)
+        self._db['a'] = 'aa'
+        self._db.close()
+        self._db = esedb.open(self._database, 'w', indexes={'length': (len, int)})
+        self.assertEqual(['a'], self._db.lookup('length', 2))
+        self._db['b'] = 'bb'
+        self.assertEqual(['a', 'b'], self._db.lookup('length', 2))
+
+    def testOpenForWritingWithoutExtractorRaisesError(self):
+        self._db.create_index('length', len, int)
+        self._db['a'] = 'aa'
+        self._db.close()
+        self.assertRaises(EseDBError, esedb.open, self._database, 'w')
+        self._db = esedb.open(self._database, 'r')
+        self.assertEqual(['a'], self._db.lookup('length', 2))
+
+    def testIndexesOptionCreatesIndex(self):
+        self._db['a'] = 'aa'
+        self._db.close()
+        self._db = esedb.open(self._database, 'w', indexes={'length': (len, int)})
+        self.assertEqual(['a'], self._db.lookup('length', 2))
+
+    def testIndexesOptionOfTable(self):
+        t = self._db.table('other', indexes={'length': (len, int)})
+        t['a'] = 'aa'
+        t.close()
+        t = self._db.table('other', indexes={'length': (len, int)})
+        self.assertEqual(['a'], t.lookup('length', 2))
+        t.close()
+
+    def testInvalidIndexesOptionRaisesError(self):
+        self._db.close()
+        self.assertRaises(EseDBError, esedb.open, self._database, 'w', indexes={'length': len})
+        self.assertRaises(EseDBError, esedb.open, self._database, 'r', indexes={'length': (len, int)})
+        self._db = esedb.open(self._database, 'w')
+
+    def testBuildingIndexDoesNotChangeVersions(self):
+        self._db['a'] = 'aa'
+        (_, version) = self._db.get_with_version('a')
+        self._db.create_index('length', len, int)
+        self.assertEqual(None, self._db.get_if_changed('a', version))
+
+    def testIndexOnRecordColumns(self):
+        self._db.close()
+        self._db = esedb.open(self._database, 'n', columns=[('name', str), ('count', int)])
+        self._db.create_index('count', lambda r: r['count'], int)
+        self._db['a'] = ('alpha', 1)
+        self._db['b'] = ('beta', 2)
+        self._db.set_columns('a', {'count': 2})
+        self.assertEqual(['a', 'b'], self._db.lookup('count', 2))
+
+    def testExtractorErrorRollsBackWrite(self):
+        self._db.create_index('length', len, int)
+        self._db['a'] = 'aa'
+        self.assertRaises(TypeError, self._db.__setitem__, 'a', None)
+        self.assertEqual('aa', self._db['a'])
+
+    def testIndexWithDifferentTypeRaisesError(self):
+        self._db.create_index('length', len, int)
+        self.assertRaises(EseDBError, self._db.create_index, 'length', len, str)
+
+    def testUnknownIndexRaisesError(self):
+        self.assertRaises(EseDBError, self._db.lookup, 'length', 2)
+        self.assertRaises(EseDBError, self._db.index_range, 'length')
+
+class EsedbCompressionFixture(unittest.TestCase):
+    """Tests for databases which compress values."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testCompressedTextValuesRoundTrip(self):
+        db = esedb.open(self._database, 'n', compression=6)
+        value = u'\u0391\u0392 some text ' * 100
+        db['a'] = value
+        db['b'] = 'short'
+        db['c'] = None
+        self.assertEqual(value, db['a'])
+        self.assertEqual('short', db['b'])
+        self.assertEqual(None, db['c'])
+        self.assertEqual([('a', value), ('b', 'short'), ('c', None)], db.items())
+        db.close()
+
+    def testCompressedBinaryValuesRoundTrip(self):
+        db = esedb.open(self._database, 'n', binary_values=True, compression=9, compression_threshold=0)
+        value = '\x00\xff' * 1000
+        db['a'] = value
+        self.assertEqual(value, db['a'])
+        db.close()
+
+    def testCompressedAndUncompressedValuesMix(self):
+        db = esedb.open(self._database, 'n')
+        db['a'] = 'x' * 1000
+        db.close()
+        db = esedb.open(self._database, 'w', compression=1)
+        db['b'] = 'y' * 1000
+        db.close()
+        db = esedb.open(self._database, 'r')
+        self.assertEqual([('a', 'x' * 1000), ('b', 'y' * 1000)], db.items())
+        db.close()
+
+    def testReplacingCompressedValue(self):
+        db = esedb.open(self._database, 'n', compression=6)
+        db['a'] = 'x' * 1000
+        db['a'] = 'short'
+        self.assertEqual('short', db['a'])
+        db['a'] = None
+        self.assertEqual(None, db['a'])
+        db.close()
+
+    def testGetIntoDecompressesValue(self):
+        db = esedb.open(self._database, 'n', binary_values=True, compression=6)
+        db['a'] = 'x' * 1000
+        b = bytearray()
+        self.assertEqual(1000, db.get_into('a', b))
+        self.assertEqual(bytearray('x' * 1000), b)
+        a = System.Array.CreateInstance(System.Byte, 10)
+        self.assertEqual(1000, db.get_into('a', a))
+        self.assertEqual(ord('x'), a[9])
+        db.close()
+
+    def testInvalidCompressionLevelRaisesError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', compression=0)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', compression=10)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', compression=1, columns=[('a', str)])
+
+class EsedbInlineValuesFixture(unittest.TestCase):
+    """Tests for databases which keep small values in the record."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testSmallAndLargeTextValues(self):
+        db = esedb.open(self._database, 'n', inline_threshold=64)
+        db['a'] = 'x' * 32
+        db['b'] = 'y' * 33
+        db['c'] = ''
+        db['d'] = None
+        self.assertEqual([('a', 'x' * 32), ('b', 'y' * 33), ('c', ''), ('d', None)], db.items())
+        db.close()
+
+    def testSmallAndLargeBinaryValues(self):
+        db = esedb.open(self._database, 'n', binary_values=True, inline_threshold=255)
+        db['a'] = '\xff' * 255
+        db['b'] = '\xff' * 256
+        self.assertEqual('\xff' * 255, db['a'])
+        self.assertEqual('\xff' * 256, db['b'])
+        db.close()
+
+    def testValueMovesBetweenColumns(self):
+        db = esedb.open(self._database, 'n', inline_threshold=100)
+        db['a'] = 'small'
+        db['a'] = 'large' * 100
+        self.assertEqual('large' * 100, db['a'])
+        db['a'] = 'small'
+        self.assertEqual('small', db['a'])
+        db.close()
+
+    def testGetIntoSmallValue(self):
+        db = esedb.open(self._database, 'n', binary_values=True, inline_threshold=100)
+        db['a'] = 'abc'
+        b = bytearray()
+        self.assertEqual(3, db.get_into('a', b))
+        self.assertEqual(bytearray('abc'), b)
+        db.close()
+
+    def testThresholdIsDetectedOnOpen(self):
+        db = esedb.open(self._database, 'n', inline_threshold=101)
+        db['a'] = 'x' * 50
+        db.close()
+        db = esedb.open(self._database, 'w')
+        db['b'] = 'y' * 51
+        self.assertEqual([('a', 'x' * 50), ('b', 'y' * 51)], db.items())
+        db.close()
+
+    def testInlineValuesWithCompression(self):
+        db = esedb.open(self._database, 'n', inline_threshold=100, compression=6)
+        db['a'] = 'small'
+        db['b'] = 'large' * 100
+        self.assertEqual([('a', 'small'), ('b', 'large' * 100)], db.items())
+        db.close()
+
+    def testInvalidThresholdRaisesError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', inline_threshold=256)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', inline_threshold=1)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', inline_threshold=10, columns=[('a', str)])
+
+class EsedbHashedKeysFixture(unittest.TestCase):
+    """Tests for databases which index a hash of the keys."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testLongKeysWithCommonPrefix(self):
+        db = esedb.open(self._database, 'n', hashed_keys=True)
+        prefix = 'x' * 1024 * 1024
+        db[prefix + 'a'] = 'a'
+        db[prefix + 'b'] = 'b'
+        self.assertEqual('a', db[prefix + 'a'])
+        self.assertEqual('b', db[prefix + 'b'])
+        self.assertFalse(db.has_key(prefix + 'c'))
+        del db[prefix + 'a']
+        self.assertEqual([prefix + 'b'], db.keys())
+        db.close()
+
+    def testKeysAreOrderedByPrefix(self):
+        db = esedb.open(self._database, 'n', hashed_keys=True)
+        for k in ['c', 'a', 'b']:
+            db[k] = k
+        self.assertEqual(['a', 'b', 'c'], db.keys())
+        self.assertEqual(('b', 'b'), db.set_location('b'))
+        db.close()
+
+    def testKeysAreCaseSensitive(self):
+        db = esedb.open(self._database, 'n', hashed_keys=True)
+        db['a'] = 'lower'
+        db['A'] = 'upper'
+        self.assertEqual('lower', db['a'])
+        self.assertEqual('upper', db['A'])
+        self.assertEqual(2, len(db))
+        db.close()
+
+    def testUnorderedKeys(self):
+        db = esedb.open(self._database, 'n', unordered_keys=True)
+        for i in xrange(100):
+            db['key%d' % i] = str(i)
+        self.assertEqual('42', db['key42'])
+        self.assertEqual(sorted('key%d' % i for i in xrange(100)), sorted(db.keys()))
+        self.assertRaises(EseDBError, db.set_location, 'key1')
+        db.close()
+
+    def testKeyModeIsDetectedOnOpen(self):
+        db = esedb.open(self._database, 'n', unordered_keys=True)
+        db['a'] = 'x'
+        db.close()
+        db = esedb.open(self._database, 'w')
+        db['b'] = 'y'
+        self.assertEqual('x', db['a'])
+        self.assertEqual('y', db['b'])
+        self.assertRaises(EseDBError, db.set_location, 'a')
+        db.close()
+
+    def testHashedTable(self):
+        db = esedb.open(self._database, 'n')
+        t = db.table('hashed', hashed_keys=True)
+        t['x' * 1000] = 'value'
+        self.assertEqual('value', t['x' * 1000])
+        db.close()
+
+    def testInvalidHashedKeysRaisesError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', hashed_keys=True, key_type=int)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', unordered_keys=True, ordinal_keys=True)
+
+class EsedbSpaceFixture(unittest.TestCase):
+    """Tests for the table density and space allocation options."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testPresets(self):
+        for space in ['append', 'random']:
+            db = esedb.open(self._database, 'n', space=space)
+            db['a'] = 'value'
+            self.assertEqual('value', db['a'])
+            db.close()
+
+    def testInitialPagesAreAllocated(self):
+        db = esedb.open(self._database, 'n', initial_pages=256, density=90, growth=512)
+        (owned, available) = db.space_usage()
+        self.assertTrue(owned >= 256)
+        self.assertTrue(owned >= available)
+        db.close()
+
+    def testGrowthOfExistingDatabase(self):
+        db = esedb.open(self._database, 'n')
+        db.close()
+        db = esedb.open(self._database, 'w', growth=2048)
+        db.update(('%d' % i, 'x' * 100) for i in xrange(1000))
+        self.assertEqual(1000, len(db))
+        db.close()
+
+    def testTableSpaceOptions(self):
+        db = esedb.open(self._database, 'n')
+        t = db.table('random', space='random', initial_pages=128)
+        t['a'] = 'value'
+        self.assertTrue(t.space_usage()[0] >= 128)
+        t.close()
+        db.close()
+
+    def testInvalidSpaceOptionsRaiseError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', space='sequential')
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', initial_pages=0)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', density=19)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', density=101)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', growth=0)
+
+class EsedbDedupFixture(unittest.TestCase):
+    """Tests for databases which store each distinct value once."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testSharedValues(self):
+        db = esedb.open(self._database, 'n', dedup=True)
+        shared = 'shared' * 1000
+        for k in ['a', 'b', 'c']:
+            db[k] = shared
+        db['b'] = 'other'
+        del db['c']
+        self.assertEqual([('a', shared), ('b', 'other')], db.items())
+        db['c'] = shared
+        self.assertEqual(shared, db['c'])
+        db.close()
+
+    def testDigestIsSha256OfBytes(self):
+        data = ''.join(chr(i) for i in range(256)) * 4
+        digest = esedb._BlobStore.digest(System.Array[System.Byte]([ord(c) for c in data]))
+        self.assertEqual(hashlib.sha256(data).digest(), ''.join(chr(b) for b in digest))
+
+    def testRewriteSameValue(self):
+        db = esedb.open(self._database, 'n', dedup=True)
+        db['a'] = 'value'
+        db['a'] = 'value'
+        db['b'] = 'value'
+        del db['b']
+        self.assertEqual('value', db['a'])
+        db.close()
+
+    def testNoneAndEmptyValues(self):
+        db = esedb.open(self._database, 'n', dedup=True)
+        db['a'] = 'x'
+        db['a'] = None
+        db['b'] = ''
+        self.assertEqual([('a', None), ('b', '')], db.items())
+        db.close()
+
+    def testBinaryValues(self):
+        db = esedb.open(self._database, 'n', binary_values=True, dedup=True)
+        db['a'] = '\x00\xff' * 100
+        db['b'] = '\x00\xff' * 100
+        self.assertEqual('\x00\xff' * 100, db['b'])
+        b = bytearray()
+        self.assertEqual(200, db.get_into('a', b))
+        self.assertEqual(bytearray('\x00\xff' * 100), b)
+        db.close()
+
+    def testClear(self):
+        db = esedb.open(self._database, 'n', dedup=True)
+        db['a'] = 'value'
+        db['b'] = 'value'
+        db.clear()
+        db['c'] = 'value'
+        self.assertEqual([('c', 'value')], db.items())
+        db.close()
+
+    def testDedupIsDetectedOnOpen(self):
+        db = esedb.open(self._database, 'n', dedup=True)
+        db['a'] = 'value'
+        db.close()
+        db = esedb.open(self._database, 'w')
+        db['b'] = 'value'
+        del db['a']
+        self.assertEqual('value', db['b'])
+        db.close()
+
+    def testDedupWithInlineValuesAndCompression(self):
+        db = esedb.open(self._database, 'n', dedup=True, inline_threshold=20, compression=6)
+        values = ['small', 'abc' * 1000, 'x' * 100]
+        for (i, v) in enumerate(values):
+            db['%d' % i] = v
+        self.assertEqual(values, db.values())
+        db.close()
+
+    def testTablesShareStoredValues(self):
+        db = esedb.open(self._database, 'n', dedup=True)
+        t = db.table('other', dedup=True)
+        db['a'] = 'value'
+        t['a'] = 'value'
+        del db['a']
+        self.assertEqual('value', t['a'])
+        t.close()
+        db.close()
+
+    def testDedupWithColumnsRaisesError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', dedup=True, columns=[('a', str)])
+
+class EsedbExternalValuesFixture(unittest.TestCase):
+    """Tests for databases which keep large values in side files."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+        self._filesDirectory = Path.Combine(self._database + '.files', 'esedb_data')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def _countFiles(self):
+        if not Directory.Exists(self._filesDirectory):
+            return 0
+        return len(Directory.GetFiles(self._filesDirectory))
+
+    def testLargeValuesGoToSideFiles(self):
+        db = esedb.open(self._database, 'n', external_threshold=1000)
+        db['a'] = 'x' * 1000
+        db['b'] = 'small'
+        self.assertEqual(1, self._countFiles())
+        self.assertEqual([('a', 'x' * 1000), ('b', 'small')], db.items())
+        db.close()
+
+    def testReplacedAndDeletedValuesRemoveFiles(self):
+        db = esedb.open(self._database, 'n', external_threshold=1000)
+        db['a'] = 'x' * 1000
+        db['a'] = 'y' * 1000
+        self.assertEqual(1, self._countFiles())
+        self.assertEqual('y' * 1000, db['a'])
+        db['a'] = 'small'
+        self.assertEqual(0, self._countFiles())
+        db['a'] = 'z' * 1000
+        del db['a']
+        self.assertEqual(0, self._countFiles())
+        db.close()
+
+    def testRollbackRemovesFile(self):
+        db = esedb.open(self._database, 'n', binary_values=True, external_threshold=1000)
+        self.assertRaises(EseDBError, db.update, [('a', 'x' * 2000), ('b', u'\u1234')])
+        self.assertFalse(db.has_key('a'))
+        self.assertEqual(0, self._countFiles())
+        db.close()
+
+    def testGetInto(self):
+        db = esedb.open(self._database, 'n', binary_values=True, external_threshold=1000)
+        db['a'] = '\xff' * 2000
+        buffer = System.Array.CreateInstance(System.Byte, 10)
+        self.assertEqual(2000, db.get_into('a', buffer))
+        self.assertEqual(255, buffer[9])
+        b = bytearray()
+        self.assertEqual(2000, db.get_into('a', b))
+        self.assertEqual(bytearray('\xff' * 2000), b)
+        db.close()
+
+    def testReplacedFileIsKeptForOlderTransactions(self):
+        db = esedb.open(self._database, 'n', external_threshold=1000)
+        db['a'] = 'x' * 1000
+        other = esedb.open(self._database)
+        tx = other.transaction()
+        self.assertEqual('x' * 1000, other['a'])
+        db['a'] = 'y' * 1000
+        self.assertEqual('y' * 1000, db['a'])
+        # The transaction still sees the old value, so its file is kept
+        self.assertEqual(2, self._countFiles())
+        self.assertEqual('x' * 1000, other['a'])
+        tx.commit()
+        self.assertEqual(1, self._countFiles())
+        self.assertEqual('y' * 1000, other['a'])
+        other.close()
+        db.close()
+
+    def testClosingCursorInTransactionReleasesFiles(self):
+        db = esedb.open(self._database, 'n', external_threshold=1000)
+        db['a'] = 'x' * 1000
+        other = esedb.open(self._database)
+        other.transaction()
+        db['a'] = 'y' * 1000
+        self.assertEqual(2, self._countFiles())
+        other.close()
+        self.assertEqual(1, self._countFiles())
+        db.close()
+
+    def testOrphanedFilesAreDeletedOnOpen(self):
+        db = esedb.open(self._database, 'n', external_threshold=1000)
+        db['a'] = 'x' * 1000
+        db.close()
+        File.WriteAllText(Path.Combine(self._filesDirectory, 'orphan'), 'orphan')
+        db = esedb.open(self._database, 'w')
+        self.assertEqual(1, self._countFiles())
+        self.assertEqual('x' * 1000, db['a'])
+        db.close()
+
+    def testValuesAreReadWithoutThreshold(self):
+        db = esedb.open(self._database, 'n', external_threshold=1000)
+        db['a'] = 'x' * 1000
+        db.close()
+        db = esedb.open(self._database, 'w')
+        self.assertEqual('x' * 1000, db['a'])
+        db['a'] = 'y' * 1000
+        self.assertEqual(0, self._countFiles())
+        self.assertEqual('y' * 1000, db['a'])
+        db.close()
+
+    def testExternalValuesInTable(self):
+        db = esedb.open(self._database, 'n', external_threshold=1000)
+        t = db.table('other')
+        t['a'] = 'x' * 1000
+        self.assertEqual('x' * 1000, t['a'])
+        self.assertEqual(1, len(Directory.GetFiles(Path.Combine(self._database + '.files', 'esedb_table_other'))))
+        t.close()
+        db.close()
+
+    def testInvalidThresholdRaisesError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', external_threshold=0)
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', external_threshold=1000, columns=[('a', str)])
+
+class EsedbTupleKeysFixture(unittest.TestCase):
+    """Tests for databases with tuple keys."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testTupleKey(self):
+        db = esedb.open(self._database, 'n', key_type=(str, int, str))
+        db[('tenant', 42, 'name')] = 'value'
+        self.assertEqual('value', db[('tenant', 42, 'name')])
+        self.assertTrue(db.has_key(['tenant', '42', 'name']))
+        self.assertFalse(db.has_key(('tenant', 42, 'other')))
+        self.assertEqual([('tenant', 42, 'name')], db.keys())
+        del db[('tenant', 42, 'name')]
+        self.assertRaises(KeyError, db.__getitem__, ('tenant', 42, 'name'))
+        db.close()
+
+    def testComponentsSortByType(self):
+        db = esedb.open(self._database, 'n', key_type=(str, int))
+        keys = [('b', 1), ('a', 100), ('a', -5), ('a', 9), ('a', 10)]
+        for k in keys:
+            db[k] = 'x'
+        self.assertEqual(sorted(keys), db.keys())
+        db.close()
+
+    def testPrefixQueries(self):
+        db = esedb.open(self._database, 'n', key_type=(str, int, str))
+        for t in ['a', 'ab', 'b']:
+            for i in [1, 2]:
+                db[(t, i, 'x')] = '%s%d' % (t, i)
+        self.assertEqual([('a', 1, 'x'), ('a', 2, 'x')], db.prefix_keys(('a',)))
+        self.assertEqual([(('ab', 2, 'x'), 'ab2')], db.prefix_items(('ab', 2)))
+        self.assertEqual([(('b', 1, 'x'), 'b1')], db.prefix_items(('b', 1, 'x')))
+        self.assertEqual([], db.prefix_keys(('c',)))
+        self.assertEqual([], db.prefix_keys(('a', 3)))
+        # The index range doesn't limit later moves
+        self.assertEqual(('a', 1, 'x'), db.first()[0])
+        self.assertEqual(('b', 2, 'x'), db.last()[0])
+        db.close()
+
+    def testSetLocationWithPrefix(self):
+        db = esedb.open(self._database, 'n', key_type=(str, int))
+        db[('a', 1)] = 'a1'
+        db[('b', 5)] = 'b5'
+        self.assertEqual((('b', 5), 'b5'), db.set_location(('b',)))
+        db.close()
+
+    def testWrongNumberOfComponentsRaisesError(self):
+        db = esedb.open(self._database, 'n', key_type=(str, int))
+        self.assertRaises(EseDBError, db.__setitem__, ('a',), 'x')
+        self.assertRaises(EseDBError, db.__setitem__, ('a', 1, 2), 'x')
+        self.assertRaises(EseDBError, db.__getitem__, 'a')
+        self.assertRaises(EseDBError, db.prefix_keys, ())
+        db.close()
+
+    def testKeyTypeIsDetectedOnOpen(self):
+        db = esedb.open(self._database, 'n', key_type=(int, str))
+        db[(1, 'a')] = 'x'
+        db.close()
+        db = esedb.open(self._database, 'w')
+        db[(2, 'b')] = 'y'
+        self.assertEqual([(1, 'a'), (2, 'b')], db.keys())
+        db.close()
+
+    def testPrefixQueriesNeedTupleKeys(self):
+        db = esedb.open(self._database, 'n')
+        self.assertRaises(EseDBError, db.prefix_keys, ('a',))
+        db.close()
+
+    def testInvalidKeyTypeRaisesError(self):
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', key_type=(str,))
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', key_type=(str, float))
+        self.assertRaises(EseDBError, esedb.open, self._database, 'n', key_type=(str, int), hashed_keys=True)
+
+class EsedbCountersFixture(unittest.TestCase):
+    """Tests for escrow counters."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+
+    def tearDown(self):
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testIncr(self):
+        db = esedb.open(self._database, 'n')
+        self.assertEqual(1, db.incr('a'))
+        self.assertEqual(6, db.incr('a', 5))
+        self.assertEqual(4, db.incr('a', -2))
+        self.assertEqual(4, db.counter('a'))
+        db.close()
+
+    def testIncrOverflowRaisesError(self):
+        db = esedb.open(self._database, 'n')
+        self.assertEqual(2**31 - 1, db.incr('a', 2**31 - 1))
+        self.assertRaises(EseDBError, db.incr, 'a')
+        self.assertEqual(2**31 - 1, db.counter('a'))
+        self.assertEqual(-2**31, db.incr('b', -2**31))
+        self.assertRaises(EseDBError, db.incr, 'b', -1)
+        self.assertEqual(-2**31, db.counter('b'))
+        db.close()
+
+    def testIncrWithInvalidDeltaRaisesError(self):
+        db = esedb.open(self._database, 'n')
+        self.assertRaises(EseDBError, db.incr, 'a', 2**31)
+        self.assertRaises(EseDBError, db.incr, 'a', -2**31 - 1)
+        self.assertRaises(EseDBError, db.incr, 'a', 1.5)
+        self.assertFalse(db.has_key('a'))
+        db.close()
+
+    def testCounterOfMissingKeyIsZero(self):
+        db = esedb.open(self._database, 'n')
+        self.assertEqual(0, db.counter('a'))
+        self.assertFalse(db.has_key('a'))
+        db.close()
+
+    def testIncrInsertsRecord(self):
+        db = esedb.open(self._database, 'n')
+        db.incr('a', 3)
+        self.assertEqual(None, db['a'])
+        db.close()
+
+    def testCounterIsSeparateFromValue(self):
+        db = esedb.open(self._database, 'n')
+        db['a'] = 'value'
+        db.incr('a')
+        self.assertEqual('value', db['a'])
+        db['a'] = 'other'
+        self.assertEqual(1, db.counter('a'))
+        del db['a']
+        self.assertEqual(0, db.counter('a'))
+        db.close()
+
+    def testIncrOnRecordTable(self):
+        db = esedb.open(self._database, 'n', columns=[('name', str), ('count', int)])
+        self.assertEqual(2, db.incr('a', 2))
+        self.assertEqual({'name': None, 'count': None}, db['a'])
+        db.close()
+
+    def testIncrDoesNotCallExtractors(self):
+        db = esedb.open(self._database, 'n')
+        values = []
+        db.create_index('length', lambda v: values.append(v) or len(v), int)
+        db.incr('a')
+        self.assertEqual([], values)
+        self.assertEqual([], db.lookup('length', 0))
+        db['a'] = 'xyz'
+        self.assertEqual(['a'], db.lookup('length', 3))
+        db.close()
+
+    def testCounterIsPersisted(self):
+        db = esedb.open(self._database, 'n')
+        db.incr(1, 7)
+        db.close()
+        db = esedb.open(self._database, 'r')
+        self.assertEqual(7, db.counter(1))
+        db.close()
+
+    def testMultiThreadedIncr(self):
+        db = esedb.open(self._database, 'n')
+        threads = [threading.Thread(target = self._incrKeys, args = (1000,)) for x in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for k in ['a', 'b', 'c']:
+            self.assertEqual(4000, db.counter(k))
+        db.close()
+
+    def _incrKeys(self, n):
+        db = esedb.open(self._database)
+        for i in xrange(n):
+            for k in ['a', 'b', 'c']:
+                db.incr(k)
+        db.close()
+
+class EsedbConditionalWritesFixture(unittest.TestCase):
+    """Tests for compare-and-swap and the other conditional writes."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+        self._db = esedb.open(self._database, 'n')
+
+    def tearDown(self):
+        self._db.close()
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testCas(self):
+        self._db['a'] = 'x'
+        self.assertTrue(self._db.cas('a', 'x', 'y'))
+        self.assertEqual('y', self._db['a'])
+        self.assertFalse(self._db.cas('a', 'x', 'z'))
+        self.assertEqual('y', self._db['a'])
+
+    def testCasComparesStoredValue(self):
+        self._db['a'] = 1
+        self.assertTrue(self._db.cas('a', 1, 2))
+        self.assertTrue(self._db.cas('a', '2', 3))
+        self.assertEqual('3', self._db['a'])
+
+    def testCasNoneValue(self):
+        self._db['a'] = None
+        self.assertFalse(self._db.cas('a', 'None', 'x'))
+        self.assertTrue(self._db.cas('a', None, 'x'))
+        self.assertTrue(self._db.cas('a', 'x', None))
+        self.assertEqual(None, self._db['a'])
+
+    def testCasMissingKey(self):
+        self.assertFalse(self._db.cas('a', None, 'x'))
+        self.assertFalse(self._db.has_key('a'))
+
+    def testCasByVersion(self):
+        self._db['a'] = 'x'
+        (v, version) = self._db.get_with_version('a')
+        self.assertTrue(self._db.cas('a', version, 'y', by_version=True))
+        self.assertFalse(self._db.cas('a', version, 'z', by_version=True))
+        self.assertEqual('y', self._db['a'])
+
+    def testPutIfAbsent(self):
+        self.assertTrue(self._db.put_if_absent('a', 'x'))
+        self.assertFalse(self._db.put_if_absent('a', 'y'))
+        self.assertEqual('x', self._db['a'])
+        self.assertEqual(1, len(self._db))
+
+    def testDeleteIf(self):
+        self._db['a'] = 'x'
+        self.assertFalse(self._db.delete_if('a', 'y'))
+        self.assertTrue(self._db.has_key('a'))
+        self.assertTrue(self._db.delete_if('a', 'x'))
+        self.assertFalse(self._db.has_key('a'))
+        self.assertFalse(self._db.delete_if('a', 'x'))
+
+    def testDeleteIfByVersion(self):
+        self._db['a'] = 'x'
+        (v, version) = self._db.get_with_version('a')
+        self._db['a'] = 'y'
+        self.assertFalse(self._db.delete_if('a', version, by_version=True))
+        (v, version) = self._db.get_with_version('a')
+        self.assertTrue(self._db.delete_if('a', version, by_version=True))
+        self.assertEqual(0, len(self._db))
+
+    def testMultiThreadedCas(self):
+        self._db['a'] = 0
+        threads = [threading.Thread(target = self._casIncrement, args = (250,)) for x in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual('1000', self._db['a'])
+
+    def _casIncrement(self, n):
+        db = esedb.open(self._database)
+        for i in xrange(n):
+            while True:
+                v = db['a']
+                if db.cas('a', v, int(v) + 1):
+                    break
+        db.close()
+
+    def testTransform(self):
+        self._db['a'] = 'abc'
+        self.assertEqual('abcd', self._db.transform('a', lambda v: v + 'd'))
+        self.assertEqual('abcd', self._db['a'])
+
+    def testTransformReturnsStoredValue(self):
+        self._db['a'] = 1
+        self.assertEqual('2', self._db.transform('a', lambda v: int(v) + 1))
+
+    def testTransformMissingKeyUsesDefault(self):
+        self.assertEqual('1', self._db.transform('a', lambda v: int(v) + 1, default=0))
+        self.assertEqual('1', self._db['a'])
+
+    def testTransformMissingKeyRaisesKeyError(self):
+        self.assertRaises(KeyError, self._db.transform, 'a', lambda v: v)
+        self.assertFalse(self._db.has_key('a'))
+
+    def testTransformRetriesWhenRecordChanges(self):
+        self._db['a'] = 'x'
+        calls = []
+        def fn(v):
+            calls.append(v)
+            if 1 == len(calls):
+                # Simulate a concurrent writer
+                db = esedb.open(self._database)
+                db['a'] = 'y'
+                db.close()
+            return v + '!'
+        self.assertEqual('y!', self._db.transform('a', fn))
+        self.assertEqual(['x', 'y'], calls)
+
+    def testMultiThreadedTransform(self):
+        self._db['a'] = 0
+        threads = [threading.Thread(target = self._transformIncrement, args = (250,)) for x in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual('1000', self._db['a'])
+
+    def _transformIncrement(self, n):
+        db = esedb.open(self._database)
+        for i in xrange(n):
+            db.transform('a', lambda v: int(v) + 1)
+        db.close()
+
+class EsedbTransactionFixture(unittest.TestCase):
+    """Tests for explicit transactions."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+        self._db = esedb.open(self._database, 'n')
+
+    def tearDown(self):
+        self._db.close()
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testCommit(self):
+        with self._db.transaction():
+            self._db['a'] = 'x'
+            self._db['b'] = 'y'
+        self.assertEqual([('a', 'x'), ('b', 'y')], self._db.items())
+
+    def testRollbackOnException(self):
+        self._db['a'] = 'x'
+        try:
+            with self._db.transaction():
+                self._db['a'] = 'y'
+                del self._db['a']
+                self._db['b'] = 'z'
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual([('a', 'x')], self._db.items())
+        self.assertEqual(1, len(self._db))
+
+    def testReadsSeeWritesOfTransaction(self):
+        with self._db.transaction():
+            self._db['a'] = 'x'
+            self.assertEqual('x', self._db['a'])
+            self.assertEqual(1, len(self._db))
+            del self._db['a']
+            self.assertFalse(self._db.has_key('a'))
+
+    def testOtherCursorsDontSeeUncommittedWrites(self):
+        other = esedb.open(self._database)
+        tx = self._db.transaction()
+        self._db['a'] = 'x'
+        self.assertFalse(other.has_key('a'))
+        tx.commit()
+        self.assertEqual('x', other['a'])
+        other.close()
+
+    def testExplicitRollback(self):
+        tx = self._db.transaction(durable=True)
+        self._db['a'] = 'x'
+        tx.rollback()
+        self.assertFalse(tx.active)
+        self.assertFalse(self._db.has_key('a'))
+        self.assertEqual(0, len(self._db))
+
+    def testConditionalWritesInTransaction(self):
+        with self._db.transaction():
+            self.assertTrue(self._db.put_if_absent('a', 'x'))
+            self.assertTrue(self._db.cas('a', 'x', 'y'))
+            self.assertEqual('y!', self._db.transform('a', lambda v: v + '!'))
+        self.assertEqual('y!', self._db['a'])
+
+    def testTransformConflictInTransactionIsRaised(self):
+        self._db['a'] = 'x'
+        other = esedb.open(self._database)
+        tx = self._db.transaction()
+        self.assertEqual('x', self._db['a'])
+        other['a'] = 'y'
+        self.assertRaises(Esent.EsentWriteConflictException, self._db.transform, 'a', lambda v: v + '!')
+        tx.rollback()
+        self.assertEqual('y!', self._db.transform('a', lambda v: v + '!'))
+        other.close()
+
+    def testWriteWaitsForTransactionOfOtherCursor(self):
+        self._db['a'] = 'x'
+        other = esedb.open(self._database)
+        tx = self._db.transaction()
+        self._db['a'] = 'y'
+        writer = threading.Thread(target = other.__setitem__, args = ('a', 'z'))
+        writer.start()
+        time.sleep(0.1)
+        self.assertTrue(writer.isAlive())
+        tx.commit()
+        writer.join(10)
+        self.assertFalse(writer.isAlive())
+        self.assertEqual('z', self._db['a'])
+        self.assertEqual(1, len(self._db))
+        other.close()
+
+    def testWriteConflictingWithTransactionTimesOut(self):
+        self._db['a'] = 'x'
+        other = esedb.open(self._database)
+        other._writeConflictTimeout = 0.1
+        tx = self._db.transaction()
+        del self._db['a']
+        self.assertRaises(EseDBError, other.__setitem__, 'a', 'z')
+        self.assertRaises(EseDBError, other.__delitem__, 'a')
+        tx.rollback()
+        other['a'] = 'z'
+        self.assertEqual('z', self._db['a'])
+        other.close()
+
+    def testNestedTransactionRaisesError(self):
+        with self._db.transaction():
+            self.assertRaises(EseDBError, self._db.transaction)
+
+    def testEndedTransactionRaisesError(self):
+        tx = self._db.transaction()
+        tx.commit()
+        self.assertRaises(EseDBError, tx.commit)
+        self.assertRaises(EseDBError, tx.rollback)
+
+    def testCloseRollsBackTransaction(self):
+        self._db.transaction()
+        self._db['a'] = 'x'
+        self._db.close()
+        self._db = esedb.open(self._database)
+        self.assertFalse(self._db.has_key('a'))
+
+    def testRollbackToSavepoint(self):
+        with self._db.transaction() as tx:
+            self._db['a'] = 'x'
+            sp = tx.savepoint()
+            self._db['a'] = 'y'
+            self._db['b'] = 'z'
+            tx.rollback_to(sp)
+            self.assertEqual([('a', 'x')], self._db.items())
+            self.assertEqual(1, len(self._db))
+        self.assertEqual([('a', 'x')], self._db.items())
+
+    def testSavepointCanBeReused(self):
+        with self._db.transaction() as tx:
+            sp = tx.savepoint()
+            self._db['a'] = 'x'
+            tx.rollback_to(sp)
+            self._db['b'] = 'y'
+            tx.rollback_to(sp)
+            self._db['c'] = 'z'
+        self.assertEqual([('c', 'z')], self._db.items())
+
+    def testRollbackToDiscardsLaterSavepoints(self):
+        with self._db.transaction() as tx:
+            sp1 = tx.savepoint()
+            self._db['a'] = 'x'
+            sp2 = tx.savepoint()
+            self._db['b'] = 'y'
+            tx.rollback_to(sp1)
+            self.assertRaises(EseDBError, tx.rollback_to, sp2)
+        self.assertEqual(0, len(self._db))
+
+    def testReleaseSavepoint(self):
+        with self._db.transaction() as tx:
+            sp = tx.savepoint()
+            self._db['a'] = 'x'
+            tx.release(sp)
+            self.assertRaises(EseDBError, tx.rollback_to, sp)
+        self.assertEqual([('a', 'x')], self._db.items())
+
+    def testRollbackUndoesSavepoints(self):
+        tx = self._db.transaction()
+        self._db['a'] = 'x'
+        tx.savepoint()
+        self._db['b'] = 'y'
+        tx.rollback()
+        self.assertEqual(0, len(self._db))
+
+    def testCommitWithOpenSavepoints(self):
+        tx = self._db.transaction()
+        tx.savepoint()
+        self._db['a'] = 'x'
+        tx.savepoint()
+        self._db['b'] = 'y'
+        tx.commit()
+        self.assertEqual([('a', 'x'), ('b', 'y')], self._db.items())
+
+    def testTooManySavepointsRaisesError(self):
+        with self._db.transaction() as tx:
+            for i in xrange(5):
+                tx.savepoint()
+            self.assertRaises(EseDBError, tx.savepoint)
+            # The cursor can still be used with the savepoints held
+            self._db['a'] = 'x'
+            self.assertEqual('x', self._db['a'])
+        self.assertEqual([('a', 'x')], self._db.items())
+
+    def testMostSavepointsOnDeduplicatedTable(self):
+        self._db.close()
+        self._db = esedb.open(self._database, 'n', dedup=True)
+        with self._db.transaction() as tx:
+            for i in xrange(5):
+                tx.savepoint()
+            self._db['a'] = 'x' * 100
+            self._db['b'] = 'x' * 100
+            del self._db['a']
+        self.assertEqual([('b', 'x' * 100)], self._db.items())
+
+    def testReleasedSavepointsCanBeTakenAgain(self):
+        with self._db.transaction() as tx:
+            sp = tx.savepoint()
+            for i in xrange(4):
+                tx.savepoint()
+            tx.release(sp)
+            for i in xrange(5):
+                tx.savepoint()
+            self._db['a'] = 'x'
+        self.assertEqual([('a', 'x')], self._db.items())
+
+    def testRollbackToSavepointRemovesSideFiles(self):
+        self._db.close()
+        self._db = esedb.open(self._database, 'n', external_threshold=16)
+        directory = Path.Combine(self._database + '.files', 'esedb_data')
+        with self._db.transaction() as tx:
+            self._db['a'] = 'x' * 64
+            sp = tx.savepoint()
+            self._db['b'] = 'y' * 64
+            tx.rollback_to(sp)
+        self.assertEqual(1, len(Directory.GetFiles(directory)))
+
+class EsedbExpiryFixture(unittest.TestCase):
+    """Tests for records which expire."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._database = self._makeDatabasePath('test.edb')
+        self._db = esedb.open(self._database, 'n', expiry=True)
+
+    def tearDown(self):
+        self._db.close()
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def _expire(self, *keys):
+        for k in keys:
+            self._db.set(k, 'expired', ttl=0.001)
+        time.sleep(0.05)
+
+    def testRecordWithTtl(self):
+        self._db.set('a', 'x', ttl=3600)
+        self.assertEqual('x', self._db['a'])
+        self.assertTrue(self._db.has_key('a'))
+
+    def testExpiredRecordIsAbsent(self):
+        self._expire('a')
+        self.assertRaises(KeyError, self._db.__getitem__, 'a')
+        self.assertFalse(self._db.has_key('a'))
+        self.assertEqual('default', self._db.pop('a', 'default'))
+
+    def testIterationSkipsExpiredRecords(self):
+        self._db['b'] = 'y'
+        self._db['d'] = 'z'
+        self._expire('a', 'c', 'e')
+        self.assertEqual(['b', 'd'], self._db.keys())
+        self.assertEqual(('b', 'y'), self._db.first())
+        self.assertEqual(('d', 'z'), self._db.next())
+        self.assertRaises(KeyError, self._db.next)
+        self.assertEqual(('d', 'z'), self._db.last())
+        self.assertEqual(('b', 'y'), self._db.previous())
+        self.assertEqual(('d', 'z'), self._db.set_location('c'))
+        self.assertEqual('d', self._db.nextkey('b'))
+        self.assertEqual([('b', 'y'), ('d', 'z')], list(self._db.scan()))
+
+    def testWritesReplaceExpiredRecords(self):
+        self._expire('a', 'b', 'c')
+        self._db['a'] = 'x'
+        self.assertEqual('y', self._db.setdefault('b', 'y'))
+        self.assertTrue(self._db.put_if_absent('c', 'z'))
+        self.assertEqual([('a', 'x'), ('b', 'y'), ('c', 'z')], self._db.items())
+
+    def testSetWithoutTtlMakesRecordPermanent(self):
+        self._db.set('a', 'x', ttl=0.001)
+        self._db['a'] = 'y'
+        time.sleep(0.05)
+        self.assertEqual('y', self._db['a'])
+
+    def testSweepExpired(self):
+        self._db['a'] = 'x'
+        self._db.set('b', 'y', ttl=3600)
+        self._expire(*[str(i) for i in range(250)])
+        self.assertEqual(252, len(self._db))
+        self.assertEqual(250, self._db.sweep_expired(batchsize=100))
+        self.assertEqual(2, len(self._db))
+        self.assertEqual(0, self._db.sweep_expired())
+        self.assertEqual(['a', 'b'], self._db.keys())
+
+    def testSweeper(self):
+        self._expire('a', 'b')
+        self._db.start_sweeper(interval=0.1)
+        self.assertRaises(EseDBError, self._db.start_sweeper)
+        time.sleep(1)
+        self._db.stop_sweeper()
+        self.assertEqual(0, len(self._db))
+
+    def testSweepSkipsRecordsWrittenByTransaction(self):
+        self._expire('a', 'b')
+        other = esedb.open(self._database)
+        tx = other.transaction()
+        other.set('a', 'x', ttl=3600)
+        self.assertEqual(1, self._db.sweep_expired())
+        tx.commit()
+        self.assertEqual([('a', 'x')], self._db.items())
+        other.close()
+
+    def testSweepDoesntDeleteReplacedRecords(self):
+        self._expire('a')
+        self._db['a'] = 'x'
+        self.assertEqual(0, self._db.sweep_expired())
+        self.assertEqual([('a', 'x')], self._db.items())
+
+    def testSweeperErrorIsRaisedByStop(self):
+        def fail(batchsize):
+            raise EseDBError('sweep failed')
+        self._db.start_sweeper(interval=0.1)
+        sweeper = self._db._sweeper
+        sweeper._cursor._deleteExpiredBatch = fail
+        sweeper._thread.join(10)
+        self.assertFalse(sweeper._thread.isAlive())
+        self.assertRaises(EseDBError, self._db.stop_sweeper)
+        self._db.start_sweeper(interval=0.1)
+        self._db.stop_sweeper()
+
+    def testSweeperIsADaemonThread(self):
+        self._db.start_sweeper(interval=0.1)
+        self.assertTrue(self._db._sweeper._thread.daemon)
+        self._db.stop_sweeper()
+
+    def testSweeperCantBeStartedReadOnly(self):
+        self._db.close()
+        self._db = esedb.open(self._database, 'r')
+        self.assertRaises(EseDBError, self._db.start_sweeper)
+
+    def testSweeperIsStoppedOnClose(self):
+        self._db.start_sweeper(interval=0.1)
+        self._db.close()
+        self._db = esedb.open(self._database)
+        self.assertEqual(0, len(self._db))
+
+    def testExpiryIsDetectedOnOpen(self):
+        self._db.close()
+        self._db = esedb.open(self._database)
+        self._expire('a')
+        self.assertFalse(self._db.has_key('a'))
+
+    def testTtlNeedsExpiry(self):
+        self._db.close()
+        self._db = esedb.open(self._database, 'n')
+        self.assertRaises(EseDBError, self._db.set, 'a', 'x', ttl=10)
+        self.assertRaises(EseDBError, self._db.sweep_expired)
+        self._db.set('a', 'x')
+        self.assertEqual('x', self._db['a'])
+
+    def testInvalidTtlRaisesError(self):
+        self.assertRaises(EseDBError, self._db.set, 'a', 'x', ttl=0)
+        self.assertRaises(EseDBError, self._db.set, 'a', 'x', ttl='10')
+
+class EsedbClosedCursorFixture(unittest.TestCase):
+    """Tests for esedb on a closed cursor."""
+
+    def setUp(self):
+        self._dataDirectory = 'unittest_data'
+        self._deleteDataDirectory()
+        self._db = esedb.open(self._makeDatabasePath('test.edb'))
+        self._db.close()
+        self._deleteDataDirectory()
+
+    def _deleteDataDirectory(self):
+        deleteDirectory(self._dataDirectory)
+
+    def _makeDatabasePath(self, filename):
+        return Path.Combine(self._dataDirectory, filename)
+
+    def testGetitemRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.__getitem__, '_')
+
+    def testSetitemRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.__setitem__, '_', '_')
+
+    def testDelitemRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.__delitem__, '_')
+
+    def testLenRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, len, self._db)
+
+    def testContainsRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.__contains__, '_')
+
+    def testClearRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.clear)
+
+    def testIterkeysRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.iterkeys)
+
+    def testKeysRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.keys)
+
+    def testItervaluesRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.itervalues)
+
+    def testValuesRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.values)
+
+    def testIteritemsRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.iteritems)
+
+    def testScanRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.scan)
+
+    def testItemsRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.items)
+
+    def testHaskeyRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.has_key, '_')
+
+    def testSetlocationRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.set_location, '_')
+
+    def testFirstRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.first)
+
+    def testLastRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.last)
+
+    def testNextRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.next)
+        
+    def testPreviousRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.previous)
+
+    def testFirstKeyRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.firstkey)
+
+    def testNextKeyRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.nextkey)
+        
+    def testPopRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.pop, 'a')
+
+    def testPopItemRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.popitem)
+
+    def testSetDefaultRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.setdefault)
+
+    def testCreateIndexRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.create_index, 'length', len)
+
+    def testLookupRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.lookup, 'length', 2)
+
+    def testTableRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.table, 'other')
+
+    def testSpaceUsageRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.space_usage)
+
+    def testPrefixItemsRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.prefix_items, ('a',))
+
+    def testPrefixKeysRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.prefix_keys, ('a',))
+
+    def testUpdateRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.update)
+
+    def testIncrRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.incr, 'a')
+
+    def testCounterRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.counter, 'a')
+
+    def testCasRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.cas, 'a', 'x', 'y')
+
+    def testPutIfAbsentRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.put_if_absent, 'a', 'x')
+
+    def testDeleteIfRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.delete_if, 'a', 'x')
+
+    def testTransformRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.transform, 'a', lambda v: v)
+
+    def testTransactionRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.transaction)
+
+    def testSetRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.set, 'a', 'x')
+
+    def testSweepExpiredRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.sweep_expired)
+
+    def testStartSweeperRaisesErrorOnClosedCursor(self):
+        self.assertRaises(EseDBCursorClosedError, self._db.start_sweeper)
         
 class EsedbDictionaryComparisonFixture(unittest.TestCase):
     """Test esedb against an in-memory dictionary, starting with an empty dictionary.